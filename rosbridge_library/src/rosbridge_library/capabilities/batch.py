@@ -0,0 +1,79 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# Copyright (c) 2014, Creativa 77 SRL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+from rosbridge_library.capability import Capability
+
+
+def join_serialized(messages):
+    """ Returns a batch message containing the given serialized JSON messages,
+    without deserializing them again """
+    return '{"op": "batch", "ops": [' + ", ".join(messages) + ']}'
+
+
+class Batch(Capability):
+    """ Handles messages carrying a list of ordinary rosbridge messages, so a
+    client sending many messages at once, e.g. publishing on many topics per
+    control cycle, sends and the server parses a single frame.
+
+    The messages are processed in order, as if they had been sent one by one.
+    Errors are reported per message, with the id of the failing message, and
+    do not stop the following messages from being processed.
+
+    Servers send batches to clients that set a batch_window, see
+    join_serialized. """
+
+    batch_msg_fields = [(True, "ops", list)]
+
+    def __init__(self, protocol):
+        # Call superclass constructor
+        Capability.__init__(self, protocol)
+
+        # Register the operations that this capability provides
+        protocol.register_operation("batch", self.batch)
+
+    def batch(self, message):
+        # Do basic type checking
+        self.basic_type_check(message, self.batch_msg_fields)
+        bid = message.get("id", None)
+
+        for index, entry in enumerate(message["ops"]):
+            if not isinstance(entry, dict):
+                self.protocol.log("error", "Batch entry %d is not a message: %s" % (index, entry), bid)
+                continue
+            if entry.get("op") == "batch":
+                self.protocol.log("error", "Batch entry %d: batches can not be nested" % index,
+                                  entry.get("id", bid))
+                continue
+            self.protocol.process_message(entry)
+
+    def finish(self):
+        self.protocol.unregister_operation("batch")
@@ -31,8 +31,14 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from rosbridge_library.capability import Capability
+from rosbridge_library.internal.send_queue import MessageStream
+from rosbridge_library.util import json, bson
 import math
 
+# Fragments carry at least this many characters of the message, so the cut
+# can always be moved back to the start of an escape sequence
+min_fragment_data = 12
+
 
 class Fragmentation(Capability):
     """ The Fragmentation capability doesn't define any incoming operation
@@ -85,6 +91,45 @@ class Fragmentation(Capability):
 
         return self._fragment_generator(serialized, fragment_size, mid)
     
+    def fragment_serialized(self, serialized, fragment_size, mid=None):
+        """ Returns the fragments of a message that was already serialized,
+        as a MessageStream that creates each fragment only when it is taken.
+
+        Unlike fragment, the message is not serialized again, and the
+        fragments including their envelope are at most fragment_size long.
+
+        Keyword Arguments
+        serialized    -- the serialized message, a JSON string or, in
+        bson_only_mode, BSON
+        fragment_size -- the max size for the fragments
+        mid           -- (optional) if provided, the fragment messages
+        will be given this id.  Otherwise an id will be auto-generated.
+        """
+        if mid is None:
+            mid = self.fragmentation_seed
+            self.fragmentation_seed = self.fragmentation_seed + 1
+
+        if self.protocol.bson_only_mode:
+            return BsonFragments(serialized, fragment_size, mid)
+        return JsonFragments(serialized, fragment_size, mid)
+
+    def fragment_chunks(self, chunks, fragment_size, mid=None):
+        """ Like fragment_serialized, for a JSON message that was serialized
+        into a list of chunks, e.g. by json_streaming.dump_chunks.  The
+        chunks are escaped one by one, they are never joined unescaped.
+
+        Keyword Arguments
+        chunks        -- the serialized message, as a list of JSON strings
+        fragment_size -- the max size for the fragments
+        mid           -- (optional) if provided, the fragment messages
+        will be given this id.  Otherwise an id will be auto-generated.
+        """
+        if mid is None:
+            mid = self.fragmentation_seed
+            self.fragmentation_seed = self.fragmentation_seed + 1
+
+        return JsonFragments(chunks, fragment_size, mid)
+
     def _fragment_generator(self, msg, size, mid):
         """ Returns a generator of fragment messages """
         total = ((len(msg)-1) / size) + 1
@@ -104,3 +149,130 @@ class Fragmentation(Capability):
             "num": num,
             "total": total
         }
+
+
+class JsonFragments(MessageStream):
+    """ The fragments of a JSON message.
+
+    The message is escaped as a JSON string once, and each fragment is the
+    envelope around a slice of it.  Slices never split an escape sequence or
+    a surrogate pair, so the data of each fragment is a valid string.
+
+    The message is a string, or a list of strings to be concatenated. """
+
+    def __init__(self, serialized, fragment_size, mid):
+        if isinstance(serialized, list):
+            # Escaping works character by character, so the escaped chunks
+            # concatenate to the escaped message
+            self.escaped = '"%s"' % "".join(json.dumps(chunk)[1:-1] for chunk in serialized)
+        else:
+            self.escaped = json.dumps(serialized)
+        self.prefix = '{"op": "fragment", "id": %s, "data": "' % json.dumps(mid)
+        overhead = len(self.prefix) + len('", "num": , "total": }')
+
+        # num and total take up to as many digits as total
+        digits = 1
+        while True:
+            budget = max(fragment_size - overhead - 2 * digits, min_fragment_data)
+            self.bounds = self._split(budget)
+            self.count = len(self.bounds) - 1
+            if len(str(self.count)) <= digits:
+                break
+            digits = len(str(self.count))
+
+        self.num = 0
+        self.size = (self.count * (overhead + len(str(self.count))) +
+                     self.bounds[-1] - self.bounds[0] +
+                     sum(len(str(n)) for n in range(self.count)))
+
+    def _split(self, budget):
+        # Skip the quotes around the escaped message
+        bounds = [1]
+        end = len(self.escaped) - 1
+        while end - bounds[-1] > budget:
+            bounds.append(self._cut(bounds[-1], bounds[-1] + budget))
+        bounds.append(end)
+        return bounds
+
+    def _cut(self, start, cut):
+        """ Moves cut back to the start of the escape sequence or surrogate
+        pair it would split.  start is the start of the fragment. """
+        escaped = self.escaped
+        backslash = escaped.rfind("\\", max(start, cut - 5), cut)
+        if backslash >= 0 and self._starts_escape(start, backslash):
+            length = 6 if escaped[backslash + 1] == "u" else 2
+            if backslash + length > cut:
+                cut = backslash
+        if (self._is_surrogate(cut, "cdef") and cut - 6 >= start and
+                self._is_surrogate(cut - 6, "89ab") and self._starts_escape(start, cut - 6)):
+            cut = cut - 6
+        return cut
+
+    def _starts_escape(self, start, backslash):
+        """ Whether the backslash starts an escape sequence rather than
+        ending one, counted from start, which starts no escape sequence """
+        first = backslash
+        while first > start and self.escaped[first - 1] == "\\":
+            first = first - 1
+        return (backslash - first) % 2 == 0
+
+    def _is_surrogate(self, i, second_digits):
+        escape = self.escaped[i:i + 4].lower()
+        return len(escape) == 4 and escape[:3] == "\\ud" and escape[3] in second_digits
+
+    def next(self):
+        if self.done():
+            raise StopIteration
+        n = self.num
+        fragment = '%s%s", "num": %d, "total": %d}' % (
+            self.prefix, self.escaped[self.bounds[n]:self.bounds[n + 1]], n, self.count)
+        self.num = n + 1
+        self.size = self.size - len(fragment)
+        return fragment
+
+    def done(self):
+        return self.num == self.count
+
+    def __len__(self):
+        return self.size
+
+
+class BsonFragments(MessageStream):
+    """ The fragments of a BSON message, sliced from its buffer through a
+    memoryview, so only the data of the current fragment is copied """
+
+    def __init__(self, serialized, fragment_size, mid):
+        self.view = memoryview(serialized)
+        self.mid = mid
+        # Integers are encoded with a fixed size, the envelope of all
+        # fragments is as long as that of an empty one
+        overhead = len(bson.BSON.encode(self._create_fragment(b"", 0, 0)))
+        self.budget = max(fragment_size - overhead, 1)
+        self.count = int(math.ceil(len(self.view) / float(self.budget)))
+        self.num = 0
+        self.size = len(self.view) + self.count * overhead
+
+    def _create_fragment(self, data, num, total):
+        return {
+            "op": "fragment",
+            "id": self.mid,
+            "data": data,
+            "num": num,
+            "total": total
+        }
+
+    def next(self):
+        if self.done():
+            raise StopIteration
+        n = self.num
+        data = self.view[n * self.budget:(n + 1) * self.budget].tobytes()
+        fragment = bson.BSON.encode(self._create_fragment(data, n, self.count))
+        self.num = n + 1
+        self.size = max(self.size - len(fragment), 0)
+        return fragment
+
+    def done(self):
+        return self.num == self.count
+
+    def __len__(self):
+        return self.size
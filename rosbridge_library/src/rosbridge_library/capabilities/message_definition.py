@@ -0,0 +1,69 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# Copyright (c) 2014, Creativa 77 SRL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+from rosbridge_library.capability import Capability
+from rosbridge_library.internal import ros_loader
+from rosbridge_library.util import string_types
+
+
+class MessageDefinition(Capability):
+    """ Sends the definition of a message type as written in its .msg file,
+    including the definitions of the types it uses, so clients receiving raw
+    messages can generate decoders for them. """
+
+    get_message_definition_msg_fields = [(True, "type", string_types)]
+
+    def __init__(self, protocol):
+        # Call superclass constructor
+        Capability.__init__(self, protocol)
+
+        # Register the operations that this capability provides
+        protocol.register_operation("get_message_definition", self.get_message_definition)
+
+    def get_message_definition(self, message):
+        self.basic_type_check(message, self.get_message_definition_msg_fields)
+
+        # Propagates the exceptions of unknown types
+        msg_class = ros_loader.get_message_class(message["type"])
+
+        outgoing_message = {
+            "op": "message_definition",
+            "type": msg_class._type,
+            "md5sum": msg_class._md5sum,
+            "definition": msg_class._full_text
+        }
+        if "id" in message:
+            outgoing_message["id"] = message["id"]
+        self.protocol.send(outgoing_message)
+
+    def finish(self):
+        self.protocol.unregister_operation("get_message_definition")
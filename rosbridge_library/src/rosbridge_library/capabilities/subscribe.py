@@ -33,21 +33,20 @@
 import fnmatch
 from threading import Lock
 from functools import partial
+from itertools import chain
 from rospy import loginfo
 from rosbridge_library.capability import Capability
-from rosbridge_library.internal.subscribers import manager
+from rosbridge_library.internal.subscribers import manager, RawMessage, SerializedMessage
 from rosbridge_library.internal.subscription_modifiers import MessageHandler
 from rosbridge_library.internal.pngcompression import encode
+from rosbridge_library.internal import conversion_pool, delta_encoding
+from rosbridge_library.internal.json_streaming import StreamedMessage
+from rosbridge_library.internal.send_queue import Chained
+from rosbridge_library.internal.serialization_cache import cache as serialization_cache
+from rosbridge_library.internal.binary_attachments import Attachment
+from rosbridge_library.internal.exceptions import InvalidArgumentException
 
-try:
-    from ujson import dumps
-except ImportError:
-    try:
-        from simplejson import dumps
-    except ImportError:
-        from json import dumps
-
-from rosbridge_library.util import string_types
+from rosbridge_library.util import json, bson, string_types
 
 
 class Subscription():
@@ -55,6 +54,8 @@ class Subscription():
 
     Chooses the most appropriate settings to send messages """
 
+    default_keyframe_interval = 50
+
     def __init__(self, client_id, topic, publish):
         """ Create a subscription for the specified client on the specified
         topic, with callback publish
@@ -70,6 +71,13 @@ class Subscription():
         self.publish = publish
 
         self.clients = {}
+        self.options = None
+
+        # The last message sent in full or patched, for delta encoding
+        self.last_message = None
+        self.messages_since_keyframe = 0
+        self.keyframe_requested = False
+        self.delta_lock = Lock()
 
         self.handler = MessageHandler(None, self._publish)
         self.handler_lock = Lock()
@@ -77,13 +85,14 @@ class Subscription():
 
     def unregister(self):
         """ Unsubscribes this subscription and cleans up resources """
-        manager.unsubscribe(self.client_id, self.topic)
+        manager.unsubscribe(self.client_id, self.topic, options=self.options)
         with self.handler_lock:
             self.handler.finish()
         self.clients.clear()
 
     def subscribe(self, sid=None, msg_type=None, throttle_rate=0,
-                  queue_length=0, fragment_size=None, compression="none", options=None):
+                  queue_length=0, fragment_size=None, compression="none", options=None,
+                  fields=None, delta=False, keyframe_interval=None, encoding=None):
         """ Add another client's subscription request
 
         If there are multiple calls to subscribe, the values actually used for
@@ -101,6 +110,17 @@ class Subscription():
         allowed outgoing messages
         compression     -- "none" if no compression, or some other value if
         compression is to be used (current valid values are 'png')
+        options         -- (optional) dictionary of conversion options
+        fields          -- (optional) list of field paths to restrict messages
+        to.  If multiple subscriptions, the union of these is used, or the
+        whole message if any subscription did not specify fields
+        delta           -- send patches against the previous message instead of
+        full messages.  Only used if all subscriptions request it
+        keyframe_interval -- the number of patches between two full messages
+        when using delta.  If multiple subscriptions, the lower of these is
+        used
+        encoding        -- "raw" to send messages as serialized by ROS.  Only
+        used if all subscriptions request it
 
          """
 
@@ -108,15 +128,66 @@ class Subscription():
             "throttle_rate": throttle_rate,
             "queue_length": queue_length,
             "fragment_size": fragment_size,
-            "compression": compression
+            "compression": compression,
+            "fields": tuple(fields) if fields else None,
+            "delta": delta,
+            "keyframe_interval": keyframe_interval or self.default_keyframe_interval,
+            "raw": encoding == "raw"
         }
 
+        previous_details = self.clients.get(sid)
         self.clients[sid] = client_details
 
         self.update_params()
 
         # Subscribe with the manager. This will propagate any exceptions
+        try:
+            self.register(msg_type, options)
+        except Exception:
+            if previous_details is None:
+                del self.clients[sid]
+            else:
+                self.clients[sid] = previous_details
+            self.update_params()
+            raise
+
+        # The new subscription has not seen any message yet
+        self.request_keyframe()
+
+    def register(self, msg_type=None, options=None):
+        """ Subscribes with the manager with the conversion options of the
+        client, adjusted to the subscription's parameters.  The options of
+        the latest call apply to the whole subscription, the subscriber
+        registered with different options is dropped.
+
+        Keyword arguments:
+        msg_type -- (optional) the type of the topic
+        options  -- (optional) dictionary of conversion options
+
+        """
+        options = self.adjust_options(options)
         manager.subscribe(self.client_id, self.topic, self.on_msg, msg_type, options=options)
+        if self.options is not None and self.options != options:
+            manager.unsubscribe(self.client_id, self.topic, options=self.options)
+        self.options = options
+
+    def adjust_options(self, options):
+        """ Returns the conversion options of the client, adjusted to the
+        subscription's parameters """
+        options = dict(options) if options else {}
+        if self.raw:
+            # Raw messages are not converted, all raw clients share them
+            options = {"encoding": "raw"}
+        if self.fields and not self.raw:
+            options["fields"] = self.fields
+        # Only stream messages that are serialized as they are
+        if self.fields or self.delta or self.compression != "none":
+            options["stream_messages"] = False
+        # Only serialize messages in the conversion pool if they are sent as
+        # they are
+        if self.delta or self.compression != "none":
+            options["serialization"] = None
+        return options
 
     def unsubscribe(self, sid=None):
         """ Unsubscribe this particular client's subscription
@@ -132,15 +203,55 @@ class Subscription():
 
         if not self.is_empty():
             self.update_params()
+            self.request_keyframe()
 
     def is_empty(self):
         """ Return true if there are no subscriptions currently """
         return len(self.clients) == 0
 
+    def request_keyframe(self):
+        """ Makes the next message be sent in full when using delta encoding.
+        Does not take the lock, as send queues call it while a message of this
+        subscription is being published. """
+        self.keyframe_requested = True
+
     def _publish(self, message):
         """ Internal method to propagate published messages to the registered
         publish callback """
-        self.publish(message, self.fragment_size, self.compression)
+        if isinstance(message, (RawMessage, SerializedMessage)):
+            # Sent as they are, raw and serialized messages are neither
+            # compressed nor patched
+            self.publish(message, self.fragment_size)
+            if self.delta:
+                # Sent by the subscriber before the options changed, patches
+                # have to start from a full message again
+                self.request_keyframe()
+            return
+        if not self.delta or self.compression != "none":
+            self.publish(message, self.fragment_size, self.compression)
+            return
+
+        if isinstance(message, StreamedMessage):
+            # Sent by the subscriber before the options changed
+            message = message.extract_values()
+
+        # Patches have to arrive in the order they were computed in.  They
+        # are chained in the send queue, which asks for a keyframe if it has
+        # to drop one of them
+        with self.delta_lock:
+            last_message = self.last_message
+            self.last_message = message
+            if (last_message is None or self.keyframe_requested or
+                    self.messages_since_keyframe >= self.keyframe_interval):
+                self.keyframe_requested = False
+                self.messages_since_keyframe = 0
+                self.publish(message, self.fragment_size, self.compression,
+                             chained=Chained(self, start=True))
+            else:
+                self.messages_since_keyframe += 1
+                patch = delta_encoding.diff(last_message, message)
+                self.publish(message, self.fragment_size, self.compression, delta=patch,
+                             chained=Chained(self))
 
     def on_msg(self, msg):
         """ Raw callback called by subscription manager for all incoming
@@ -161,6 +272,10 @@ class Subscription():
             self.queue_length = 0
             self.fragment_size = None
             self.compression = "none"
+            self.fields = None
+            self.delta = False
+            self.keyframe_interval = self.default_keyframe_interval
+            self.raw = False
             return
 
         def f(fieldname):
@@ -174,6 +289,14 @@ class Subscription():
         else:
             self.fragment_size = min(frags)
         self.compression = "png" if "png" in f("compression") else "none"
+        fields = f("fields")
+        if None in fields:
+            self.fields = None
+        else:
+            self.fields = tuple(sorted(set(chain(*fields))))
+        self.delta = all(f("delta"))
+        self.keyframe_interval = min(f("keyframe_interval"))
+        self.raw = all(f("raw"))
 
         with self.handler_lock:
             self.handler = self.handler.set_throttle_rate(self.throttle_rate)
@@ -184,7 +307,9 @@ class Subscribe(Capability):
 
     subscribe_msg_fields = [(True, "topic", string_types), (False, "type", string_types),
                             (False, "throttle_rate", int), (False, "fragment_size", int),
-                            (False, "queue_length", int), (False, "compression", string_types)]
+                            (False, "queue_length", int), (False, "compression", string_types),
+                            (False, "fields", list), (False, "delta", bool),
+                            (False, "keyframe_interval", int), (False, "encoding", string_types)]
     unsubscribe_msg_fields = [(True, "topic", string_types)]
 
     topics_glob = None
@@ -207,6 +332,15 @@ class Subscribe(Capability):
         # Check the args
         self.basic_type_check(msg, self.subscribe_msg_fields)
 
+        encoding = msg.get("encoding", None)
+        if encoding is not None and encoding != "raw":
+            raise InvalidArgumentException("Unknown encoding %s, expected raw" % encoding)
+        if encoding == "raw" and not self.sends_binary():
+            raise InvalidArgumentException("The raw encoding needs binary_attachments or a binary serializer")
+        fields = msg.get("fields", None)
+        if fields is not None and not all(isinstance(field, string_types) for field in fields):
+            raise InvalidArgumentException("Expected field fields to be a list of field paths. Invalid value: %s" % (fields,))
+
         # Make the subscription
         topic = msg["topic"]
 
@@ -237,7 +371,11 @@ class Subscribe(Capability):
           "fragment_size": msg.get("fragment_size", None),
           "queue_length": msg.get("queue_length", 0),
           "compression": msg.get("compression", "none"),
-          "options": dict(add_ros_type_to_message=self.add_ros_type_to_message)
+          "fields": fields,
+          "delta": msg.get("delta", False),
+          "keyframe_interval": msg.get("keyframe_interval", None),
+          "encoding": encoding,
+          "options": self.conversion_options()
         }
         self._subscriptions[topic].subscribe(**subscribe_args)
 
@@ -274,7 +412,8 @@ class Subscribe(Capability):
 
         self.protocol.log("info", "Unsubscribed from %s" % topic)
 
-    def publish(self, topic, message, fragment_size=None, compression="none"):
+    def publish(self, topic, message, fragment_size=None, compression="none", delta=None,
+                chained=None):
         """ Publish a message to the client
 
         Keyword arguments:
@@ -285,6 +424,10 @@ class Subscribe(Capability):
         with payloads not greater than this value
         compression   -- (optional) compress the message. valid values are
         'png' and 'none'
+        delta         -- (optional) a patch against the previous message of
+        the subscription, sent instead of message
+        chained       -- (optional) the send_queue.Chained marker of a
+        message of a delta encoded subscription
 
         """
         # TODO: fragmentation, proper ids
@@ -302,11 +445,82 @@ class Subscribe(Capability):
         else:
             self.protocol.log("debug", "No topic security glob, not checking topic publish.")
 
+        if delta is not None:
+            # Patches depend on the previous message of this client, so they
+            # cannot be shared
+            self.protocol.send({"op": "publish", "topic": topic, "delta": delta}, chained=chained)
+            return
+
+        if isinstance(message, SerializedMessage):
+            # Converted and serialized for this client in the conversion pool.
+            # Messages serialized before the client changed its settings are
+            # skipped, the subscription is registered with the new ones.
+            if message.serialization != self.pool_serialization():
+                return
+            self.protocol.send({"op": "publish", "topic": topic}, serialized=message.data)
+            return
+
+        if isinstance(message, RawMessage):
+            outgoing_msg = {"op": "publish", "topic": topic, "encoding": "raw",
+                            "type": message.type, "md5sum": message.md5sum,
+                            "msg": self.binary(message.data)}
+            self.protocol.send(outgoing_msg, shared_source=message, shared_key=(topic, "raw"))
+            return
+
+        if compression == "png" and isinstance(message, StreamedMessage):
+            message = message.extract_values()
+
         outgoing_msg = {"op": "publish", "topic": topic, "msg": message}
-        if compression == "png":
-            outgoing_msg_dumped = dumps(outgoing_msg)
-            outgoing_msg = {"op": "png", "data": encode(outgoing_msg_dumped)}
-        self.protocol.send(outgoing_msg)
+        if compression == "png" and not self.protocol.binary_attachments and not self.protocol.serializer.native_binary:
+            # The png data only depends on the message, share it between clients
+            png_data = serialization_cache.get(message, (topic, "png_data"))
+            if png_data is None:
+                png_data = encode(json.dumps(outgoing_msg))
+                serialization_cache.put(message, (topic, "png_data"), png_data)
+            outgoing_msg = {"op": "png", "data": png_data}
+        else:
+            compression = "none"
+        self.protocol.send(outgoing_msg, shared_source=message, shared_key=(topic, compression),
+                           chained=chained)
+
+    def serialization_changed(self):
+        # Messages are converted and serialized ahead for the client with
+        # the options of its protocol
+        options = self.conversion_options()
+        for topic, subscription in list(self._subscriptions.items()):
+            if subscription.adjust_options(options) == subscription.options:
+                continue
+            try:
+                subscription.register(options=options)
+            except Exception as exc:
+                self.protocol.log("error", "Unable to update the subscription to %s: %s" % (topic, exc))
+
+    def conversion_options(self):
+        """ Returns the options messages are converted with for the client """
+        return dict(add_ros_type_to_message=self.add_ros_type_to_message,
+                    binary_attachments=self.protocol.binary_attachments,
+                    native_binary=self.protocol.serializer.native_binary,
+                    typed_arrays=self.protocol.serializer.typed_arrays,
+                    stream_messages=self.protocol.streams_messages(),
+                    serialization=self.pool_serialization())
+
+    def pool_serialization(self):
+        """ Returns how the conversion pool serializes messages for the
+        client, or None if the pool is not running """
+        if conversion_pool.pool is None:
+            return None
+        return (type(self.protocol), self.protocol.serialization_key())
+
+    def sends_binary(self):
+        """ Returns True if bytes can be sent to the client as they are """
+        return (self.protocol.bson_only_mode or self.protocol.serializer.binary or
+                self.protocol.binary_attachments)
+
+    def binary(self, data):
+        """ Wraps bytes so that the client's serialization keeps them raw """
+        if self.protocol.bson_only_mode or self.protocol.serializer.name == "bson":
+            return bson.binary.Binary(data)
+        return Attachment(data)
 
     def finish(self):
         for subscription in self._subscriptions.values():
@@ -74,6 +74,11 @@ class Capability:
         time to free up resources. """
         pass
 
+    def serialization_changed(self):
+        """ Notify this capability that the client changed settings that the
+        protocol's serialization_key() depends on. """
+        pass
+
     def basic_type_check(self, msg, types_info):
         """ Performs basic typechecking on fields in msg.
 
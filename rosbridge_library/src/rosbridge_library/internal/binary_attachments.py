@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Binary attachments carry uint8[]/char[] fields as raw bytes next to the
+JSON envelope of a message instead of base64-encoding them into it.
+
+A binary frame has the following layout (all integers are big-endian):
+
+    4 bytes  magic, "RBIN"
+    uint32   length of the JSON header
+    uint32   total length of the attachments
+    bytes    the JSON header, utf-8 encoded
+    bytes    the attachments, concatenated
+
+In the JSON header every attached field is replaced by an object
+{"@attachment": {"offset": <int>, "length": <int>}} where offset is relative to
+the start of the attachments.
+"""
+
+import struct
+
+
+attachment_field_name = "@attachment"
+frame_magic = b"RBIN"
+frame_header = struct.Struct("!4sII")
+
+# Binary fields shorter than this are still base64-encoded inline
+min_attachment_size = 256
+
+
+class Attachment(object):
+    """ Placeholder for a binary field that is sent as a raw attachment """
+
+    __slots__ = ["data"]
+
+    def __init__(self, data):
+        self.data = data if isinstance(data, bytes) else bytes(bytearray(data))
+
+    def __len__(self):
+        return len(self.data)
+
+
+class BinaryFrame(bytes):
+    """ A serialized message that has to be sent as a binary frame """
+    pass
+
+
+def encode(msg, dumps):
+    """ Encodes msg as a binary frame if it contains any attachments.
+
+    msg itself is left untouched, since converted messages are shared between
+    clients.
+
+    Keyword arguments:
+    msg   -- the dictionary of values to serialize
+    dumps -- the function used to serialize the JSON header
+
+    Returns a BinaryFrame, or None if msg does not contain attachments
+    """
+    attachments = []
+    header = _extract_attachments(msg, attachments, [0])
+    if not attachments:
+        return None
+
+    header = dumps(header)
+    if not isinstance(header, bytes):
+        header = header.encode("utf-8")
+    attachments_length = sum(len(data) for data in attachments)
+    return BinaryFrame(b"".join([frame_header.pack(frame_magic, len(header), attachments_length), header] + attachments))
+
+
+def decode(frame, loads):
+    """ Decodes a binary frame back into a dictionary of values, with the
+    attachments as raw bytes """
+    magic, header_length, attachments_length = frame_header.unpack_from(frame)
+    if magic != frame_magic:
+        raise ValueError("Not a binary frame")
+    start = frame_header.size
+    header = frame[start:start + header_length]
+    attachments = frame[start + header_length:start + header_length + attachments_length]
+    return _resolve_attachments(loads(header.decode("utf-8")), attachments)
+
+
+def _extract_attachments(obj, attachments, offset):
+    """ Returns obj with all attachments replaced by references.  Containers
+    without attachments are returned as is rather than copied. """
+    if isinstance(obj, Attachment):
+        attachments.append(obj.data)
+        reference = {attachment_field_name: {"offset": offset[0], "length": len(obj.data)}}
+        offset[0] += len(obj.data)
+        return reference
+
+    if isinstance(obj, dict):
+        result = obj
+        for key, value in obj.items():
+            new_value = _extract_attachments(value, attachments, offset)
+            if new_value is not value:
+                if result is obj:
+                    result = dict(obj)
+                result[key] = new_value
+        return result
+
+    if isinstance(obj, list):
+        # ROS arrays are homogeneous, lists of primitives can be skipped
+        if len(obj) == 0 or not isinstance(obj[0], (dict, list, Attachment)):
+            return obj
+        result = obj
+        for i, value in enumerate(obj):
+            new_value = _extract_attachments(value, attachments, offset)
+            if new_value is not value:
+                if result is obj:
+                    result = list(obj)
+                result[i] = new_value
+        return result
+
+    return obj
+
+
+def _resolve_attachments(obj, attachments):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and attachment_field_name in obj:
+            reference = obj[attachment_field_name]
+            return attachments[reference["offset"]:reference["offset"] + reference["length"]]
+        for key, value in obj.items():
+            obj[key] = _resolve_attachments(value, attachments)
+    elif isinstance(obj, list):
+        for i, value in enumerate(obj):
+            obj[i] = _resolve_attachments(value, attachments)
+    return obj
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Converts subscribed messages in a pool of worker processes.
+
+Conversion and serialization otherwise run on the rospy callback threads,
+which share the GIL, so a server can only use a single core for them however
+many topics it sends.  With the pool started, subscribers receive
+rospy.AnyMsgs and pass their bytes to the workers, which deserialize,
+convert and serialize the messages, and return them ready to send.
+
+The results of jobs submitted with the same key, the topic of the messages,
+are delivered in the order the jobs were submitted, whichever worker
+finishes first.  Results of different keys don't wait for each other.  A job
+whose result doesn't arrive within job_timeout, e.g. because its worker was
+killed, is given up, so it doesn't hold up the later jobs of its key.
+
+The workers are started from a fork server, as forking the server itself
+could copy locks held by the threads of rospy.  The settings the conversion
+depends on, like the JSON backend, are passed to the workers when they
+start.  Python 2 forks the workers from the server.
+"""
+
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+from threading import Event, Lock, Thread
+from time import time
+import signal
+import traceback
+
+from rospy import logerr, logwarn
+from rosbridge_library.internal import message_conversion
+from rosbridge_library.util import json
+
+try:
+    from multiprocessing import get_context
+except ImportError:
+    # Python 2 can only fork the workers
+    get_context = None
+
+
+# Jobs allowed to wait for the workers per key.  Messages arriving while as
+# many are waiting are dropped, like those of a full ROS subscriber queue.
+default_max_pending = 100
+
+# Seconds after which a job that got no result is given up
+default_job_timeout = 10.0
+
+default_start_method = "forkserver"
+
+# The running pool, see start
+pool = None
+
+
+class Job(object):
+    """ A submitted job, waiting for its result to be delivered """
+
+    __slots__ = ["callback", "submitted", "result"]
+
+    def __init__(self, callback, submitted):
+        self.callback = callback
+        self.submitted = submitted
+        self.result = None
+
+
+class ConversionPool(object):
+    """ Runs jobs in worker processes, and delivers their results in the
+    order the jobs were submitted per key """
+
+    def __init__(self, processes, max_pending=default_max_pending, job_timeout=default_job_timeout,
+                 initializer=None, initargs=(), start_method=default_start_method):
+        """ Keyword arguments:
+        processes    -- the number of worker processes
+        max_pending  -- the number of jobs allowed to wait per key
+        job_timeout  -- seconds after which a job without result is given up
+        initializer  -- (optional) a function each worker calls on start
+        initargs     -- the arguments of initializer
+        start_method -- how the workers are started, see multiprocessing.
+        Ignored by Python 2
+
+        """
+        self.processes = processes
+        self.max_pending = max_pending
+        self.job_timeout = job_timeout
+        self.dropped = 0
+        self.timed_out = 0
+        if get_context is not None:
+            self._pool = get_context(start_method).Pool(processes, _init_worker, (initializer, initargs))
+            self._error_callbacks = True
+        else:
+            self._pool = Pool(processes, _init_worker, (initializer, initargs))
+            self._error_callbacks = False
+        # Guards the queues of pending jobs, which grow on the threads
+        # submitting jobs
+        self._lock = Lock()
+        # Makes results be delivered by one thread at a time
+        self._deliver_lock = Lock()
+        self._pending = {}
+        # Keys whose jobs are being dropped, logged once per backlog
+        self._dropping = set()
+        # Gives up jobs that timed out, also of keys that get no more jobs
+        self._stopped = Event()
+        self._reaper = Thread(target=self._reap)
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def submit(self, key, func, args, callback):
+        """ Runs func(*args) in a worker process, then calls callback with
+        its result, after the callbacks of the jobs submitted with the same
+        key before.  func and args must be picklable.
+
+        Returns False if the job was dropped, because max_pending jobs of the
+        same key are already waiting
+
+        """
+        job = Job(callback, time())
+        with self._lock:
+            pending = self._pending.setdefault(key, deque())
+            if len(pending) >= self.max_pending:
+                self.dropped += 1
+                if key not in self._dropping:
+                    self._dropping.add(key)
+                    logwarn("Dropping messages of %s, %d are waiting for conversion", key, len(pending))
+                return False
+            self._dropping.discard(key)
+            pending.append(job)
+        kwargs = dict(callback=partial(self._finished, key, job))
+        if self._error_callbacks:
+            kwargs["error_callback"] = partial(self._failed, key, job)
+        try:
+            self._pool.apply_async(_run, (func, args), **kwargs)
+        except Exception as exc:
+            # Don't hold up the jobs submitted after this one
+            self._finished(key, job, (False, str(exc)))
+            return False
+        return True
+
+    def _reap(self):
+        """ Delivers the results held up by jobs that timed out, checking
+        every half of job_timeout until the pool is terminated """
+        while not self._stopped.wait(self.job_timeout / 2.0):
+            now = time()
+            with self._lock:
+                stuck = [key for key, pending in self._pending.items()
+                         if now - pending[0].submitted > self.job_timeout]
+            for key in stuck:
+                with self._deliver_lock:
+                    self._deliver(key, now)
+
+    def _failed(self, key, job, exc):
+        """ Called if the result of job could not be sent back """
+        self._finished(key, job, (False, repr(exc)))
+
+    def _finished(self, key, job, result):
+        """ Stores the result of job, then delivers the results of key that
+        are ready """
+        with self._deliver_lock:
+            # Jobs that timed out already have a result
+            if job.result is None:
+                job.result = result
+            self._deliver(key, time())
+
+    def _deliver(self, key, now):
+        """ Delivers the results of all jobs of key that are done and were
+        submitted before the first that is not, giving up jobs that timed
+        out.  Called with the deliver lock held. """
+        ready = []
+        with self._lock:
+            pending = self._pending.get(key, ())
+            while pending:
+                job = pending[0]
+                if job.result is None and now - job.submitted > self.job_timeout:
+                    job.result = (False, "No result after %s seconds, the worker may have died" % self.job_timeout)
+                    self.timed_out += 1
+                if job.result is None:
+                    break
+                ready.append(pending.popleft())
+            if not pending:
+                self._pending.pop(key, None)
+        for job in ready:
+            succeeded, value = job.result
+            if not succeeded:
+                logerr("Exception while converting messages of %s in a worker process: %s", key, value)
+                continue
+            try:
+                job.callback(value)
+            except Exception as exc:
+                logerr("Exception delivering converted messages: %s", exc)
+
+    def pending(self):
+        """ Returns the number of jobs waiting to be delivered """
+        with self._lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+    def terminate(self):
+        """ Stops the worker processes, results not delivered yet are lost """
+        self._stopped.set()
+        self._pool.terminate()
+
+
+def _init_worker(initializer, initargs):
+    # Interrupts are handled by the server, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run(func, args):
+    """ Runs a job in a worker process.  Returns (True, result), or
+    (False, traceback) as exceptions may not be picklable, and the results
+    of later jobs of the key wait for this one's """
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _init_converter(json_backends, binary_encoder):
+    """ Makes a worker convert messages like the server """
+    json.use(*json_backends)
+    message_conversion.binary_encoder = binary_encoder
+
+
+def start(processes, max_pending=default_max_pending, job_timeout=default_job_timeout):
+    """ Starts the pool that subscribers convert messages in.  Call once at
+    startup, after choosing the JSON backend and before clients subscribe,
+    with processes > 0 to enable it.
+
+    Returns the pool, or None if it is not enabled
+
+    """
+    global pool
+    if processes and processes > 0 and pool is None:
+        initargs = ((json.encoder.name, json.decoder.name), message_conversion.get_encoder())
+        pool = ConversionPool(processes, max_pending, job_timeout, _init_converter, initargs)
+    return pool
+
+
+def stop():
+    """ Stops the pool, later subscriptions convert messages themselves """
+    global pool
+    if pool is not None:
+        pool.terminate()
+        pool = None
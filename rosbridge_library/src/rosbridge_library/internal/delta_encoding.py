@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Delta encoding sends only the parts of a converted message that changed
+since the previous message of the same subscription.
+
+A patch is a dictionary with an entry for every changed field:
+
+ * fields that are messages are patched recursively, with a nested patch
+ * fields that are arrays are either replaced by the complete new array, or
+   patched with {"length": <int>, "ranges": [{"start": <int>, "values": <list>}]}
+   which truncates or extends the array to length and overwrites the given
+   ranges of elements
+ * all other fields are replaced by their new value
+
+Unchanged fields are left out of the patch.
+"""
+
+# Arrays are compared in blocks of this many elements
+block_size = 64
+
+# Arrays are sent whole rather than patched if more than this fraction of
+# their elements changed
+max_patched_fraction = 0.5
+
+
+def diff(old, new):
+    """ Returns the patch that turns the converted message old into new.
+
+    Both messages must be of the same type and converted with the same
+    options, so that their dictionaries have the same layout.
+
+    """
+    patch = {}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+            continue
+        old_value = old[key]
+        if old_value is value or old_value == value:
+            continue
+        if type(value) is dict and type(old_value) is dict:
+            patch[key] = diff(old_value, value)
+        elif type(value) is list and type(old_value) is list:
+            patch[key] = _diff_list(old_value, value)
+        else:
+            patch[key] = value
+    return patch
+
+
+def apply(old, patch):
+    """ Returns the message that results from applying patch to old.  old is
+    left untouched. """
+    new = dict(old)
+    for key, value in patch.items():
+        old_value = old.get(key)
+        if type(value) is dict and type(old_value) is dict:
+            new[key] = apply(old_value, value)
+        elif type(value) is dict and type(old_value) is list:
+            new[key] = _apply_list(old_value, value)
+        else:
+            new[key] = value
+    return new
+
+
+def _diff_list(old, new):
+    """ Returns either the list new itself or a range patch, whichever is
+    smaller.  Blocks of elements are compared with slices first so only
+    changed blocks are scanned element by element. """
+    common = min(len(old), len(new))
+    ranges = []
+    changed = 0
+    start = None
+    for block in range(0, common, block_size):
+        end = min(block + block_size, common)
+        if old[block:end] == new[block:end]:
+            if start is not None:
+                changed += _add_range(ranges, old, new, start, block)
+                start = None
+        elif start is None:
+            start = block
+    if start is not None:
+        changed += _add_range(ranges, old, new, start, common)
+    if len(new) > common:
+        ranges.append({"start": common, "values": new[common:]})
+        changed += len(new) - common
+
+    if changed > len(new) * max_patched_fraction:
+        return new
+    return {"length": len(new), "ranges": ranges}
+
+
+def _add_range(ranges, old, new, start, end):
+    """ Appends the range of changed blocks [start, end) to ranges, trimmed to
+    the first and last changed element.  Returns the number of elements sent """
+    while old[start] == new[start]:
+        start += 1
+    while old[end - 1] == new[end - 1]:
+        end -= 1
+    ranges.append({"start": start, "values": new[start:end]})
+    return end - start
+
+
+def _apply_list(old, patch):
+    new = old[:patch["length"]]
+    if len(new) < patch["length"]:
+        new.extend([None] * (patch["length"] - len(new)))
+    for patched_range in patch["ranges"]:
+        start = patched_range["start"]
+        values = patched_range["values"]
+        new[start:start + len(values)] = values
+    return new
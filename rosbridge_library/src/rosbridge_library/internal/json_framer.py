@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Splits a stream of text into the top-level JSON objects it contains.
+
+The stream is scanned once, keeping track of the brace depth and of whether
+the scan is inside a string, so that braces in strings are not counted.  Data
+outside of top-level objects is discarded.
+"""
+
+import re
+
+# Characters that change the state of the scan, outside and inside strings
+_structure = re.compile(r'[{}"]')
+_string_end = re.compile(r'["\\]')
+
+
+class JsonFramer(object):
+    """ Incrementally extracts complete top-level JSON objects from chunks of
+    a text stream """
+
+    def __init__(self):
+        self.buffer = ""
+        self.reset()
+
+    def reset(self):
+        """ Discards all buffered data """
+        self.buffer = ""
+        # Position up to which the buffer has been scanned
+        self.position = 0
+        # Brace depth at position, 0 if not inside an object
+        self.depth = 0
+        self.in_string = False
+        # Characters discarded since the last call of feed
+        self.discarded = 0
+
+    def pending(self):
+        """ Returns the number of buffered characters that are not part of a
+        complete object yet """
+        return len(self.buffer)
+
+    def feed(self, data):
+        """ Adds data to the stream and returns the list of top-level objects
+        completed by it, as strings.  Text between objects is discarded and
+        counted in self.discarded. """
+        self.discarded = 0
+        self.buffer = self.buffer + data if self.buffer else data
+        buffer = self.buffer
+        position = self.position
+        depth = self.depth
+        in_string = self.in_string
+        start = 0
+        objects = []
+
+        if depth == 0:
+            position = self._skip_to_object(buffer, position)
+            start = position
+
+        while position < len(buffer):
+            if in_string:
+                match = _string_end.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    break
+                if match.group() == "\\":
+                    # Skip the escaped character, it may not have arrived yet
+                    if match.end() == len(buffer):
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                else:
+                    in_string = False
+                    position = match.end()
+                continue
+
+            match = _structure.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            position = match.end()
+            character = match.group()
+            if character == '"':
+                in_string = True
+            elif character == "{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    objects.append(buffer[start:position])
+                    position = self._skip_to_object(buffer, position)
+                    start = position
+
+        # Only keep the unfinished object
+        self.buffer = buffer[start:]
+        self.position = position - start
+        self.depth = depth
+        self.in_string = in_string
+        return objects
+
+    def _skip_to_object(self, buffer, position):
+        """ Returns the position of the next "{" in buffer, discarding anything
+        before it """
+        start = buffer.find("{", position)
+        if start == -1:
+            start = len(buffer)
+        self.discarded += len(buffer[position:start].strip())
+        return start
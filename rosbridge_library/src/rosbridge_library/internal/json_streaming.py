@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Writes ROS messages as JSON directly from the message objects, instead of
+first building the dictionary of values with message_conversion.extract_values
+and then serializing it.
+
+The JSON is written through a write function, so it can be collected into
+fixed-size chunks with ChunkedOutput and sent as fragments without ever
+holding the dictionary of values or the complete string in memory.  The
+result decodes to the same values as extract_values.
+"""
+
+from base64 import standard_b64encode
+from functools import partial
+from math import isinf, isnan
+
+from rosbridge_library.internal import ros_loader, message_conversion
+from rosbridge_library.internal.message_conversion import (ros_binary_types, ros_binary_types_list_braces,
+                                                           ros_time_types, ros_primitive_types, ros_float_types,
+                                                           ros_type_field_name, list_braces, python2)
+from rosbridge_library.util import json
+
+default_chunk_size = 65536
+
+# Writers keyed by rostype, and field plans keyed by message class.  Both are
+# built lazily and reused for every later message.
+_writers = {}
+_object_plans = {}
+
+
+class StreamedMessage(object):
+    """ A ROS message that is converted to JSON when it is serialized.
+
+    Used in place of the dictionary of values returned by extract_values.
+    Code that needs the dictionary can still get it from extract_values().
+    """
+
+    __slots__ = ["inst", "options", "_values"]
+
+    def __init__(self, inst, options=None):
+        self.inst = inst
+        self.options = options
+        self._values = None
+
+    def extract_values(self):
+        """ Returns the dictionary of values of the message, converting it
+        on first use """
+        if self._values is None:
+            self._values = message_conversion.extract_values(self.inst, self.options)
+        return self._values
+
+    def write(self, write):
+        """ Writes the message as JSON by calling write with pieces of it """
+        _get_writer(self.inst._type)(self.inst, write, self.options)
+
+
+class ChunkedOutput(object):
+    """ Collects written strings and passes them on to sink in chunks of
+    exactly chunk_size characters.  Only the last chunk, emitted by close, may
+    be shorter. """
+
+    def __init__(self, sink, chunk_size=default_chunk_size):
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            data = "".join(self.parts)
+            end = len(data) - len(data) % self.chunk_size
+            for start in range(0, end, self.chunk_size):
+                self.sink(data[start:start + self.chunk_size])
+            self.parts = [data[end:]] if end < len(data) else []
+            self.size = len(data) - end
+
+    def close(self):
+        if self.size > 0:
+            self.sink("".join(self.parts))
+        self.parts = []
+        self.size = 0
+
+
+def is_supported():
+    """ Returns True if the configured binary encoder produces JSON
+    strings, which the writers assume """
+    return message_conversion.get_encoder() is standard_b64encode
+
+
+def is_streamed(msg):
+    """ Returns True if the outgoing message dictionary msg contains a
+    StreamedMessage """
+    return any(isinstance(value, StreamedMessage) for value in msg.values())
+
+
+def extract_values(msg):
+    """ Returns a copy of the outgoing message dictionary msg with all
+    StreamedMessages replaced by their dictionary of values """
+    return dict((key, value.extract_values() if isinstance(value, StreamedMessage) else value)
+                for key, value in msg.items())
+
+
+def write_message(msg, write):
+    """ Writes the outgoing message dictionary msg as JSON, writing the
+    StreamedMessages it contains directly from their ROS messages """
+    write("{")
+    separator = ""
+    for key, value in msg.items():
+        write(separator)
+        write(json.dumps(key))
+        write(": ")
+        if isinstance(value, StreamedMessage):
+            value.write(write)
+        else:
+            write(json.dumps(value))
+        separator = ", "
+    write("}")
+
+
+def dumps(msg):
+    """ Serializes the outgoing message dictionary msg to a JSON string """
+    parts = []
+    write_message(msg, parts.append)
+    return "".join(parts)
+
+
+def dump_chunks(msg, chunk_size=default_chunk_size):
+    """ Serializes the outgoing message dictionary msg to a list of JSON
+    string chunks of chunk_size characters each """
+    chunks = []
+    output = ChunkedOutput(chunks.append, chunk_size)
+    write_message(msg, output.write)
+    output.close()
+    return chunks
+
+
+def _get_writer(rostype):
+    """ Returns the cached writer for the given rostype, building it on first
+    use.  A writer is a function (inst, write, options) -> None. """
+    writer = _writers.get(rostype)
+    if writer is None:
+        writer = _build_writer(rostype)
+        _writers[rostype] = writer
+    return writer
+
+
+def _build_writer(rostype):
+    # The type dispatch mirrors message_conversion._build_from_converter
+    for binary_type, expression in ros_binary_types_list_braces:
+        if expression.sub(binary_type, rostype) in ros_binary_types:
+            return _write_binary
+    if rostype in ros_time_types:
+        return _write_time
+    if rostype in ros_float_types:
+        return _write_float
+    if rostype == "bool":
+        return _write_bool
+    if rostype == "string":
+        return _write_primitive
+    if rostype in ros_primitive_types:
+        return _write_int
+    if list_braces.search(rostype) is not None:
+        return _build_list_writer(list_braces.sub("", rostype))
+    return partial(_write_object, rostype=rostype)
+
+
+def _write_binary(inst, write, options=None):
+    encoded = standard_b64encode(inst)
+    write('"')
+    write(encoded if python2 else encoded.decode('ascii'))
+    write('"')
+
+
+def _write_time(inst, write, options=None):
+    write('{"secs": %d, "nsecs": %d}' % (inst.secs, inst.nsecs))
+
+
+def _write_float(inst, write, options=None):
+    # JSON does not support Inf and NaN, they are written as null
+    write("null" if isnan(inst) or isinf(inst) else repr(float(inst)))
+
+
+def _write_bool(inst, write, options=None):
+    write("true" if inst else "false")
+
+
+def _write_int(inst, write, options=None):
+    write("%d" % inst)
+
+
+def _write_primitive(inst, write, options=None):
+    write(json.dumps(inst))
+
+
+def _build_list_writer(rostype):
+    """ Returns a writer for lists whose elements are of type rostype """
+    if rostype in ros_float_types:
+        write_list = _write_float_list
+    elif rostype in ros_primitive_types:
+        def write_list(inst, write, options=None):
+            write(json.dumps(list(inst)))
+    else:
+        element_writer = _get_writer(rostype)
+
+        def write_list(inst, write, options=None):
+            write("[")
+            separator = ""
+            for element in inst:
+                write(separator)
+                element_writer(element, write, options)
+                separator = ", "
+            write("]")
+    return write_list
+
+
+def _write_float_list(inst, write, options=None):
+    # Formatting the floats directly is faster than checking each of them for
+    # Inf and NaN first.  Their representations are the only ones with an "n".
+    try:
+        values = ", ".join(map(float.__repr__, inst))
+    except TypeError:
+        # Elements that are not python floats
+        values = None
+    if values is None or "n" in values:
+        write(json.dumps(message_conversion._from_float_list_inst(inst)))
+    else:
+        write("[")
+        write(values)
+        write("]")
+
+
+def _write_object(inst, write, options=None, rostype=None):
+    plan = _object_plans.get(type(inst))
+    if plan is None:
+        plan = _build_object_plan(type(inst))
+    field_prefixes, field_writers, get_fields = plan
+    if options and options.get("add_ros_type_to_inst", False):
+        write('{"%s": %s' % (ros_type_field_name, json.dumps(rostype)))
+        if field_prefixes:
+            write(", ")
+    else:
+        write("{")
+    for field_prefix, field_writer, field_inst in zip(field_prefixes, field_writers, get_fields(inst)):
+        write(field_prefix)
+        field_writer(field_inst, write, options)
+    write("}")
+
+
+def _build_object_plan(cls):
+    """ Builds and caches the field plan for a message class: the JSON written
+    before each field, the writer of each field and the field getter of
+    message_conversion """
+    field_names, _, get_fields = message_conversion._from_object_plans.get(cls) or \
+        message_conversion._build_from_object_plan(cls)
+    field_prefixes = tuple(("" if i == 0 else ", ") + json.dumps(field_name) + ": "
+                           for i, field_name in enumerate(field_names))
+    field_writers = tuple(_get_writer(field_rostype) for field_rostype in cls._slot_types)
+    plan = (field_prefixes, field_writers, get_fields)
+    _object_plans[cls] = plan
+    return plan
@@ -35,15 +35,22 @@ from __future__ import print_function
 import roslib
 import rospy
 
-from rosbridge_library.internal import ros_loader
+from rosbridge_library.internal import ros_loader, binary_attachments, serializers
 
-import math
 import re
 import string
+from functools import partial
+from math import isinf, isnan
+from operator import attrgetter
 from base64 import standard_b64encode, standard_b64decode
 
 from rosbridge_library.util import string_types, bson
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import sys
 if sys.version_info >= (3, 0):
     type_map = {
@@ -78,6 +85,7 @@ ros_primitive_types = ["bool", "byte", "char", "int8", "uint8", "int16",
                        "uint16", "int32", "uint32", "int64", "uint64",
                        "float32", "float64", "string"]
 ros_header_types = ["Header", "std_msgs/Header", "roslib/Header"]
+ros_float_types = ["float32", "float64"]
 ros_binary_types = ["uint8[]", "char[]"]
 list_braces = re.compile(r'\[[^\]]*\]')
 ros_binary_types_list_braces = [("uint8[]", re.compile(r'uint8\[[^\]]*\]')),
@@ -87,6 +95,32 @@ binary_encoder = None
 
 ros_type_field_name = "@rostype"
 
+# float32[]/float64[] arrays with at least this many elements are sanitized
+# with numpy (if available).  Below that the per-element loop is faster.
+numpy_min_array_length = 256
+
+# Outbound converters keyed by rostype, and field-accessor plans keyed by
+# message class.  Both are built lazily and reused for every later message.
+_from_converters = {}
+_from_object_plans = {}
+
+# Outbound converters for a subset of fields, keyed by message class and
+# field paths
+_from_projections = {}
+
+# Inbound decoders keyed by rostype, field decoder plans keyed by message
+# class and the message classes used to instantiate nested messages.
+_to_decoders = {}
+_to_object_plans = {}
+_to_message_classes = {}
+
+# For each primitive rostype, the python types that are accepted as is and
+# the string types that are accepted and re-encoded
+_to_primitive_types = dict(
+    (rostype, (frozenset(t for t in primitive_types if rostype in type_map[t.__name__]),
+               frozenset(t for t in string_types if rostype in type_map.get(t.__name__, []))))
+    for rostype in ros_primitive_types)
+
 def get_encoder():
     global binary_encoder
     if binary_encoder is None:
@@ -102,6 +136,13 @@ def get_encoder():
             exit(0)
     return binary_encoder
 
+
+def encodes_bson_binary():
+    """ Returns True if binary fields are converted to bson.Binary values,
+    which only BSON can serialize.  Otherwise converted messages never
+    contain them. """
+    return get_encoder() is bson.Binary
+
 class InvalidMessageException(Exception):
     def __init__(self, inst):
         Exception.__init__(self, "Unable to extract message values from %s instance" % type(inst).__name__)
@@ -124,9 +165,88 @@ def extract_values(inst, options=None):
     rostype = getattr(inst, "_type", None)
     if rostype is None:
         raise InvalidMessageException(inst=inst)
+    if options and options.get("fields"):
+        return get_projection(type(inst), options["fields"])(inst, options)
     return _from_inst(inst, rostype, options=options)
 
 
+def get_projection(cls, fields):
+    """ Returns the cached converter that only extracts the given fields of
+    instances of the message class cls, building it on first use.
+
+    Keyword arguments:
+    cls    -- the message class
+    fields -- a sequence of field paths such as "pose.pose.position".  A path
+    selects the whole subtree of its last field.  Paths into arrays of
+    messages apply to every element
+
+    Throws:
+    NonexistentFieldException -- if a path does not exist in cls
+
+    """
+    fields = tuple(sorted(set(fields)))
+    projection = _from_projections.get((cls, fields))
+    if projection is None:
+        tree = {}
+        for path in fields:
+            node = tree
+            names = path.split(".")
+            for name in names[:-1]:
+                if node.get(name, {}) is None:
+                    # A shorter path already selects the whole subtree
+                    break
+                node = node.setdefault(name, {})
+            else:
+                node[names[-1]] = None
+        projection = _build_from_projection(cls, cls._type, tree, [])
+        _from_projections[(cls, fields)] = projection
+    return projection
+
+
+def _build_from_projection(cls, roottype, tree, stack):
+    """ Returns a converter (inst, options) -> dict for the fields of message
+    class cls selected by tree.  tree maps field names to either None, to
+    select the whole field, or to the tree of the selected sub-fields """
+    slot_types = dict(zip(cls.__slots__, cls._slot_types))
+    fields = []
+    for field_name, subtree in sorted(tree.items()):
+        field_stack = stack + [field_name]
+        if field_name not in slot_types:
+            raise NonexistentFieldException(roottype, field_stack)
+        field_rostype = slot_types[field_name]
+        if subtree is None:
+            fields.append((field_name, _get_from_converter(field_rostype)))
+            continue
+
+        # Only messages and arrays of messages have sub-fields
+        element_rostype = list_braces.sub("", field_rostype)
+        if element_rostype in ros_primitive_types or element_rostype in ros_time_types:
+            raise NonexistentFieldException(roottype, field_stack + [sorted(subtree)[0]])
+        if element_rostype in ros_header_types:
+            element_rostype = "std_msgs/Header"
+        element_projection = _build_from_projection(ros_loader.get_message_class(element_rostype),
+                                                    roottype, subtree, field_stack)
+        if list_braces.search(field_rostype) is None:
+            fields.append((field_name, element_projection))
+        else:
+            fields.append((field_name, partial(_from_projected_list_inst, element_projection=element_projection)))
+
+    rostype = cls._type
+
+    def convert(inst, options=None):
+        msg = {}
+        if options and options.get("add_ros_type_to_inst", False):
+            msg[ros_type_field_name] = rostype
+        for field_name, field_converter in fields:
+            msg[field_name] = field_converter(getattr(inst, field_name), options)
+        return msg
+    return convert
+
+
+def _from_projected_list_inst(inst, options=None, element_projection=None):
+    return [element_projection(x, options) for x in inst]
+
+
 def populate_instance(msg, inst):
     """ Returns an instance of the provided class, with its fields populated
     according to the values in msg """
@@ -134,84 +254,224 @@ def populate_instance(msg, inst):
 
 
 def _from_inst(inst, rostype, options=None):
+    return _get_from_converter(rostype)(inst, options)
+
+
+def _get_from_converter(rostype):
+    """ Returns the cached converter for the given rostype, building it on
+    first use.
+
+    A converter is a function (inst, options) -> JSON-compatible value.  The
+    type dispatch (binary, time, primitive, list or message) is resolved once
+    per rostype instead of once per field of every message. """
+    converter = _from_converters.get(rostype)
+    if converter is None:
+        # Building twice under a race is harmless, both results are equivalent
+        converter = _build_from_converter(rostype)
+        _from_converters[rostype] = converter
+    return converter
+
+
+def _build_from_converter(rostype):
     # Special case for uint8[], we encode the string
     for binary_type, expression in ros_binary_types_list_braces:
         if expression.sub(binary_type, rostype) in ros_binary_types:
-            encoded = get_encoder()(inst)
-            return encoded if python2 else encoded.decode('ascii')
+            return _from_binary_inst
 
     # Check for time or duration
     if rostype in ros_time_types:
-        return {"secs": inst.secs, "nsecs": inst.nsecs}
+        return _from_time_inst
 
     # Check for primitive types
+    if rostype in ros_float_types:
+        return _from_float_inst
     if rostype in ros_primitive_types:
-        #JSON does not support Inf and NaN. They are mapped to None and encoded as null.
-        if rostype in ["float32", "float64"]:
-            if math.isnan(inst) or math.isinf(inst):
-                return None
-        return inst
+        return _from_primitive_inst
 
     # Check if it's a list or tuple
-    if type(inst) in list_types:
-        return _from_list_inst(inst, rostype, options=options)
+    if list_braces.search(rostype) is not None:
+        return _build_from_list_converter(list_braces.sub("", rostype))
 
     # Assume it's otherwise a full ros msg object
-    return _from_object_inst(inst, rostype, options=options)
+    return partial(_from_object_inst, rostype=rostype)
 
 
-def _from_list_inst(inst, rostype, options=None):
-    # Can duck out early if the list is empty
-    if len(inst) == 0:
-        return []
+def _from_binary_inst(inst, options=None):
+    # Binary fields are left to serializers with native binary support, large
+    # ones also if the client accepts binary attachments
+    if options:
+        if options.get("native_binary", False):
+            return binary_attachments.Attachment(inst)
+        if options.get("binary_attachments", False) and len(inst) >= binary_attachments.min_attachment_size:
+            return binary_attachments.Attachment(inst)
+    encoded = get_encoder()(inst)
+    return encoded if python2 else encoded.decode('ascii')
 
-    # Remove the list indicators from the rostype
-    rostype = list_braces.sub("", rostype)
 
+def _from_time_inst(inst, options=None):
+    return {"secs": inst.secs, "nsecs": inst.nsecs}
+
+
+def _from_float_inst(inst, options=None):
+    #JSON does not support Inf and NaN. They are mapped to None and encoded as null.
+    if isnan(inst) or isinf(inst):
+        return None
+    return inst
+
+
+def _from_primitive_inst(inst, options=None):
+    return inst
+
+
+def _build_from_list_converter(rostype):
+    """ Returns a converter for lists whose elements are of type rostype """
     # Shortcut for primitives
-    if rostype in ros_primitive_types and not rostype in ["float32", "float64"]:
-        return list(inst)
+    if rostype in ros_float_types:
+        def convert(inst, options=None):
+            if options and options.get("typed_arrays", False):
+                return serializers.TypedArray(rostype, inst)
+            return _from_float_list_inst(inst)
+    elif rostype in serializers.typed_array_types or rostype == "byte":
+        array_type = "int8" if rostype == "byte" else rostype
+
+        def convert(inst, options=None):
+            if options and options.get("typed_arrays", False):
+                return serializers.TypedArray(array_type, inst)
+            return list(inst)
+    elif rostype in ros_primitive_types:
+        def convert(inst, options=None):
+            return list(inst)
+    else:
+        element_converter = _get_from_converter(rostype)
 
-    # Call to _to_inst for every element of the list
-    return [_from_inst(x, rostype, options=options) for x in inst]
+        def convert(inst, options=None):
+            return [element_converter(x, options) for x in inst]
+    return convert
 
 
-def _from_object_inst(inst, rostype, options=None):
+def _from_float_list_inst(inst, options=None):
+    #JSON does not support Inf and NaN. They are mapped to None and encoded as null.
+    if numpy is not None and len(inst) >= numpy_min_array_length:
+        return _from_float_array(inst)
+    return [None if isnan(x) or isinf(x) else x for x in inst]
+
+
+def _from_float_array(inst):
+    """ Vectorized version of _from_float_list_inst using numpy """
+    values = numpy.asarray(inst, dtype=numpy.float64)
+    finite = numpy.isfinite(values)
+    if finite.all():
+        return values.tolist() if isinstance(inst, numpy.ndarray) else list(inst)
+    values = values.astype(object)
+    values[~finite] = None
+    return values.tolist()
+
+
+def _from_object_inst(inst, options=None, rostype=None):
     # Create an empty dict then populate with values from the inst
     msg = {}
-    options = options if options else {}
-    add_ros_type_to_inst = bool(options.get("add_ros_type_to_inst", False))
-    if add_ros_type_to_inst:
+    if options and options.get("add_ros_type_to_inst", False):
         msg[ros_type_field_name] = rostype
-    for field_name, field_rostype in zip(inst.__slots__, inst._slot_types):
-        field_inst = getattr(inst, field_name)
-        msg[field_name] = _from_inst(field_inst, field_rostype, options=options)
+    plan = _from_object_plans.get(type(inst))
+    if plan is None:
+        plan = _build_from_object_plan(type(inst))
+    field_names, field_converters, get_fields = plan
+    for field_name, field_converter, field_inst in zip(field_names, field_converters, get_fields(inst)):
+        if field_converter is None:
+            msg[field_name] = field_inst
+        else:
+            msg[field_name] = field_converter(field_inst, options)
     return msg
 
 
+def _build_from_object_plan(cls):
+    """ Builds and caches the field-accessor plan for a message class.
+
+    The plan holds the field names, the converter for each field (None for
+    primitives that are passed through unchanged) and a getter returning all
+    field values of an instance in slot order """
+    field_names = tuple(cls.__slots__)
+    field_converters = []
+    for field_rostype in cls._slot_types:
+        if field_rostype in ros_primitive_types and field_rostype not in ros_float_types:
+            field_converters.append(None)
+        else:
+            field_converters.append(_get_from_converter(field_rostype))
+
+    if len(field_names) == 0:
+        get_fields = lambda inst: ()
+    elif len(field_names) == 1:
+        field_name = field_names[0]
+        get_fields = lambda inst: (getattr(inst, field_name),)
+    else:
+        get_fields = attrgetter(*field_names)
+
+    plan = (field_names, tuple(field_converters), get_fields)
+    _from_object_plans[cls] = plan
+    return plan
+
+
 def _to_inst(msg, rostype, roottype, inst=None, stack=[]):
+    return _get_to_decoder(rostype)(msg, roottype, inst, stack)
+
+
+def _get_to_decoder(rostype):
+    """ Returns the cached decoder for the given rostype, building it on first
+    use.
+
+    A decoder is a function (msg, roottype, inst, stack) -> value that
+    typechecks the JSON value msg and returns the corresponding ROS value,
+    populating inst if one is provided. """
+    decoder = _to_decoders.get(rostype)
+    if decoder is None:
+        # Building twice under a race is harmless, both results are equivalent
+        decoder = _build_to_decoder(rostype)
+        _to_decoders[rostype] = decoder
+    return decoder
+
+
+def _build_to_decoder(rostype):
     # Check if it's uint8[], and if it's a string, try to b64decode
     for binary_type, expression in ros_binary_types_list_braces:
         if expression.sub(binary_type, rostype) in ros_binary_types:
-            return _to_binary_inst(msg)
+            def decode(msg, roottype, inst=None, stack=[]):
+                return _to_binary_inst(msg)
+            return decode
 
     # Check the type for time or rostime
     if rostype in ros_time_types:
-        return _to_time_inst(msg, rostype, inst)
+        def decode(msg, roottype, inst=None, stack=[]):
+            return _to_time_inst(msg, rostype, inst)
+        return decode
 
     # Check to see whether this is a primitive type
     if rostype in ros_primitive_types:
-        return _to_primitive_inst(msg, rostype, roottype, stack)
+        def decode(msg, roottype, inst=None, stack=[]):
+            return _to_primitive_inst(msg, rostype, roottype, stack)
+        return decode
 
     # Check whether we're dealing with a list type
-    if inst is not None and type(inst) in list_types:
-        return _to_list_inst(msg, rostype, roottype, inst, stack)
+    if list_braces.search(rostype) is not None:
+        return _build_to_list_decoder(rostype)
 
     # Otherwise, the type has to be a full ros msg type, so msg must be a dict
-    if inst is None:
-        inst = ros_loader.get_message_instance(rostype)
+    is_header = rostype in ros_header_types
+
+    def decode(msg, roottype, inst=None, stack=[]):
+        if inst is None:
+            inst = _get_to_message_class(rostype)()
+        return _to_object_inst(msg, rostype, roottype, inst, stack, is_header)
+    return decode
 
-    return _to_object_inst(msg, rostype, roottype, inst, stack)
+
+def _get_to_message_class(rostype):
+    """ Returns the message class for rostype without going through the locked
+    ros_loader cache once it has been loaded """
+    cls = _to_message_classes.get(rostype)
+    if cls is None:
+        cls = ros_loader.get_message_class(rostype)
+        _to_message_classes[rostype] = cls
+    return cls
 
 
 def _to_binary_inst(msg):
@@ -254,61 +514,84 @@ def _to_time_inst(msg, rostype, inst=None):
 def _to_primitive_inst(msg, rostype, roottype, stack):
     # Typecheck the msg
     msgtype = type(msg)
-    if msgtype in primitive_types and rostype in type_map[msgtype.__name__]:
+    accepted_types, accepted_string_types = _to_primitive_types[rostype]
+    if msgtype in accepted_types:
         return msg
-    elif msgtype in string_types and rostype in type_map[msgtype.__name__]:
+    elif msgtype in accepted_string_types:
         return msg.encode("utf-8", "ignore") if python2 else msg
     raise FieldTypeMismatchException(roottype, stack, rostype, msgtype)
 
 
-def _to_list_inst(msg, rostype, roottype, inst, stack):
-    # Typecheck the msg
-    if type(msg) not in list_types:
-        raise FieldTypeMismatchException(roottype, stack, rostype, type(msg))
+def _build_to_list_decoder(rostype):
+    """ Returns a decoder for the list type rostype """
+    # Remove the list indicators from the rostype
+    element_rostype = list_braces.sub("", rostype)
+    element_decoder = _get_to_decoder(element_rostype)
 
-    # Can duck out early if the list is empty
-    if len(msg) == 0:
-        return []
+    # Python types that elements of a primitive list can have to be copied
+    # across without going through the element decoder
+    bulk_types = None
+    if element_rostype in ros_primitive_types:
+        accepted_types, accepted_string_types = _to_primitive_types[element_rostype]
+        bulk_types = accepted_types if python2 else accepted_types | accepted_string_types
 
-    # Remove the list indicators from the rostype
-    rostype = list_braces.sub("", rostype)
+    def decode(msg, roottype, inst=None, stack=[]):
+        # Typecheck the msg
+        if type(msg) not in list_types:
+            raise FieldTypeMismatchException(roottype, stack, rostype, type(msg))
+
+        # Typecheck all elements of a homogeneous primitive list in one pass
+        if bulk_types is not None and set(map(type, msg)) <= bulk_types:
+            return list(msg)
 
-    # Call to _to_inst for every element of the list
-    return [_to_inst(x, rostype, roottype, None, stack) for x in msg]
+        # Call the element decoder for every element of the list.  This also
+        # raises the appropriate exception for the first mismatching element
+        return [element_decoder(x, roottype, None, stack) for x in msg]
+    return decode
 
 
-def _to_object_inst(msg, rostype, roottype, inst, stack):
+def _to_object_inst(msg, rostype, roottype, inst, stack, is_header=False):
     # Typecheck the msg
     if type(msg) is not dict:
         raise FieldTypeMismatchException(roottype, stack, rostype, type(msg))
 
     # Substitute the correct time if we're an std_msgs/Header
     try:
-        if rostype in ros_header_types:
+        if is_header:
             inst.stamp = rospy.get_rostime()
     except rospy.exceptions.ROSInitException as e:
         rospy.logdebug("Not substituting the correct header time: %s" % e)
 
-    inst_fields = dict(zip(inst.__slots__, inst._slot_types))
+    field_decoders = _to_object_plans.get(type(inst))
+    if field_decoders is None:
+        field_decoders = _build_to_object_plan(type(inst))
 
     for field_name in msg:
-        # Add this field to the field stack
-        field_stack = stack + [field_name]
-
         # If field_name is ROS type, ignore it
-        if field_name in (ros_type_field_name,):
+        if field_name == ros_type_field_name:
             continue
 
+        # Add this field to the field stack
+        field_stack = stack + [field_name]
+
         # Raise an exception if the msg contains a bad field
-        if not field_name in inst_fields:
+        field_decoder = field_decoders.get(field_name)
+        if field_decoder is None:
             raise NonexistentFieldException(roottype, field_stack)
 
-        field_rostype = inst_fields[field_name]
         field_inst = getattr(inst, field_name)
 
-        field_value = _to_inst(msg[field_name], field_rostype,
-                    roottype, field_inst, field_stack)
+        field_value = field_decoder(msg[field_name], roottype, field_inst, field_stack)
 
         setattr(inst, field_name, field_value)
 
     return inst
+
+
+def _build_to_object_plan(cls):
+    """ Builds and caches the field decoders of a message class, keyed by
+    field name """
+    plan = dict((field_name, _get_to_decoder(field_rostype))
+                for field_name, field_rostype in zip(cls.__slots__, cls._slot_types))
+    _to_object_plans[cls] = plan
+    return plan
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from threading import Thread, Condition
+from time import time
+
+from rosbridge_library.internal.send_queue import SendQueue
+
+
+class OutgoingQueue(Thread):
+    """ Sends the outgoing messages of a client from its own thread, with at
+    least interval seconds between two messages.
+
+    Threads producing messages only append them to the queue, so a client
+    that asks for a delay between messages, or a transport that blocks while
+    the client reads, never makes them wait. """
+
+    def __init__(self, send, interval=0, queue=None, log=None, is_closed=None):
+        """ Keyword arguments:
+        send      -- the function that sends a single message to the client.
+        Messages pushed with a topic are passed on with it, as send(message,
+        topic)
+        interval  -- the minimum time in seconds between two messages
+        queue     -- (optional) the SendQueue holding the messages.  By
+        default the queue is unbounded and takes messages of any type
+        log       -- (optional) the function messages that could not be sent
+        are logged with, as log(level, message), like Protocol.log
+        is_closed -- (optional) a function telling whether an exception
+        raised by send means that the client is gone.  The queue then stops
+
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.send = send
+        self.interval = interval
+        self.queue = queue if queue is not None else SendQueue(size=lambda message: 0)
+        self.log = log
+        self.is_closed = is_closed
+        self.c = Condition()
+        self.alive = True
+        self.last_send = 0
+        self.start()
+
+    def push(self, message, topic=None):
+        """ Queues a message to be sent """
+        with self.c:
+            self.queue.push(message, topic)
+            self.c.notify()
+
+    def set_interval(self, interval):
+        with self.c:
+            self.interval = interval
+            self.c.notify()
+
+    def is_empty(self):
+        with self.c:
+            return len(self.queue) == 0
+
+    def time_remaining(self):
+        return max((self.last_send + self.interval) - time(), 0)
+
+    def finish(self):
+        """ Stops the thread, dropping the messages that were not sent yet """
+        with self.c:
+            self.alive = False
+            self.queue.clear()
+            self.c.notify()
+
+    def run(self):
+        while True:
+            with self.c:
+                while self.alive and (len(self.queue) == 0 or self.time_remaining() > 0):
+                    if len(self.queue) == 0:
+                        self.c.wait()
+                    else:
+                        self.c.wait(self.time_remaining())
+                if not self.alive:
+                    return
+                message, topic = self.queue.pop()
+                self.last_send = time()
+            # Send outside of the lock, so producers are never blocked by the
+            # transport
+            try:
+                if topic is None:
+                    self.send(message)
+                else:
+                    self.send(message, topic)
+            except Exception as exc:
+                if self.is_closed is not None and self.is_closed(exc):
+                    self.finish()
+                    return
+                if self.log is not None:
+                    self.log("error", "Unable to send message to client: %s" % exc)
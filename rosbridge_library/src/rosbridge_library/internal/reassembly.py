@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Reassembles the fragmented messages of one client.
+
+The fragments of a message are put into a list preallocated for all of them,
+and joined once the last one arrived.  Incomplete messages are kept ordered
+by the time their last fragment arrived.  As all of them share the same
+timeout, the ones that timed out are always the oldest, so expiring them
+never looks at the others.
+
+The fragments a client may have waiting are bounded by max_bytes.  When a
+fragment exceeds it, the oldest incomplete messages are dropped to make room,
+and if that is not enough, the message of the fragment itself.
+"""
+
+from collections import OrderedDict
+from time import time
+
+from rosbridge_library.internal.exceptions import InvalidArgumentException
+
+
+# Each preallocated fragment slot counts as this many bytes, so a client
+# cannot make the server allocate lists for huge announced totals
+slot_bytes = 8
+
+
+class PartialMessage(object):
+    """ The fragments of a message received so far """
+
+    __slots__ = ("parts", "received", "size", "last_append")
+
+    def __init__(self, total):
+        self.parts = [None] * total
+        self.received = 0
+        self.size = total * slot_bytes
+        self.last_append = 0
+
+    def add(self, num, data):
+        """ Stores fragment num, returns the number of bytes added """
+        if self.parts[num] is not None:
+            raise InvalidArgumentException("Fragment %d was already received" % num)
+        self.parts[num] = data
+        self.received += 1
+        self.size += len(data)
+        return len(data)
+
+    def is_complete(self):
+        return self.received == len(self.parts)
+
+    def join(self):
+        try:
+            return self.parts[0][:0].join(self.parts)
+        except TypeError:
+            raise InvalidArgumentException("Fragments of a message have different types of data")
+
+
+class Reassembler(object):
+    """ Reassembles the fragmented messages of one client """
+
+    def __init__(self, timeout, max_bytes=None, log=None):
+        """ Keyword arguments:
+        timeout   -- seconds after the last fragment of an incomplete message
+        after which it is dropped
+        max_bytes -- the maximum total size of the fragments of incomplete
+        messages, or None
+        log       -- (optional) log(level, message, mid) reports dropped
+        messages
+
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.log = log
+        # message id -> PartialMessage, oldest last_append first
+        self.messages = OrderedDict()
+        self.size = 0
+
+    def add(self, mid, num, total, data, now=None):
+        """ Adds a fragment.  Returns the reassembled message once all of its
+        fragments were received, otherwise None.
+
+        Raises InvalidArgumentException for fragments that do not fit the
+        fragments received before, or that exceed max_bytes on their own.
+
+        """
+        if now is None:
+            now = time()
+        self.expire(now, keep=mid)
+
+        if not isinstance(total, int) or isinstance(total, bool) or total < 1:
+            raise InvalidArgumentException("Invalid number of fragments: %s" % (total,))
+        if not isinstance(num, int) or isinstance(num, bool) or not 0 <= num < total:
+            raise InvalidArgumentException("Invalid fragment number %s of %d fragments" % (num, total))
+
+        message = self.messages.pop(mid, None)
+        if message is None:
+            if self.max_bytes is not None and total * slot_bytes > self.max_bytes:
+                raise InvalidArgumentException("Message of %d fragments exceeds the limit of %d bytes"
+                                               % (total, self.max_bytes))
+            message = PartialMessage(total)
+            self.size += message.size
+        elif len(message.parts) != total:
+            # Keep the message, the fragment is the invalid one
+            self.messages[mid] = message
+            raise InvalidArgumentException("Fragment announces %d fragments, expected %d"
+                                           % (total, len(message.parts)))
+        # Reinserting moves the message behind the others
+        message.last_append = now
+        self.messages[mid] = message
+        self.size += message.add(num, data)
+
+        if message.is_complete():
+            self._remove(mid)
+            return message.join()
+        self._limit(mid)
+        return None
+
+    def expire(self, now=None, keep=None):
+        """ Drops the incomplete messages whose last fragment arrived more
+        than timeout seconds ago, except the message keep """
+        if now is None:
+            now = time()
+        deadline = now - self.timeout
+        kept = None
+        while self.messages:
+            mid, message = next(iter(self.messages.items()))
+            if message.last_append >= deadline:
+                break
+            if mid == keep:
+                # A fragment for it just arrived, it is moved behind the
+                # others right after
+                kept = self.messages.pop(mid)
+                continue
+            self._remove(mid)
+            self._report("Fragmented message timed out after receiving %d of %d fragments"
+                         % (message.received, len(message.parts)), mid)
+        if kept is not None:
+            self.messages[keep] = kept
+
+    def clear(self):
+        self.messages.clear()
+        self.size = 0
+
+    def _limit(self, mid):
+        """ Drops the oldest incomplete messages until max_bytes is met,
+        the message mid last """
+        if self.max_bytes is None:
+            return
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.messages))
+            message = self._remove(oldest)
+            if oldest == mid:
+                raise InvalidArgumentException("Fragmented message exceeds the limit of %d bytes"
+                                               % self.max_bytes)
+            self._report("Dropped fragmented message after receiving %d of %d fragments, "
+                         "the limit of %d bytes was reached"
+                         % (message.received, len(message.parts), self.max_bytes), oldest)
+
+    def _remove(self, mid):
+        message = self.messages.pop(mid)
+        self.size -= message.size
+        return message
+
+    def _report(self, text, mid):
+        if self.log is not None:
+            self.log("warning", text, mid)
+
+    def __len__(self):
+        return len(self.messages)
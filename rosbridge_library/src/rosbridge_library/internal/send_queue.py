@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Bounds the messages waiting to be sent to a client.
+
+A client that reads slower than its subscriptions produce messages would
+otherwise make the server buffer an ever growing backlog for it.  The queue
+limits the number of messages and bytes waiting for a client and decides
+which messages to give up on when a limit is reached:
+
+    drop_oldest      -- drop the messages that have been waiting longest
+    drop_newest      -- drop the message that is being queued
+    latest_per_topic -- replace a queued message of the same topic, so a slow
+                        client always receives the most recent message of
+                        every topic.  Messages without a topic (service
+                        responses, status messages, fragments, ...) and
+                        messages exceeding the limits otherwise are handled
+                        as with drop_oldest
+
+A message is always accepted into an empty queue, so messages larger than
+max_bytes are sent rather than dropped.
+
+A MessageStream, e.g. the fragments of a large message, is queued and
+dropped as a single entry, but its messages are only produced one at a time
+as the queue is drained.  Once its first message has been sent, a stream is
+never dropped, as the client could not use the rest of a message.
+
+Messages that depend on the ones before them, like the patches of a delta
+encoded subscription, are pushed with a Chained marker instead of a topic.
+They are never replaced, and if one of them is dropped, the queued messages
+of its chain up to the next message starting the chain are dropped with it,
+as are the ones pushed afterwards.  The chain is asked to start over, so the
+client's state is left behind until it does, but never wrong.
+"""
+
+from collections import deque
+from threading import Lock
+
+
+policies = ("drop_oldest", "drop_newest", "latest_per_topic")
+
+
+class MessageStream(object):
+    """ A sequence of messages that are produced on demand.
+
+    Subclasses implement next(), and len() as the total size of the messages
+    not produced yet.  count is the number of messages in the stream. """
+
+    count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        raise NotImplementedError
+
+    def done(self):
+        """ Returns True once all messages have been produced """
+        raise NotImplementedError
+
+
+class Chained(object):
+    """ Marks a message that depends on the earlier messages of chain, pushed
+    in place of its topic """
+
+    __slots__ = ["chain", "start"]
+
+    def __init__(self, chain, start=False):
+        """ Keyword arguments:
+        chain -- the object the messages belong to, e.g. a subscription.  Its
+        request_keyframe() is called when a message of the chain was dropped,
+        with the queue's lock released
+        start -- True if the message does not depend on earlier ones
+
+        """
+        self.chain = chain
+        self.start = start
+
+
+class SendQueue(object):
+    """ A thread safe queue of serialized messages bounded by a message and a
+    byte budget, which counts the messages sent and dropped """
+
+    def __init__(self, max_messages=None, max_bytes=None, policy="drop_oldest", size=len):
+        """ Keyword arguments:
+        max_messages -- the maximum number of queued messages, or None
+        max_bytes    -- the maximum total length of queued messages, or None
+        policy       -- one of policies
+        size         -- the function returning the length of a message
+
+        """
+        if policy not in policies:
+            raise ValueError("Unknown send queue policy %s, expected one of %s"
+                             % (policy, ", ".join(policies)))
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size = size
+        self.lock = Lock()
+        # Entries are [message, size, topic] lists, so the latest message of a
+        # topic can be replaced in place
+        self.entries = deque()
+        self.latest = {}
+        self.queued_bytes = 0
+        self.idle = True
+        # The entry of the stream that is partly sent, always the oldest
+        self.streaming = None
+        # Chains that lost a message and wait for a message starting them
+        self.broken = set()
+
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.max_queued = 0
+
+    def push(self, message, topic=None):
+        """ Queues a message, dropping messages according to the policy if
+        the queue is full.
+
+        Keyword arguments:
+        message -- the serialized message
+        topic   -- (optional) the topic of a published message, or the
+        Chained marker of a message depending on earlier ones
+
+        Returns True if the queue was idle, in which case the caller has to
+        make sure the queue is drained with pop().  The queue becomes idle
+        again once pop() returned None.
+
+        """
+        size = self.size(message)
+        broken = []
+        with self.lock:
+            was_idle = self.idle
+            self.idle = False
+            chained = isinstance(topic, Chained)
+
+            if chained and topic.chain in self.broken and not topic.start:
+                # The client misses the message this one depends on
+                self._count_dropped(size)
+                return was_idle
+            elif chained and topic.start:
+                self.broken.discard(topic.chain)
+
+            if (self.policy == "latest_per_topic" and topic is not None and not chained and
+                    topic in self.latest and self.latest[topic] is not self.streaming):
+                entry = self.latest[topic]
+                self._count_dropped(entry[1])
+                self.queued_bytes += size - entry[1]
+                entry[0] = message
+                entry[1] = size
+            elif self.policy == "drop_newest" and self.entries and self._exceeds(1, size):
+                self._count_dropped(size)
+                if chained:
+                    self.broken.add(topic.chain)
+                    broken.append(topic.chain)
+            else:
+                entry = [message, size, topic]
+                self.entries.append(entry)
+                self.queued_bytes += size
+                if topic is not None and not chained and self.policy == "latest_per_topic":
+                    self.latest[topic] = entry
+
+            # The newest message is always kept, and so is a stream that is
+            # partly sent
+            while self._exceeds(0, 0):
+                index = 1 if self.entries[0] is self.streaming else 0
+                if index >= len(self.entries) - 1:
+                    break
+                self._drop(index, broken)
+            self.max_queued = max(self.max_queued, len(self.entries))
+
+        for chain in broken:
+            chain.request_keyframe()
+        return was_idle
+
+    def pop(self):
+        """ Returns the oldest queued (message, topic) pair and counts it as
+        sent, or None if the queue is empty, which makes the queue idle.  Of a
+        MessageStream, the next message is returned. """
+        with self.lock:
+            if not self.entries:
+                self.idle = True
+                return None
+            entry = self.entries[0]
+            if isinstance(entry[0], MessageStream):
+                return self._pop_stream(entry)
+            message, size, topic = self._remove_oldest()
+            self.sent += 1
+            self.sent_bytes += size
+            return message, topic
+
+    def pop_while(self, predicate, limit=None):
+        """ Pops the oldest queued messages for as long as predicate(message)
+        is true, at most limit of them, and returns them as a list.  Does not
+        make the queue idle. """
+        messages = []
+        with self.lock:
+            while (self.entries and not isinstance(self.entries[0][0], MessageStream) and
+                   (limit is None or len(messages) < limit) and predicate(self.entries[0][0])):
+                message, size, topic = self._remove_oldest()
+                self.sent += 1
+                self.sent_bytes += size
+                messages.append(message)
+        return messages
+
+    def clear(self):
+        """ Drops all queued messages """
+        with self.lock:
+            while self.entries:
+                self._count_dropped(self._remove_oldest()[1])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        """ Returns the counters of the queue as a dict """
+        with self.lock:
+            return {"queued": len(self.entries), "queued_bytes": self.queued_bytes,
+                    "max_queued": self.max_queued,
+                    "sent": self.sent, "sent_bytes": self.sent_bytes,
+                    "dropped": self.dropped, "dropped_bytes": self.dropped_bytes}
+
+    def _exceeds(self, extra_messages, extra_bytes):
+        return ((self.max_messages is not None and len(self.entries) + extra_messages > self.max_messages) or
+                (self.max_bytes is not None and self.queued_bytes + extra_bytes > self.max_bytes))
+
+    def _pop_stream(self, entry):
+        stream = entry[0]
+        message = next(stream)
+        remaining = self.size(stream)
+        size = entry[1] - remaining
+        entry[1] = remaining
+        self.queued_bytes -= size
+        if stream.done():
+            self._remove_oldest()
+        else:
+            self.streaming = entry
+        self.sent += 1
+        self.sent_bytes += size
+        return message, entry[2]
+
+    def _remove_oldest(self):
+        return self._remove(0)
+
+    def _remove(self, index):
+        if index == 0:
+            entry = self.entries.popleft()
+        else:
+            entry = self.entries[index]
+            del self.entries[index]
+        if entry is self.streaming:
+            self.streaming = None
+        self.queued_bytes -= entry[1]
+        topic = entry[2]
+        if topic is not None and self.latest.get(topic) is entry:
+            del self.latest[topic]
+        return entry
+
+    def _drop(self, index, broken):
+        """ Drops the entry at index.  Of a chain, the later queued entries
+        depending on it are dropped as well, and if none of them starts the
+        chain over, the chain is appended to broken. """
+        entry = self._remove(index)
+        self._count_dropped(entry[1])
+        marker = entry[2]
+        if not isinstance(marker, Chained):
+            return
+        dependent = []
+        for later in list(self.entries)[index:]:
+            if isinstance(later[2], Chained) and later[2].chain is marker.chain:
+                if later[2].start:
+                    return self._drop_entries(dependent)
+                dependent.append(later)
+        self._drop_entries(dependent)
+        if marker.chain not in self.broken:
+            self.broken.add(marker.chain)
+            broken.append(marker.chain)
+
+    def _drop_entries(self, entries):
+        if not entries:
+            return
+        dropped = set(id(entry) for entry in entries)
+        self.entries = deque(entry for entry in self.entries if id(entry) not in dropped)
+        for entry in entries:
+            self.queued_bytes -= entry[1]
+            self._count_dropped(entry[1])
+
+    def _count_dropped(self, size):
+        self.dropped += 1
+        self.dropped_bytes += size
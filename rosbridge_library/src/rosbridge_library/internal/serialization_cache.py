@@ -0,0 +1,168 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Shares values derived from a converted message, such as its serialized
+form, between all clients that send the same message.
+
+A single converted message dict is handed to every client subscribed to a
+topic with the same conversion options.  Entries are keyed by the identity of
+that dict plus a key describing how the value was derived (topic,
+compression, serialization settings, ...), so each client with identical
+settings reuses the bytes produced for the first one.
+
+Only messages that the subscriber announced with share, because several
+clients take them, are cached.  Their values are dropped as soon as all of
+these clients sent the message, and the cache is bounded both in entries and
+in bytes, so a single client of a large topic never keeps copies around.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class SerializationCache():
+    """ A bounded, thread safe cache of values derived from shared messages.
+
+    Shared messages are kept referenced while they are in the cache, so the
+    id() of a source cannot be reused while its values are alive """
+
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # id(source) -> [source, clients that did not take it yet, keys]
+        self._sources = OrderedDict()
+        # (id(source), key) -> (value, size)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def share(self, source, takers):
+        """ Makes the values derived from source cacheable, until takers
+        clients took it.  Nothing is cached for fewer than two takers.
+
+        Keyword arguments:
+        source -- the converted message handed to the clients
+        takers -- the number of clients the message is handed to
+
+        """
+        if takers < 2:
+            return
+        with self._lock:
+            self._drop(id(source))
+            self._sources[id(source)] = [source, takers, []]
+            while len(self._sources) > self.max_entries:
+                self._drop(next(iter(self._sources)))
+
+    def get(self, source, key):
+        """ Returns the cached value derived from source, or None
+
+        Keyword arguments:
+        source -- the shared message the value was derived from
+        key    -- a hashable describing how the value was derived
+
+        """
+        with self._lock:
+            entry = None
+            if self._shared(source) is not None:
+                entry = self._entries.get((id(source), key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, source, key, value):
+        """ Caches a value derived from a shared source, evicting the least
+        recently added entries if the cache is full """
+        size = value_size(value)
+        with self._lock:
+            shared = self._shared(source)
+            if shared is None or size > self.max_bytes:
+                return
+            cache_key = (id(source), key)
+            self._remove(cache_key)
+            self._entries[cache_key] = (value, size)
+            self.size += size
+            shared[2].append(key)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def taken(self, source):
+        """ Records that a client sent source.  Once all clients it was
+        shared with did, its values are dropped. """
+        with self._lock:
+            shared = self._shared(source)
+            if shared is None:
+                return
+            shared[1] -= 1
+            if shared[1] <= 0:
+                self._drop(id(source))
+
+    def clear(self):
+        with self._lock:
+            self._sources.clear()
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _shared(self, source):
+        shared = self._sources.get(id(source))
+        if shared is None or shared[0] is not source:
+            return None
+        return shared
+
+    def _drop(self, source_id):
+        shared = self._sources.pop(source_id, None)
+        if shared is not None:
+            for key in shared[2]:
+                self._remove((source_id, key))
+
+    def _remove(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+def value_size(value):
+    """ Returns the size of a cached value, a serialized message or a list
+    of serialized chunks """
+    if isinstance(value, (list, tuple)):
+        return sum(len(chunk) for chunk in value)
+    return len(value)
+
+
+cache = SerializationCache()
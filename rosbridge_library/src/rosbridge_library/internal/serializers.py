@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" The wire formats a client can choose for the messages of its connection.
+
+JSON is the default.  CBOR and MessagePack carry binary fields as raw bytes
+and numeric arrays as typed arrays, i.e. the little-endian values packed into
+a byte string, tagged with the element type as in RFC 8746: as CBOR tags, and
+as MessagePack extension types with the same numbers.  They are only
+available if the cbor2 and msgpack packages are installed.
+"""
+
+import struct
+import sys
+
+from rosbridge_library.internal.binary_attachments import Attachment, BinaryFrame
+from rosbridge_library.util import json, bson
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+python2 = sys.version_info < (3, 0)
+
+
+# element rostype -> (struct format character, typed array tag)
+typed_array_types = {
+    "int8": ("b", 72),
+    "int16": ("h", 77),
+    "uint16": ("H", 69),
+    "int32": ("i", 78),
+    "uint32": ("I", 70),
+    "int64": ("q", 79),
+    "uint64": ("Q", 71),
+    "float32": ("f", 85),
+    "float64": ("d", 86),
+}
+typed_array_formats = dict((tag, format) for format, tag in typed_array_types.values())
+
+
+class TypedArray(object):
+    """ Placeholder for a numeric array field that is sent as a typed array """
+
+    __slots__ = ["rostype", "values"]
+
+    def __init__(self, rostype, values):
+        """ Keyword arguments:
+        rostype -- the type of the elements, one of typed_array_types
+        values  -- the sequence of values
+
+        """
+        self.rostype = rostype
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def tag(self):
+        return typed_array_types[self.rostype][1]
+
+    def pack(self):
+        """ Returns the values as little-endian bytes """
+        format = typed_array_types[self.rostype][0]
+        if numpy is not None and isinstance(self.values, numpy.ndarray):
+            return self.values.astype("<" + format).tobytes()
+        return struct.pack("<%d%s" % (len(self.values), format), *self.values)
+
+
+def unpack_typed_array(tag, data):
+    """ Returns the list of values of a typed array, or None if tag is not a
+    typed array tag """
+    format = typed_array_formats.get(tag)
+    if format is None:
+        return None
+    return list(struct.unpack("<%d%s" % (len(data) // struct.calcsize(format), format), data))
+
+
+class Serializer(object):
+    """ Turns dictionaries of values into wire-level messages and back """
+
+    name = None
+    # Whether messages are sent as binary frames
+    binary = False
+    # Whether binary fields can be passed as Attachments, and numeric arrays
+    # as TypedArrays
+    native_binary = False
+    typed_arrays = False
+
+    def dumps(self, msg):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class JsonSerializer(Serializer):
+    name = "json"
+
+    def dumps(self, msg):
+        return json.dumps(msg)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class BsonSerializer(Serializer):
+    name = "bson"
+    binary = True
+
+    def dumps(self, msg):
+        return BinaryFrame(bson.BSON.encode(msg))
+
+    def loads(self, data):
+        return bson.BSON(data).decode()
+
+
+def _cbor_default(encoder, value):
+    if isinstance(value, Attachment):
+        encoder.encode(value.data)
+    elif isinstance(value, TypedArray):
+        encoder.encode(cbor2.CBORTag(value.tag(), value.pack()))
+    else:
+        raise TypeError("Unable to serialize %s to CBOR" % type(value).__name__)
+
+
+def _decode_py2_strings(obj):
+    # Binary data, e.g. bson.binary.Binary, is a subclass of str and kept
+    if type(obj) is str:
+        return obj.decode("utf-8")
+    if isinstance(obj, dict):
+        return dict((_decode_py2_strings(key), _decode_py2_strings(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        # ROS arrays are homogeneous, only lists of strings and messages
+        # need to be copied
+        if len(obj) == 0 or not isinstance(obj[0], (str, dict, list)):
+            return obj
+        return [_decode_py2_strings(value) for value in obj]
+    return obj
+
+
+def _cbor_tag_hook(*args):
+    # The arguments differ between cbor2 versions, one of them is the tag
+    tag = [arg for arg in args if isinstance(arg, cbor2.CBORTag)][0]
+    values = unpack_typed_array(tag.tag, tag.value)
+    return tag if values is None else values
+
+
+class CborSerializer(Serializer):
+    name = "cbor"
+    binary = True
+    native_binary = True
+    typed_arrays = True
+
+    def dumps(self, msg):
+        if python2:
+            # Strings of ROS messages are str on python 2, which cbor2
+            # encodes as byte strings
+            msg = _decode_py2_strings(msg)
+        return BinaryFrame(cbor2.dumps(msg, default=_cbor_default))
+
+    def loads(self, data):
+        return cbor2.loads(data, tag_hook=_cbor_tag_hook)
+
+
+def _msgpack_default(value):
+    if isinstance(value, Attachment):
+        return memoryview(value.data)
+    if isinstance(value, TypedArray):
+        return msgpack.ExtType(value.tag(), value.pack())
+    raise TypeError("Unable to serialize %s to MessagePack" % type(value).__name__)
+
+
+def _msgpack_ext_hook(code, data):
+    values = unpack_typed_array(code, data)
+    return msgpack.ExtType(code, data) if values is None else values
+
+
+class MsgpackSerializer(Serializer):
+    name = "msgpack"
+    binary = True
+    native_binary = True
+    typed_arrays = True
+
+    def dumps(self, msg):
+        if python2:
+            # Strings of ROS messages are str on python 2, which msgpack
+            # only tells apart from binary data if they are unicode
+            msg = _decode_py2_strings(msg)
+        return BinaryFrame(msgpack.packb(msg, default=_msgpack_default, use_bin_type=True))
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, ext_hook=_msgpack_ext_hook)
+
+
+json_serializer = JsonSerializer()
+_serializers = {}
+
+
+def register(serializer):
+    """ Makes a serializer available to clients under its name """
+    _serializers[serializer.name] = serializer
+
+
+def get(name):
+    """ Returns the serializer registered under name, or None """
+    return _serializers.get(name)
+
+
+def names():
+    """ Returns the names of the available serializers """
+    return sorted(_serializers.keys())
+
+
+register(json_serializer)
+register(BsonSerializer())
+if cbor2 is not None:
+    register(CborSerializer())
+if msgpack is not None:
+    register(MsgpackSerializer())
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+""" Instrumentation of the protocol: per client, the number of messages of
+every op and how long handling them took, how long serializing,
+fragmenting and passing messages to the transport took, the messages and
+bytes in and out, and the state of the client's queues.
+
+snapshot() returns the statistics of all clients as a dictionary, which
+StatsPublisher publishes as JSON on a topic.  prometheus_text() returns the
+totals over all clients, including the ones that have disconnected, in the
+Prometheus text format.
+"""
+
+import time
+import weakref
+from bisect import bisect_left
+from threading import Lock
+
+import rospy
+
+from rosbridge_library.util import json
+
+
+# Upper bounds of the buckets of the latency histograms, in seconds
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# The steps of sending a message that are timed
+stages = ("serialize", "fragment", "outgoing")
+
+# The counters of SendQueue.stats() that are totals rather than gauges
+queue_counters = ("sent", "sent_bytes", "dropped", "dropped_bytes")
+
+
+class Histogram(object):
+    """ Counts observed durations in the latency buckets """
+
+    __slots__ = ["counts", "count", "sum"]
+
+    def __init__(self):
+        # The last bucket counts everything above the largest bound
+        self.counts = [0] * (len(latency_buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(latency_buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "buckets": list(self.counts)}
+
+
+class Counters(object):
+    """ The counters and histograms of one client, or of several clients
+    added up """
+
+    def __init__(self):
+        # op -> [number of messages, number of failures, Histogram]
+        self.ops = {}
+        self.stages = dict((stage, Histogram()) for stage in stages)
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        # queue name -> totals of the queue_counters of finished queues
+        self.queues = {}
+
+    def merge(self, other):
+        for op, (count, errors, histogram) in other.ops.items():
+            entry = self.ops.setdefault(op, [0, 0, Histogram()])
+            entry[0] += count
+            entry[1] += errors
+            entry[2].merge(histogram)
+        for stage, histogram in other.stages.items():
+            self.stages[stage].merge(histogram)
+        self.messages_in += other.messages_in
+        self.bytes_in += other.bytes_in
+        self.messages_out += other.messages_out
+        self.bytes_out += other.bytes_out
+        for name, counters in other.queues.items():
+            self.merge_queue(name, counters)
+
+    def merge_queue(self, name, queue_stats):
+        totals = self.queues.setdefault(name, dict((counter, 0) for counter in queue_counters))
+        for counter in queue_counters:
+            totals[counter] += queue_stats.get(counter, 0)
+
+
+class ClientStats(object):
+    """ The statistics of a single client, updated by its Protocol """
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.started = time.time()
+        self.lock = Lock()
+        self.counters = Counters()
+        # name -> SendQueue, registered by the protocol and the transport
+        self.queues = {}
+
+    def received(self, nbytes, messages=1):
+        with self.lock:
+            self.counters.messages_in += messages
+            self.counters.bytes_in += nbytes
+
+    def operation(self, op, seconds, failed=False):
+        with self.lock:
+            entry = self.counters.ops.get(op)
+            if entry is None:
+                entry = self.counters.ops[op] = [0, 0, Histogram()]
+            entry[0] += 1
+            if failed:
+                entry[1] += 1
+            entry[2].observe(seconds)
+
+    def stage(self, stage, seconds):
+        with self.lock:
+            self.counters.stages[stage].observe(seconds)
+
+    def sent(self, nbytes, messages=1):
+        with self.lock:
+            self.counters.messages_out += messages
+            self.counters.bytes_out += nbytes
+
+    def add_queue(self, name, queue):
+        """ Reports the depth and counters of a SendQueue under name """
+        self.queues[name] = queue
+
+    def queue_stats(self):
+        return dict((name, queue.stats()) for name, queue in list(self.queues.items()))
+
+    def snapshot(self):
+        with self.lock:
+            counters = self.counters
+            return {
+                "client_id": self.client_id,
+                "uptime": time.time() - self.started,
+                "ops": dict((op, {"count": count, "errors": errors, "latency": histogram.to_dict()})
+                            for op, (count, errors, histogram) in counters.ops.items()),
+                "stages": dict((stage, histogram.to_dict()) for stage, histogram in counters.stages.items()),
+                "messages_in": counters.messages_in,
+                "bytes_in": counters.bytes_in,
+                "messages_out": counters.messages_out,
+                "bytes_out": counters.bytes_out,
+                "queues": self.queue_stats(),
+            }
+
+
+_lock = Lock()
+# Clients that did not call finish, e.g. because they were never connected,
+# disappear with their Protocol
+_clients = weakref.WeakValueDictionary()
+_finished = Counters()
+
+
+def register(client_stats):
+    with _lock:
+        _clients[id(client_stats)] = client_stats
+
+
+def unregister(client_stats):
+    """ Removes a finished client, keeping its counts in the totals """
+    with _lock:
+        if _clients.pop(id(client_stats), None) is None:
+            return
+        with client_stats.lock:
+            _finished.merge(client_stats.counters)
+        for name, queue_stats in client_stats.queue_stats().items():
+            _finished.merge_queue(name, queue_stats)
+
+
+def clients():
+    with _lock:
+        return list(_clients.values())
+
+
+def snapshot():
+    """ Returns the statistics of all connected clients """
+    client_snapshots = [client_stats.snapshot() for client_stats in clients()]
+    return {"time": time.time(), "latency_buckets": list(latency_buckets), "clients": client_snapshots}
+
+
+def totals():
+    """ Returns the Counters added up over all clients, past and present,
+    and the number of messages and bytes queued for the present ones """
+    result = Counters()
+    queued = {}
+    with _lock:
+        result.merge(_finished)
+    for client_stats in clients():
+        with client_stats.lock:
+            result.merge(client_stats.counters)
+        for name, queue_stats in client_stats.queue_stats().items():
+            result.merge_queue(name, queue_stats)
+            depth = queued.setdefault(name, [0, 0])
+            depth[0] += queue_stats["queued"]
+            depth[1] += queue_stats["queued_bytes"]
+    return result, queued
+
+
+def _format_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(latency_buckets + ("+Inf",), histogram.counts):
+        cumulative += count
+        lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, cumulative))
+    lines.append("%s_sum{%s} %r" % (name, labels.rstrip(","), histogram.sum))
+    lines.append("%s_count{%s} %d" % (name, labels.rstrip(","), histogram.count))
+
+
+def prometheus_text():
+    """ Returns the totals of all clients in the Prometheus text exposition
+    format """
+    counters, queued = totals()
+    lines = []
+
+    def metric(name, metric_type, description):
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+
+    metric("rosbridge_clients", "gauge", "Number of connected clients")
+    lines.append("rosbridge_clients %d" % len(clients()))
+
+    metric("rosbridge_operations_total", "counter", "Messages received from clients, by op")
+    for op, (count, errors, histogram) in sorted(counters.ops.items()):
+        lines.append('rosbridge_operations_total{op="%s"} %d' % (op, count))
+    metric("rosbridge_operation_errors_total", "counter", "Messages whose op failed, by op")
+    for op, (count, errors, histogram) in sorted(counters.ops.items()):
+        lines.append('rosbridge_operation_errors_total{op="%s"} %d' % (op, errors))
+    metric("rosbridge_operation_duration_seconds", "histogram", "Time taken to handle a message, by op")
+    for op, (count, errors, histogram) in sorted(counters.ops.items()):
+        _format_histogram(lines, "rosbridge_operation_duration_seconds", 'op="%s",' % op, histogram)
+    metric("rosbridge_send_stage_duration_seconds", "histogram", "Time taken by the steps of sending a message")
+    for stage in stages:
+        _format_histogram(lines, "rosbridge_send_stage_duration_seconds", 'stage="%s",' % stage,
+                          counters.stages[stage])
+
+    for name, value, description in [("received_messages", counters.messages_in, "Messages received"),
+                                      ("received_bytes", counters.bytes_in, "Bytes received"),
+                                      ("sent_messages", counters.messages_out, "Messages passed to the transports"),
+                                      ("sent_bytes", counters.bytes_out, "Bytes passed to the transports")]:
+        metric("rosbridge_%s_total" % name, "counter", description)
+        lines.append("rosbridge_%s_total %d" % (name, value))
+
+    metric("rosbridge_queued_messages", "gauge", "Messages waiting in the queues of the clients")
+    for name, (messages, nbytes) in sorted(queued.items()):
+        lines.append('rosbridge_queued_messages{queue="%s"} %d' % (name, messages))
+    metric("rosbridge_queued_bytes", "gauge", "Bytes waiting in the queues of the clients")
+    for name, (messages, nbytes) in sorted(queued.items()):
+        lines.append('rosbridge_queued_bytes{queue="%s"} %d' % (name, nbytes))
+    metric("rosbridge_dropped_messages_total", "counter", "Messages dropped from full queues")
+    for name, queue_totals in sorted(counters.queues.items()):
+        lines.append('rosbridge_dropped_messages_total{queue="%s"} %d' % (name, queue_totals["dropped"]))
+    return "\n".join(lines) + "\n"
+
+
+class StatsPublisher(object):
+    """ Periodically publishes snapshot() as JSON on a std_msgs/String topic """
+
+    def __init__(self, topic="/rosbridge/stats", period=1.0):
+        from std_msgs.msg import String
+        self.message_class = String
+        self.publisher = rospy.Publisher(topic, String, queue_size=1, latch=True)
+        self.timer = rospy.Timer(rospy.Duration(period), self.publish)
+
+    def publish(self, event=None):
+        self.publisher.publish(self.message_class(data=json.dumps(snapshot())))
+
+    def shutdown(self):
+        self.timer.shutdown()
+        self.publisher.unregister()
@@ -31,17 +31,118 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+from functools import partial
+from io import BytesIO
 from threading import Lock
-from rospy import Subscriber, logerr
+from rospy import AnyMsg, Subscriber, logerr
 from rostopic import get_topic_type
-from rosbridge_library.internal import ros_loader, message_conversion
+from rosbridge_library.internal import conversion_pool, ros_loader, message_conversion
+from rosbridge_library.internal.json_streaming import StreamedMessage
+from rosbridge_library.internal.serialization_cache import cache as serialization_cache
 from rosbridge_library.internal.topics import TopicNotEstablishedException
 from rosbridge_library.internal.topics import TypeConflictException
 
 """ Manages and interfaces with ROS Subscriber objects.  A single subscriber
-is shared between multiple clients
+is shared between all clients of a topic, whatever conversion options they
+chose.  Each incoming message is converted once per set of options that a
+client subscribed with.
+
+Clients that subscribe with the "encoding" option "raw" receive RawMessages,
+the messages as serialized by ROS.  Once a topic has such clients, its
+subscriber receives rospy.AnyMsgs, which are only deserialized if other
+clients need them converted.
+
+If the conversion pool is running, clients that subscribe with the
+"serialization" option receive SerializedMessages instead, converted and
+serialized by the worker processes of the pool from rospy.AnyMsgs.  The
+option is the class of the client's protocol and its serialization_key().
 """
 
+# The conversion options, and their defaults
+default_options = {"add_ros_type_to_message": False, "binary_attachments": False, "fields": None,
+                   "native_binary": False, "typed_arrays": False, "stream_messages": False,
+                   "encoding": None, "serialization": None}
+
+
+def get_options_key(options=None):
+    """ Returns a hashable for the conversion options, equal for options that
+    convert messages the same way """
+    _options = dict(default_options)
+    if options:
+        _options.update(options)
+    return frozenset(_options.items())
+
+
+class RawMessage(object):
+    """ A message as serialized by ROS, with its type and md5sum """
+
+    __slots__ = ["type", "md5sum", "data"]
+
+    def __init__(self, type, md5sum, data):
+        self.type = type
+        self.md5sum = md5sum
+        self.data = data
+
+
+class SerializedMessage(object):
+    """ A publish message converted and serialized in the conversion pool,
+    ready to be sent.  serialization is the "serialization" option it was
+    serialized for """
+
+    __slots__ = ["data", "serialization"]
+
+    def __init__(self, data, serialization=None):
+        self.data = data
+        self.serialization = serialization
+
+
+class Conversion():
+    """ Converts the messages of a topic for the clients that subscribed with
+    the same conversion options """
+
+    def __init__(self, msg_class, options):
+        self.msg_class = msg_class
+        self.key = get_options_key(options)
+        self.raw = options.get("encoding") == "raw"
+        # Convert messages in the conversion pool, for clients of a protocol
+        # class and serialization_key()
+        self.serialization = options.get("serialization")
+        self.pooled = self.serialization is not None and not self.raw
+        if self.raw:
+            self.callbacks = {}
+            return
+        fields = options.get("fields")
+        # Make sure the requested fields exist, propagating any exceptions
+        if fields:
+            message_conversion.get_projection(msg_class, fields)
+        self.extract_values_options = dict(add_ros_type_to_inst=bool(options.get("add_ros_type_to_message", False)),
+                                           binary_attachments=bool(options.get("binary_attachments", False)),
+                                           native_binary=bool(options.get("native_binary", False)),
+                                           typed_arrays=bool(options.get("typed_arrays", False)),
+                                           fields=fields)
+        # Hand out messages that are written to JSON directly, without
+        # building the dictionary of values
+        self.stream_messages = bool(options.get("stream_messages", False)) and not fields
+        # client_id -> callback
+        self.callbacks = {}
+
+    def convert(self, msg):
+        if self.raw:
+            return self.convert_raw(msg)
+        if self.stream_messages:
+            return StreamedMessage(msg, self.extract_values_options)
+        return message_conversion.extract_values(msg, options=self.extract_values_options)
+
+    def convert_raw(self, msg):
+        if isinstance(msg, AnyMsg):
+            header = getattr(msg, "_connection_header", None) or {}
+            return RawMessage(header.get("type", self.msg_class._type),
+                              header.get("md5sum", self.msg_class._md5sum), msg._buff)
+        # Another subscriber of this node made rospy deserialize the message
+        buff = BytesIO()
+        msg.serialize(buff)
+        return RawMessage(self.msg_class._type, self.msg_class._md5sum, buff.getvalue())
+
 
 class MultiSubscriber():
     """ Handles multiple clients for a single subscriber.
@@ -50,13 +151,15 @@ class MultiSubscriber():
     callbacks being called in separate threads, must lock whenever modifying
     or accessing the subscribed clients. """
 
-    def __init__(self, topic, msg_type=None, options=None):
+    def __init__(self, topic, msg_type=None, raw=False):
         """ Register a subscriber on the specified topic.
 
         Keyword arguments:
         topic    -- the name of the topic to register the subscriber on
         msg_type -- (optional) the type to register the subscriber as.  If not
         provided, an attempt will be made to infer the topic type
+        raw      -- (optional) subscribe for rospy.AnyMsgs right away, for
+        raw or pooled conversions
 
         Throws:
         TopicNotEstablishedException -- if no msg_type was specified by the
@@ -86,19 +189,21 @@ class MultiSubscriber():
             raise TypeConflictException(topic, topic_type, msg_class._type)
 
         # Create the subscriber and associated member variables
-        self.subscriptions = {}
+        # options key -> Conversion of the clients that chose these options
+        self.conversions = {}
+        # client_id -> the options keys the client subscribed with
+        self.clients = {}
         self.lock = Lock()
         self.topic = topic
         self.msg_class = msg_class
-        self.subscriber = Subscriber(topic, msg_class, self.callback)
-        self.options = dict(options) if options else {}
-        self.extract_values_options = dict(add_ros_type_to_inst=bool(options.get("add_ros_type_to_message", False)))
-
+        self.raw = raw
+        self.subscriber = Subscriber(topic, AnyMsg if raw else msg_class, self.callback)
 
     def unregister(self):
         self.subscriber.unregister()
         with self.lock:
-            self.subscriptions.clear()
+            self.conversions.clear()
+            self.clients.clear()
 
     def verify_type(self, msg_type):
         """ Verify that the subscriber subscribes to messages of this type.
@@ -117,67 +222,144 @@ class MultiSubscriber():
                                         self.msg_class._type, msg_type)
         return
 
-    def subscribe(self, client_id, callback):
+    def subscribe(self, client_id, callback, options=None):
         """ Subscribe the specified client to this subscriber.
 
+        A client may be subscribed with several sets of options at the same
+        time, e.g. while it changes its options.
+
         Keyword arguments:
         client_id -- the ID of the client subscribing
         callback  -- this client's callback, that will be called for incoming
         messages
+        options   -- (optional) dictionary of conversion options.  "fields"
+        is a tuple of field paths to restrict messages to, "stream_messages"
+        hands out json_streaming.StreamedMessages instead of dictionaries of
+        values, "encoding" "raw" hands out RawMessages, and "serialization"
+        hands out SerializedMessages if the conversion pool is running
+
+        Throws:
+        NonexistentFieldException -- if options restrict messages to fields
+        that do not exist in the msg_type
 
         """
+        key = get_options_key(options)
         with self.lock:
-            self.subscriptions[client_id] = callback
+            conversion = self.conversions.get(key)
+            if conversion is None:
+                conversion = Conversion(self.msg_class, dict(key))
+                self.conversions[key] = conversion
+            conversion.callbacks[client_id] = callback
+            self.clients.setdefault(client_id, set()).add(key)
+            if (conversion.raw or conversion.pooled) and not self.raw:
+                # rospy shares one data class per topic and node, so the
+                # subscriber has to be replaced.  Messages published in
+                # between are missed.
+                self.subscriber.unregister()
+                self.raw = True
+                self.subscriber = Subscriber(self.topic, AnyMsg, self.callback)
             # If the topic is latched, add_callback will immediately invoke
             # the given callback.
-            self.subscriber.impl.add_callback(self.callback, [callback])
-            self.subscriber.impl.remove_callback(self.callback, [callback])
+            latched = [(conversion, [callback])]
+            self.subscriber.impl.add_callback(self.callback, latched)
+            self.subscriber.impl.remove_callback(self.callback, latched)
 
-    def unsubscribe(self, client_id):
+    def unsubscribe(self, client_id, options=None):
         """ Unsubscribe the specified client from this subscriber
 
         Keyword arguments:
         client_id -- the ID of the client to unsubscribe
+        options   -- (optional) the options the client subscribed with.  If
+        not provided, all subscriptions of the client are removed
+
+        Returns True if the client was subscribed
 
         """
         with self.lock:
-            del self.subscriptions[client_id]
+            keys = self.clients.get(client_id)
+            if not keys:
+                return False
+            if options is None:
+                removed = list(keys)
+            else:
+                removed = [get_options_key(options)]
+                if removed[0] not in keys:
+                    return False
+            for key in removed:
+                keys.discard(key)
+                conversion = self.conversions[key]
+                del conversion.callbacks[client_id]
+                if not conversion.callbacks:
+                    del self.conversions[key]
+            if not keys:
+                del self.clients[client_id]
+            return True
 
     def has_client_id(self, client_id):
         with self.lock:
-            return client_id in self.subscriptions
+            return client_id in self.clients
 
     def has_subscribers(self):
         """ Return true if there are subscribers """
         with self.lock:
-            ret = len(self.subscriptions) != 0
+            ret = len(self.clients) != 0
             return ret
 
     def callback(self, msg, callbacks=None):
         """ Callback for incoming messages on the rospy.Subscriber
 
-        Converts the incoming msg to JSON, then passes the JSON to the
-        registered subscriber callbacks.
+        Converts the incoming msg once for each set of conversion options,
+        then passes the result to the registered subscriber callbacks.
 
         Keyword Arguments:
-        msg - the ROS message coming from the subscriber
-        callbacks - subscriber callbacks to invoke
+        msg - the ROS message coming from the subscriber, or a rospy.AnyMsg
+        callbacks - (optional) list of (Conversion, subscriber callbacks)
+        pairs to invoke
 
         """
-        # Try to convert the msg to JSON
-        json = None
-        try:
-            json = message_conversion.extract_values(msg, options=self.extract_values_options)
-        except Exception as exc:
-            logerr("Exception while converting messages in subscriber callback : %s", exc)
-            return
-        
         # Get the callbacks to call
         if not callbacks:
             with self.lock:
-                callbacks = self.subscriptions.values()
-
-        # Pass the JSON to each of the callbacks
+                callbacks = [(conversion, list(conversion.callbacks.values()))
+                             for conversion in self.conversions.values()]
+
+        deserialized = None
+        pooled = []
+        for conversion, conversion_callbacks in callbacks:
+            if conversion.pooled and isinstance(msg, AnyMsg) and conversion_pool.pool is not None:
+                pooled.append((conversion, conversion_callbacks))
+                continue
+            # Try to convert the msg to JSON
+            try:
+                if conversion.raw:
+                    json = conversion.convert(msg)
+                else:
+                    if deserialized is None:
+                        deserialized = self.deserialize(msg)
+                    json = conversion.convert(deserialized)
+            except Exception as exc:
+                logerr("Exception while converting messages in subscriber callback : %s", exc)
+                continue
+
+            # Pass the JSON to each of the callbacks
+            self._call(conversion_callbacks, json)
+
+        if pooled:
+            conversion_pool.pool.submit(self.topic, convert_serialized,
+                                        (self.topic, self.msg_class._type, msg._buff,
+                                         [conversion.key for conversion, _ in pooled]),
+                                        partial(self._pooled_callback, pooled))
+
+    def _pooled_callback(self, callbacks, results):
+        """ Passes the messages serialized in the conversion pool to the
+        callbacks of their Conversions, in the order of the topic """
+        for (conversion, conversion_callbacks), serialized in zip(callbacks, results):
+            if serialized is not None:
+                self._call(conversion_callbacks, SerializedMessage(serialized, conversion.serialization))
+
+    def _call(self, callbacks, json):
+        # The clients reuse each other's serialized message
+        serialization_cache.share(json, len(callbacks))
         for callback in callbacks:
             try:
                 callback(json)
@@ -186,6 +368,15 @@ class MultiSubscriber():
                 logerr("Exception calling subscribe callback: %s", exc)
                 pass
 
+    def deserialize(self, msg):
+        """ Returns the message of a rospy.AnyMsg, deserialized once for all
+        clients that need it converted """
+        if not isinstance(msg, AnyMsg):
+            return msg
+        inst = self.msg_class()
+        inst.deserialize(msg._buff)
+        return inst
+
 
 class SubscriberManager():
     """
@@ -193,16 +384,9 @@ class SubscriberManager():
     """
 
     def __init__(self):
+        # topic -> MultiSubscriber
         self._subscribers = {}
-
-    def get_subscriber_key(self, topic, options=None):
-        # defaults
-        _options = {"add_ros_type_to_message": False}
-        if options:
-            _options.update(options)
-        options = _options
-        subscriber_key = (topic, frozenset(options.items()))
-        return subscriber_key
+        self._lock = Lock()
 
     def subscribe(self, client_id, topic, callback, msg_type=None, options=None):
         """ Subscribe to a topic
@@ -212,43 +396,92 @@ class SubscriberManager():
         topic     -- the name of the topic to subscribe to
         callback  -- the callback to call for incoming messages on the topic
         msg_type  -- (optional) the type of the topic
+        options   -- (optional) conversion options, see
+        MultiSubscriber.subscribe
 
         """
+        raw = bool(options) and (options.get("encoding") == "raw" or
+                                 options.get("serialization") is not None)
+        while True:
+            with self._lock:
+                subscriber = self._subscribers.get(topic)
+            if subscriber is None:
+                # Made without holding the lock, as resolving the type of the
+                # topic asks the master
+                created = MultiSubscriber(topic, msg_type, raw=raw)
+                with self._lock:
+                    subscriber = self._subscribers.setdefault(topic, created)
+                if subscriber is not created:
+                    # Another client subscribed to the topic meanwhile
+                    created.unregister()
 
-        subscriber_key = self.get_subscriber_key(topic, options=options)
-
-        if not subscriber_key in self._subscribers:
-            self._subscribers[subscriber_key] = MultiSubscriber(topic, msg_type, options=options)
-
-        if msg_type is not None:
-            self._subscribers[subscriber_key].verify_type(msg_type)
-
-        self._subscribers[subscriber_key].subscribe(client_id, callback)
-
-    def unsubscribe(self, client_id, topic):
+            try:
+                if msg_type is not None:
+                    subscriber.verify_type(msg_type)
+                # Latched messages are delivered to the callback right away
+                subscriber.subscribe(client_id, callback, options=options)
+            except Exception:
+                # Do not keep a subscriber without clients
+                with self._lock:
+                    if self._subscribers.get(topic) is subscriber and not subscriber.has_subscribers():
+                        subscriber.unregister()
+                        del self._subscribers[topic]
+                raise
+
+            with self._lock:
+                if self._subscribers.get(topic) is subscriber:
+                    return
+            # The subscriber lost its last client and was unregistered before
+            # this client was subscribed to it, so start over
+            subscriber.unsubscribe(client_id, options)
+
+    def unsubscribe(self, client_id, topic, options=None):
         """ Unsubscribe from a topic
 
         Keyword arguments:
         client_id -- the ID of the client to unsubscribe
         topic     -- the topic to unsubscribe from
+        options   -- (optional) the options the client subscribed with.  If
+        not provided, all subscriptions of the client on the topic are removed
 
         """
-
-        subscriber_key = None
-        subscriber = None
-        found = False
-        for subscriber_key, subscriber in self._subscribers.items():
-            if topic == subscriber_key[0] and subscriber.has_client_id(client_id):
-                found = True
-                break
-
-        if found:
-            subscriber.unsubscribe(client_id)
+        with self._lock:
+            subscriber = self._subscribers.get(topic)
+            if subscriber is None or not subscriber.unsubscribe(client_id, options):
+                return
 
             if not subscriber.has_subscribers():
                 subscriber.unregister()
-                del self._subscribers[subscriber_key]
+                del self._subscribers[topic]
 
 
-manager = SubscriberManager()
+# The Conversions of a worker process of the conversion pool, with the
+# protocols serializing their messages, keyed by type and options key
+_pooled_conversions = {}
+
 
+def convert_serialized(topic, msg_type, buff, keys):
+    """ Deserializes a message, then converts and serializes it as a publish
+    message for each of the keys of conversion options.  Runs in the worker
+    processes of the conversion pool.
+
+    Returns the list of serialized messages, None where serialization failed
+    """
+    msg_class = ros_loader.get_message_class(msg_type)
+    msg = msg_class()
+    msg.deserialize(buff)
+    results = []
+    for key in keys:
+        pooled = _pooled_conversions.get((msg_type, key))
+        if pooled is None:
+            conversion = Conversion(msg_class, dict(key))
+            protocol_class, serialization_key = conversion.serialization
+            pooled = (conversion, protocol_class.for_serialization(serialization_key))
+            _pooled_conversions[(msg_type, key)] = pooled
+        conversion, protocol = pooled
+        outgoing_msg = {"op": "publish", "topic": topic, "msg": conversion.convert(msg)}
+        results.append(protocol.serialize(outgoing_msg))
+    return results
+
+
+manager = SubscriberManager()
@@ -31,13 +31,19 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import rospy
-import time
 import sys, traceback
+from time import time
+from threading import Lock
 from rosbridge_library.internal.exceptions import InvalidArgumentException
 from rosbridge_library.internal.exceptions import MissingArgumentException
 
 from rosbridge_library.capabilities.fragmentation import Fragmentation
-from rosbridge_library.util import json, bson
+from rosbridge_library.internal import binary_attachments, json_streaming, message_conversion, serializers, stats
+from rosbridge_library.internal.json_framer import JsonFramer
+from rosbridge_library.internal.outgoing_queue import OutgoingQueue
+from rosbridge_library.internal.send_queue import MessageStream
+from rosbridge_library.internal.serialization_cache import cache as serialization_cache
+from rosbridge_library.util import json, bson, text_type
 
 
 def is_number(s):
@@ -56,12 +62,12 @@ def has_binary(obj):
         return any(has_binary(item) for item in obj)
 
     if isinstance(obj, dict):
-        return any(has_binary(item) for item in obj.itervalues())
+        return any(has_binary(item) for item in obj.values())
 
     return isinstance(obj, bson.binary.Binary)
 
 
-class Protocol:
+class Protocol(object):
     """ The interface for a single client to interact with ROS.
 
     See rosbridge_protocol for the default protocol used by rosbridge
@@ -77,9 +83,6 @@ class Protocol:
     # ..same for other parameters
     fragment_size = None
     png = None
-    # buffer used to gather partial JSON-objects (could be caused by small tcp-buffers or similar..)
-    buffer = ""
-    old_buffer = ""
     busy = False
     # if this is too low, ("simple")clients network stacks will get flooded (when sending fragments of a huge message..)
     # .. depends on message_size/bandwidth/performance/client_limits/...
@@ -89,6 +92,24 @@ class Protocol:
     external_service_list = {}
     # Use only BSON for the whole communication if the server has been started with bson_only_mode:=True
     bson_only_mode = False
+    # Large binary fields are sent as raw attachments in binary frames if the server allows it and the client asks for it
+    allow_binary_attachments = False
+    binary_attachments = False
+    # Set by transports whose outgoing method takes the topic of published
+    # messages as a second argument, e.g. to keep only the latest message per topic
+    outgoing_takes_topic = False
+    # Set by transports whose outgoing method takes MessageStreams, e.g. the
+    # fragments of a large message, and produces their messages as it sends
+    outgoing_takes_streams = False
+    # Clients can ask transports to collect the messages sent to them within a
+    # window of batch_window milliseconds into a single batch message
+    batch_window = 0
+    max_batch_window = 1000
+    # The wire format of the client's messages, see set_serializer
+    serializer = serializers.json_serializer
+    # Set to False by transports that cannot tell where a binary message
+    # ends, e.g. plain TCP streams
+    delimits_messages = True
 
     parameters = None
 
@@ -102,76 +123,83 @@ class Protocol:
         self.client_id = client_id
         self.capabilities = []
         self.operations = {}
+        # gathers partial JSON-objects (could be caused by small tcp-buffers or similar..)
+        self.framer = JsonFramer()
+        # paces outgoing messages if the client asks for a delay between them
+        self.outgoing_queue = None
+        self.outgoing_queue_lock = Lock()
+        # counters and latencies, exported by internal.stats
+        self.stats = stats.ClientStats(client_id)
+        stats.register(self.stats)
 
         if self.parameters:
             self.fragment_size = self.parameters["max_message_size"]
             self.delay_between_messages = self.parameters["delay_between_messages"]
             self.bson_only_mode = self.parameters.get('bson_only_mode', False)
+            self.allow_binary_attachments = self.parameters.get('allow_binary_attachments', False)
+            if self.parameters.get('serializer'):
+                self.set_serializer(self.parameters['serializer'])
 
-    # added default message_string="" to allow recalling incoming until buffer is empty without giving a parameter
-    # --> allows to get rid of (..or minimize) delay between client-side sends
     def incoming(self, message_string=""):
         """ Process an incoming message from the client
 
+        The message string may contain any number of JSON objects, including
+        parts of objects that are completed by later calls.
+
         Keyword arguments:
         message_string -- the wire-level message sent by the client
 
         """
-        self.buffer = self.buffer + message_string
-        msg = None
+        if self.bson_only_mode or (self.serializer.binary and not isinstance(message_string, text_type)):
+            # Binary formats are used in conjunction with a network handler
+            # that receives exactly one full message
+            self.handle_message(message_string)
+            return
 
-        # take care of having multiple JSON-objects in receiving buffer
-        # ..first, try to load the whole buffer as a JSON-object
-        try:
-            msg = self.deserialize(self.buffer)
-            self.buffer = ""
+        # Shortcut for the usual case of a single complete message
+        if not self.framer.pending():
+            try:
+                msg = self.deserialize(message_string)
+            except Exception:
+                msg = None
+            if isinstance(msg, dict):
+                self.handle_message(message_string, msg)
+                return
+
+        for json_string in self.framer.feed(message_string):
+            self.handle_message(json_string)
+        if self.framer.discarded:
+            self.log("warning", "Discarded %d characters of data that is not a JSON object" % self.framer.discarded)
+
+    def handle_message(self, message_string, msg=None):
+        """ Deserializes and processes a single complete message.  Network
+        handlers that receive whole messages may call this directly instead
+        of incoming.
 
-        # if loading whole object fails try to load part of it (from first opening bracket "{" to next closing bracket "}"
-        # .. this causes Exceptions on "inner" closing brackets --> so I suppressed logging of deserialization errors
-        except Exception as e:
-            if self.bson_only_mode:
-                # Since BSON should be used in conjunction with a network handler
-                # that receives exactly one full BSON message.
-                # This will then be passed to self.deserialize and shouldn't cause any
-                # exceptions because of fragmented messages (broken or invalid messages might still be sent tough)
-                self.log("error", "Exception in deserialization of BSON")
+        Keyword arguments:
+        message_string -- the wire-level representation of one message
+        msg            -- (optional) message_string, already deserialized
 
-            else:
-                # TODO: handling of partial/multiple/broken json data in incoming buffer
-                # this way is problematic when json contains nested json-objects ( e.g. { ... { "config": [0,1,2,3] } ...  } )
-                # .. if outer json is not fully received, stepping through opening brackets will find { "config" : ... } as a valid json object
-                # .. and pass this "inner" object to rosbridge and throw away the leading part of the "outer" object..
-                # solution for now:
-                # .. check for "op"-field. i can still imagine cases where a nested message ( e.g. complete service_response fits into the data field of a fragment..)
-                # .. would cause trouble, but if a response fits as a whole into a fragment, simply do not pack it into a fragment.
-                #
-                # --> from that follows current limitiation:
-                #     fragment data must NOT (!) contain a complete json-object that has an "op-field"
-                #
-                # an alternative solution would be to only check from first opening bracket and have a time out on data in input buffer.. (to handle broken data)
-                opening_brackets = [i for i, letter in enumerate(self.buffer) if letter == '{']
-                closing_brackets = [i for i, letter in enumerate(self.buffer) if letter == '}']
-
-                for start in opening_brackets:
-                    for end in closing_brackets:
-                        try:
-                            msg = self.deserialize(self.buffer[start:end+1])
-                            if msg.get("op",None) != None:
-                                # TODO: check if throwing away leading data like this is okay.. loops look okay..
-                                self.buffer = self.buffer[end+1:len(self.buffer)]
-                                # jump out of inner loop if json-decode succeeded
-                                break
-                        except Exception as e:
-                            # debug json-decode errors with this line
-                            #print e
-                            pass
-                    # if load was successfull --> break outer loop, too.. -> no need to check if json begins at a "later" opening bracket..
-                    if msg != None:
-                        break
-
-        # if decoding of buffer failed .. simply return
+        """
+        self.stats.received(len(message_string))
         if msg is None:
-            return
+            try:
+                msg = self.deserialize(message_string)
+            except Exception as e:
+                self.log("error", "Unable to deserialize message from client: %s" % e)
+                return
+        self.process_message(msg, message_string)
+
+    def process_message(self, msg, message_string=None):
+        """ Passes a deserialized message to the operation it requests
+
+        Keyword arguments:
+        msg            -- the dictionary of values of the message
+        message_string -- (optional) the wire-level message, for logging
+
+        """
+        if message_string is None:
+            message_string = msg
 
         # process fields JSON-message object that "control" rosbridge
         mid = None
@@ -196,23 +224,66 @@ class Protocol:
             self.delay_between_messages = msg["message_intervall"]
         if "png" in msg.keys():
             self.png = msg["msg"]
+        # binary attachments can only be switched on, messages already converted for this client may contain attachments
+        if (msg.get("binary_attachments", False) is True and self.allow_binary_attachments and
+                not self.bson_only_mode and not self.binary_attachments):
+            self.binary_attachments = True
+            self.serialization_changed()
+        if isinstance(msg.get("batch_window"), (int, float)):
+            self.batch_window = min(max(msg["batch_window"], 0), self.max_batch_window)
+        if "serializer" in msg:
+            self.set_serializer(msg["serializer"], mid)
 
         # now try to pass message to according operation
+        start = time()
         try:
             self.operations[op](msg)
         except Exception as exc:
+            self.stats.operation(op, time() - start, failed=True)
             traceback.print_exc(file=sys.stderr)
             self.log("error", "%s: %s" % (op, str(exc)), mid)
+        else:
+            self.stats.operation(op, time() - start)
 
-        # if anything left in buffer .. re-call self.incoming
-        # TODO: check what happens if we have "garbage" on tcp-stack --> infinite loop might be triggered! .. might get out of it when next valid JSON arrives since only data after last 'valid' closing bracket is kept
-        if len(self.buffer) > 0:
-            # try to avoid infinite loop..
-            if self.old_buffer != self.buffer:
-                self.old_buffer = self.buffer
-                self.incoming()
+    def set_serializer(self, name, mid=None):
+        """ Switches the client to the wire format registered under name in
+        internal.serializers.  The format can be chosen once, messages sent
+        by the client afterwards are expected in it as well, apart from text
+        messages, which are always JSON.
 
+        Keyword arguments:
+        name -- the name of the serializer
+        mid  -- (optional) an ID associated with the request, logged on error
+
+        Returns True if the client uses the serializer
 
+        """
+        serializer = serializers.get(name)
+        if serializer is None:
+            self.log("error", "Unknown serializer: %s.  Available serializers: %s" % (name, serializers.names()), mid)
+            return False
+        if serializer is self.serializer:
+            return True
+        if self.bson_only_mode:
+            self.log("error", "Cannot switch to serializer %s, the server only speaks BSON" % name, mid)
+            return False
+        if self.serializer is not serializers.json_serializer:
+            self.log("error", "Cannot switch to serializer %s, already using %s" % (name, self.serializer.name), mid)
+            return False
+        if serializer.binary and not self.delimits_messages:
+            self.log("error", "Serializer %s needs a transport that delimits messages" % name, mid)
+            return False
+        self.serializer = serializer
+        self.log("info", "using serializer %s" % name)
+        self.serialization_changed()
+        return True
+
+    def serialization_changed(self):
+        """ Tells the capabilities that settings serialization_key() depends
+        on have changed, so messages serialized ahead for the client, e.g. in
+        the conversion pool, are serialized with the new settings """
+        for capability in self.capabilities:
+            capability.serialization_changed()
 
     def outgoing(self, message):
         """ Pass an outgoing message to the client.  This method should be
@@ -224,46 +295,148 @@ class Protocol:
         """
         pass
 
-    def send(self, message, cid=None):
+    def send(self, message, cid=None, shared_source=None, shared_key=None, serialized=None,
+             chained=None):
         """ Called internally in preparation for sending messages to the client
 
         This method pre-processes the message then passes it to the overridden
         outgoing method.
 
         Keyword arguments:
-        message -- a dict of message values to be marshalled and sent
-        cid     -- (optional) an associated id
+        message       -- a dict of message values to be marshalled and sent
+        cid           -- (optional) an associated id
+        shared_source -- (optional) the converted message that message was
+        built from, if it is shared with other clients
+        shared_key    -- (optional) a hashable that, together with
+        shared_source, determines the content of message.  Clients with the
+        same serialization_key() reuse each other's serialized message
+        serialized    -- (optional) message as already serialized by serialize,
+        e.g. in the conversion pool.  message only needs the op, topic and id
+        chained       -- (optional) the send_queue.Chained marker of a message
+        that depends on earlier ones, passed to the send queue instead of the
+        topic
 
         """
-        serialized = self.serialize(message, cid)
+        if (serialized is None and self.fragment_size is not None and
+                json_streaming.is_streamed(message) and self.streams_messages()):
+            # Streamed messages are written straight into chunks
+            self._send_chunks(message, cid, shared_source, shared_key)
+            return
+
+        topic = chained if chained is not None else self._replaceable_topic(message)
+        if serialized is None:
+            start = time()
+            if shared_source is not None:
+                cache_key = (shared_key, self.serialization_key())
+                serialized = serialization_cache.get(shared_source, cache_key)
+                if serialized is None:
+                    serialized = self.serialize(message, cid)
+                    if serialized is not None:
+                        serialization_cache.put(shared_source, cache_key, serialized)
+                serialization_cache.taken(shared_source)
+            else:
+                serialized = self.serialize(message, cid)
+            self.stats.stage("serialize", time() - start)
         if serialized is not None:
             if self.png == "png":
                 # TODO: png compression on outgoing messages
                 # encode message
                 pass
 
-            fragment_list = None
-            if self.fragment_size != None and len(serialized) > self.fragment_size:
-                mid = message.get("id", None)
-
-                # TODO: think about splitting into fragments that have specified size including header-fields!
-                # --> estimate header size --> split content into fragments that have the requested overall size, rather than requested content size
-                fragment_list = Fragmentation(self).fragment(message, self.fragment_size, mid )
-
-            # fragment list not empty -> send fragments
-            if fragment_list != None:
-                for fragment in fragment_list:
-                    if self.bson_only_mode:
-                        self.outgoing(bson.BSON.encode(fragment))
-                    else:
-                        self.outgoing(json.dumps(fragment))
-                    # okay to use delay here (sender's send()-function) because rosbridge is sending next request only to service provider when last one had finished)
-                    #  --> if this was not the case this delay needed to be implemented in service-provider's (meaning message receiver's) send_message()-function in rosbridge_tcp.py)
-                    time.sleep(self.delay_between_messages)
-            # else send message as it is
+            # binary frames are not fragmented, fragments can only carry text.
+            # The fragments are sliced from the serialized message as the
+            # transport takes them.
+            if (self.fragment_size != None and len(serialized) > self.fragment_size and
+                    not isinstance(serialized, binary_attachments.BinaryFrame)):
+                start = time()
+                fragments = Fragmentation(self).fragment_serialized(
+                    serialized, self.fragment_size, message.get("id", None))
+                self.stats.stage("fragment", time() - start)
+                self.send_serialized(fragments, chained)
             else:
-                self.outgoing(serialized)
-                time.sleep(self.delay_between_messages)
+                self.send_serialized(serialized, topic)
+
+    def send_serialized(self, serialized, topic=None):
+        """ Passes a serialized message on to outgoing.  If the client asked
+        for a delay between messages, the message is queued and sent from the
+        client's outgoing queue instead, so the calling thread (often a shared
+        ROS callback thread) never sleeps.  Once the queue exists, every
+        message goes through it, even if the delay is set back to 0, so none
+        overtakes the message the queue is sending.
+
+        Keyword arguments:
+        serialized -- the wire-level message, or a MessageStream of them
+        topic      -- (optional) the topic of a complete published message, or
+        the send_queue.Chained marker of a message depending on earlier ones
+
+        """
+        delay = float(self.delay_between_messages or 0)
+        if delay > 0 and self.outgoing_queue is None:
+            with self.outgoing_queue_lock:
+                if self.outgoing_queue is None:
+                    self.outgoing_queue = OutgoingQueue(self._outgoing, delay, log=self.log)
+                    self.stats.add_queue("pacing", self.outgoing_queue.queue)
+        if self.outgoing_queue is None:
+            self._outgoing(serialized, topic)
+            return
+        if self.outgoing_queue.interval != delay:
+            self.outgoing_queue.set_interval(delay)
+        self.outgoing_queue.push(serialized, topic)
+
+    def _replaceable_topic(self, message):
+        """ Returns the topic of a published message that a newer message of
+        the same topic may replace in a send queue, or None.  Deltas depend on
+        the message before them and are never replaced. """
+        if message.get("op") != "publish" or "delta" in message:
+            return None
+        return message.get("topic")
+
+    def _outgoing(self, serialized, topic=None):
+        if isinstance(serialized, MessageStream) and not self.outgoing_takes_streams:
+            for message in serialized:
+                self._outgoing(message)
+            return
+        start = time()
+        if topic is not None and self.outgoing_takes_topic:
+            self.outgoing(serialized, topic)
+        else:
+            self.outgoing(serialized)
+        self.stats.stage("outgoing", time() - start)
+        if isinstance(serialized, MessageStream):
+            self.stats.sent(len(serialized), serialized.count)
+        else:
+            self.stats.sent(len(serialized))
+
+    def _send_chunks(self, message, cid=None, shared_source=None, shared_key=None):
+        """ Sends a message containing StreamedMessages, as fragments if it
+        is longer than fragment_size.  The dictionary of values is never
+        built, and the fragments are sliced from the escaped chunks as the
+        transport takes them. """
+        chunks = None
+        if shared_source is not None:
+            cache_key = (shared_key, self.serialization_key(), "chunks")
+            chunks = serialization_cache.get(shared_source, cache_key)
+            serialization_cache.taken(shared_source)
+        if chunks is None:
+            start = time()
+            try:
+                chunks = json_streaming.dump_chunks(message)
+            except:
+                if cid is not None:
+                    self.log("error", "Unable to serialize %s message to client"
+                             % message["op"], cid)
+                return
+            self.stats.stage("serialize", time() - start)
+            if shared_source is not None:
+                serialization_cache.put(shared_source, cache_key, chunks)
+
+        if sum(len(chunk) for chunk in chunks) <= self.fragment_size:
+            self.send_serialized("".join(chunks), self._replaceable_topic(message))
+            return
+        start = time()
+        fragments = Fragmentation(self).fragment_chunks(chunks, self.fragment_size, message.get("id", None))
+        self.stats.stage("fragment", time() - start)
+        self.send_serialized(fragments)
 
     def finish(self):
         """ Indicate that the client is finished and clean up resources.
@@ -273,12 +446,46 @@ class Protocol:
         """
         for capability in self.capabilities:
             capability.finish()
+        if self.outgoing_queue is not None:
+            self.outgoing_queue.finish()
+        stats.unregister(self.stats)
+
+    def serialization_key(self):
+        """ Returns a hashable describing the settings that serialize()
+        depends on.  Clients with equal keys produce identical output for
+        identical messages.
+
+        Override together with serialize. """
+        return (self.bson_only_mode, self.binary_attachments, self.serializer.name)
+
+    @classmethod
+    def for_serialization(cls, key):
+        """ Returns an instance without client or capabilities, whose
+        serialize() produces the output of clients with the serialization_key()
+        key.  Used by the worker processes of the conversion pool.
+
+        Override together with serialization_key. """
+        protocol = cls.__new__(cls)
+        protocol.client_id = None
+        protocol.bson_only_mode, protocol.binary_attachments, name = key
+        protocol.serializer = serializers.get(name)
+        return protocol
+
+    def streams_messages(self):
+        """ Returns True if outgoing ROS messages may be handed to serialize
+        as json_streaming.StreamedMessages, to be written to JSON directly
+        instead of being converted to dictionaries of values first.
+
+        Override to return False if serialize needs the values. """
+        return (not self.bson_only_mode and not self.binary_attachments and
+                self.serializer is serializers.json_serializer and json_streaming.is_supported())
 
     def serialize(self, msg, cid=None):
         """ Turns a dictionary of values into the appropriate wire-level
         representation.
 
-        Default behaviour uses JSON.  Override to use a different container.
+        Default behaviour uses JSON, or the serializer the client chose.
+        Override to use a different container.
 
         Keyword arguments:
         msg -- the dictionary of values to serialize
@@ -287,9 +494,22 @@ class Protocol:
         Returns a JSON string representing the dictionary
         """
         try:
-            if has_binary(msg) or self.bson_only_mode:
+            if json_streaming.is_streamed(msg):
+                if not self.streams_messages():
+                    msg = json_streaming.extract_values(msg)
+                else:
+                    return json_streaming.dumps(msg)
+            if self.serializer is not serializers.json_serializer:
+                return self.serializer.dumps(msg)
+            if self.binary_attachments:
+                frame = binary_attachments.encode(msg, json.dumps)
+                if frame is not None:
+                    return frame
+            # Converted messages only contain bson.Binary values if binary
+            # fields are encoded that way, otherwise there is no need to look
+            if self.bson_only_mode or (message_conversion.encodes_bson_binary() and has_binary(msg)):
                 return bson.BSON.encode(msg)
-            else:    
+            else:
                 return json.dumps(msg)
         except:
             if cid is not None:
@@ -302,7 +522,8 @@ class Protocol:
 
         """ Turns the wire-level representation into a dictionary of values
 
-        Default behaviour assumes JSON. Override to use a different container.
+        Default behaviour assumes JSON, or the serializer the client chose
+        for binary messages.  Override to use a different container.
 
         Keyword arguments:
         msg -- the wire-level message to deserialize
@@ -315,6 +536,8 @@ class Protocol:
             if self.bson_only_mode:
                 bson_message = bson.BSON(msg)
                 return bson_message.decode()
+            elif self.serializer.binary and not isinstance(msg, text_type):
+                return self.serializer.loads(msg)
             else:
                 return json.loads(msg)
         except Exception as e:
@@ -42,12 +42,14 @@ from rosbridge_library.capabilities.defragmentation import Defragment
 from rosbridge_library.capabilities.advertise_service import AdvertiseService
 from rosbridge_library.capabilities.service_response import ServiceResponse
 from rosbridge_library.capabilities.unadvertise_service import UnadvertiseService
+from rosbridge_library.capabilities.batch import Batch
+from rosbridge_library.capabilities.message_definition import MessageDefinition
 
 
 
 class RosbridgeProtocol(Protocol):
     """ Adds the handlers for the rosbridge opcodes """
-    rosbridge_capabilities = [CallService, Advertise, Publish, Subscribe, Defragment, AdvertiseService, ServiceResponse, UnadvertiseService]
+    rosbridge_capabilities = [CallService, Advertise, Publish, Subscribe, Defragment, AdvertiseService, ServiceResponse, UnadvertiseService, Batch, MessageDefinition]
 
     print("registered capabilities (classes):")
     for cap in rosbridge_capabilities:
@@ -42,8 +42,11 @@ from rosbridge_library.capabilities.defragmentation import Defragment
 from rosbridge_library.capabilities.advertise_service import AdvertiseService
 from rosbridge_library.capabilities.service_response import ServiceResponse
 from rosbridge_library.capabilities.unadvertise_service import UnadvertiseService
+from rosbridge_library.capabilities.batch import Batch
+from rosbridge_library.capabilities.message_definition import MessageDefinition
 
 from rosbridge_library.protocol import has_binary
+from rosbridge_library.internal import json_streaming, message_conversion, serializers
 from rosbridge_library.util import json, bson
 from rosbridge_library.util import rdfutils
 import rdflib
@@ -51,7 +54,7 @@ import rdflib
 class RosbridgeRDFProtocol(Protocol):
     """ Adds the handlers for the rosbridge opcodes """
     rosbridge_capabilities = [CallService, Advertise, Publish, (Subscribe, {"options": {"add_ros_type_to_message": True}}),
-                              Defragment, AdvertiseService, ServiceResponse, UnadvertiseService]
+                              Defragment, AdvertiseService, ServiceResponse, UnadvertiseService, Batch, MessageDefinition]
 
     print("registered capabilities (classes):")
     for cap in rosbridge_capabilities:
@@ -83,6 +86,27 @@ class RosbridgeRDFProtocol(Protocol):
                         kwargs.update(x)
             self.add_capability(capability_class, *args, **kwargs)
 
+    def serialization_key(self):
+        return ("rdf", self.rdf_content_type, self.bson_only_mode)
+
+    @classmethod
+    def for_serialization(cls, key):
+        protocol = cls.__new__(cls)
+        protocol.client_id = None
+        _, protocol.rdf_content_type, protocol.bson_only_mode = key
+        return protocol
+
+    def set_serializer(self, name, mid=None):
+        # RDF content is text, the JSON-LD context needs JSON
+        if name != serializers.json_serializer.name:
+            self.log("error", "Cannot switch to serializer %s, RDF clients only use JSON" % name, mid)
+            return False
+        return True
+
+    def streams_messages(self):
+        # The JSON-LD context is added to the dictionary of values
+        return False
+
     def serialize(self, msg, cid=None):
         """ Turns a dictionary of values into the appropriate wire-level
         representation.
@@ -96,6 +120,8 @@ class RosbridgeRDFProtocol(Protocol):
         Returns a JSON string representing the dictionary
         """
 
+        if json_streaming.is_streamed(msg):
+            msg = json_streaming.extract_values(msg)
 
         rdfutils.add_jsonld_context_to_rosbridge_message(msg)
 
@@ -110,7 +136,7 @@ class RosbridgeRDFProtocol(Protocol):
                 return None
 
         try:
-            if has_binary(msg) or self.bson_only_mode:
+            if self.bson_only_mode or (message_conversion.encodes_bson_binary() and has_binary(msg)):
                 return bson.BSON.encode(msg)
             else:
                 return json.dumps(msg)
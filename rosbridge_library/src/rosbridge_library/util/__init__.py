@@ -1,19 +1,16 @@
-# try to import json-lib: 1st try usjon, 2nd try simplejson, else import standard python json
-try:
-    import ujson as json
-except ImportError:
-    try:
-        import simplejson as json
-    except ImportError:
-        import json
+# the preferred one of the installed json-libs that handles NaN, unicode,
+# large ints and floats correctly, see json_backends
+from rosbridge_library.util.json_backends import json
 
 # Differing string types for Python 2 and 3
 import sys
 if sys.version_info >= (3, 0):
     string_types = (str,)
+    text_type = str
     from io import StringIO
 else:
     string_types = (str, unicode)
+    text_type = unicode
     from StringIO import StringIO
 
 import bson
@@ -0,0 +1,275 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Willow Garage, Inc. nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Selection of the JSON library used by rosbridge.
+
+Several JSON libraries may be installed, which differ in speed and in how
+they treat NaN, unicode, large integers and floats.  At import, every
+installed library is checked for the behaviour rosbridge depends on, and the
+first correct encoder and decoder in the order of backend_names are chosen.
+The choice can be overridden with use(), which also picks the fastest
+correct backends on request.  These are found by measuring each backend on a
+typical rosbridge message, which takes a moment, so it is not done by
+default.
+"""
+
+import math
+import sys
+import time
+
+python2 = sys.version_info < (3, 0)
+
+if python2:
+    text_types = (str, unicode)
+else:
+    text_types = (str,)
+
+# Candidates in order of preference, roughly the fastest first
+backend_names = ["orjson", "rapidjson", "ujson", "simplejson", "json"]
+
+# Time in seconds to measure each encoder and decoder for
+benchmark_duration = 0.05
+
+
+class JsonBackend(object):
+    """ The dumps and loads functions of a JSON library """
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return "<JsonBackend %s>" % self.name
+
+
+class Json(object):
+    """ Serializes with the chosen encoder and deserializes with the chosen
+    decoder.  Modules import the single instance json, which use() updates
+    in place. """
+
+    def __init__(self, encoder, decoder):
+        self.use_backends(encoder, decoder)
+
+    def use_backends(self, encoder, decoder):
+        self.encoder = encoder
+        self.decoder = decoder
+        self.dumps = encoder.dumps
+        self.loads = decoder.loads
+
+    def use(self, encoder_name, decoder_name=None):
+        """ Switches to the backends of the given names, which have to be
+        installed.  Raises ValueError otherwise.  The name "fastest" switches
+        to the fastest backends that pass the checks, see select(). """
+        if encoder_name == "fastest" and decoder_name is None:
+            self.use_backends(*select(fastest=True))
+            return
+        available = backends()
+        for name in (encoder_name, decoder_name or encoder_name):
+            if name not in available:
+                raise ValueError("Unknown or unavailable JSON backend: %s.  Available backends: %s"
+                                 % (name, sorted(available.keys())))
+        self.use_backends(available[encoder_name], available[decoder_name or encoder_name])
+
+    def __repr__(self):
+        return "<Json encoder=%s decoder=%s>" % (self.encoder.name, self.decoder.name)
+
+
+def _load_backend(name):
+    """ Returns the backend of the library name, or None if it is not
+    installed """
+    try:
+        if name == "orjson":
+            import orjson
+
+            def dumps(obj):
+                # orjson returns bytes, messages are sent as text
+                return orjson.dumps(obj).decode("utf-8")
+            return JsonBackend(name, dumps, orjson.loads)
+        if name == "rapidjson":
+            import rapidjson
+            return JsonBackend(name, rapidjson.dumps, rapidjson.loads)
+        if name == "ujson":
+            import ujson
+            return JsonBackend(name, ujson.dumps, ujson.loads)
+        if name == "simplejson":
+            import simplejson
+            return JsonBackend(name, simplejson.dumps, simplejson.loads)
+        if name == "json":
+            import json
+            return JsonBackend(name, json.dumps, json.loads)
+    except ImportError:
+        return None
+    raise ValueError("Unknown JSON backend: %s" % name)
+
+
+_backends = None
+
+
+def backends():
+    """ Returns the installed backends, by name """
+    global _backends
+    if _backends is None:
+        loaded = [(name, _load_backend(name)) for name in backend_names]
+        _backends = dict((name, backend) for name, backend in loaded if backend is not None)
+    return _backends
+
+
+def _roundtrip(backend, value):
+    return backend.loads(backend.dumps(value))
+
+
+def check_encoder(backend):
+    """ Returns the list of checks the dumps function of backend fails """
+    failed = []
+    reference = backends()["json"]
+    try:
+        if not isinstance(backend.dumps({"a": [1, 2.5, None, True]}), text_types):
+            failed.append("text output")
+    except Exception:
+        failed.append("text output")
+    try:
+        # NaN and infinity are converted to null before serialization, but
+        # must not fail a message if one slips through
+        backend.dumps([float("nan"), float("inf"), -float("inf")])
+    except Exception:
+        failed.append("nan")
+    try:
+        value = u"\u00fc\u20ac\U0001f600\n\"\\/"
+        if reference.loads(backend.dumps(value)) != value:
+            failed.append("unicode")
+        if python2 and reference.loads(backend.dumps(value.encode("utf-8"))) != value:
+            failed.append("utf-8 str")
+    except Exception:
+        failed.append("unicode")
+    try:
+        values = [2 ** 64 - 1, -2 ** 63, 2 ** 53 + 1]
+        if reference.loads(backend.dumps(values)) != values:
+            failed.append("large ints")
+    except Exception:
+        failed.append("large ints")
+    try:
+        values = [0.1, 1.0 / 3, 1e-300, 5e-324, 1.7976931348623157e308, 123456789.12345678, -0.0]
+        if reference.loads(backend.dumps(values)) != values:
+            failed.append("float precision")
+    except Exception:
+        failed.append("float precision")
+    return failed
+
+
+def check_decoder(backend):
+    """ Returns the list of checks the loads function of backend fails """
+    failed = []
+    reference = backends()["json"]
+    try:
+        if backend.loads(b'{"a": [1]}') != {"a": [1]}:
+            failed.append("bytes input")
+    except Exception:
+        failed.append("bytes input")
+    try:
+        values = backend.loads('[NaN, Infinity, -Infinity]')
+        if not math.isnan(values[0]) or values[1:] != [float("inf"), -float("inf")]:
+            failed.append("nan")
+    except Exception:
+        failed.append("nan")
+    try:
+        value = u"\u00fc\u20ac\U0001f600\n\"\\/"
+        if backend.loads(reference.dumps(value)) != value or backend.loads(u'"\\ud83d\\ude00"') != u"\U0001f600":
+            failed.append("unicode")
+    except Exception:
+        failed.append("unicode")
+    try:
+        values = [2 ** 64 - 1, -2 ** 63, 2 ** 53 + 1]
+        decoded = backend.loads(reference.dumps(values))
+        if decoded != values or not all(isinstance(value, (int, long) if python2 else int) for value in decoded):
+            failed.append("large ints")
+    except Exception:
+        failed.append("large ints")
+    try:
+        values = [0.1, 1.0 / 3, 1e-300, 5e-324, 1.7976931348623157e308, 123456789.12345678, -0.0]
+        if backend.loads(reference.dumps(values)) != values:
+            failed.append("float precision")
+    except Exception:
+        failed.append("float precision")
+    return failed
+
+
+def _sample_message():
+    """ Returns a message like the ones rosbridge usually sends """
+    return {"op": "publish", "topic": "/joint_states",
+            "msg": {"header": {"seq": 1234, "stamp": {"secs": 1500000000, "nsecs": 123456789},
+                               "frame_id": "base_link"},
+                    "name": ["joint_%d" % i for i in range(20)],
+                    "position": [0.001 * i - 0.5 for i in range(20)],
+                    "velocity": [0.25] * 20,
+                    "effort": [0.0] * 20,
+                    "ranges": [1.0 + i * 0.013 for i in range(200)]}}
+
+
+def _measure(function, argument, duration):
+    """ Returns the number of calls of function per second """
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in range(10):
+            function(argument)
+        calls += 10
+        elapsed = time.time() - start
+    return calls / elapsed
+
+
+def benchmark(backend, duration=None):
+    """ Returns the rates of dumps and loads of backend in calls per second """
+    duration = benchmark_duration if duration is None else duration
+    message = _sample_message()
+    serialized = backend.dumps(message)
+    return _measure(backend.dumps, message, duration), _measure(backend.loads, serialized, duration)
+
+
+def select(fastest=False):
+    """ Returns the first encoder and the first decoder in the order of
+    backend_names among the installed backends that pass the checks, or the
+    fastest of them if fastest is set.  The json module of the standard
+    library is used if no other backend does. """
+    available = backends()
+    installed = [available[name] for name in backend_names if name in available]
+    encoders = [backend for backend in installed if not check_encoder(backend)] or [available["json"]]
+    decoders = [backend for backend in installed if not check_decoder(backend)] or [available["json"]]
+    if not fastest:
+        return encoders[0], decoders[0]
+    rates = dict((backend.name, benchmark(backend)) for backend in set(encoders + decoders))
+    return (max(encoders, key=lambda backend: rates[backend.name][0]),
+            max(decoders, key=lambda backend: rates[backend.name][1]))
+
+
+json = Json(*select())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+""" Benchmarks for the conversion and serialization hot path of rosbridge.
+
+Measures extract_values, populate_instance, Protocol.serialize (JSON and
+BSON), Fragmentation.fragment and RosbridgeRDFProtocol.serialize over a set of
+representative messages and reports their throughput.  If tracemalloc is
+available (python 3, or the pytracemalloc backport), the memory allocated per
+operation is reported as well, as the peak of the memory traced during it.
+
+Does not need a running ROS master:
+
+    rosrun rosbridge_library benchmark_conversion.py
+    python benchmark_conversion.py --duration 2 --messages Image JointState
+"""
+from __future__ import print_function
+
+import argparse
+import math
+import sys
+import time
+from base64 import standard_b64encode
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from rosbridge_library.internal import message_conversion
+from rosbridge_library.internal import ros_loader
+from rosbridge_library.capabilities.fragmentation import Fragmentation
+from rosbridge_library.protocol import Protocol
+
+try:
+    from rosbridge_library.rosbridge_rdf_protocol import RosbridgeRDFProtocol
+except ImportError:
+    RosbridgeRDFProtocol = None
+
+
+def make_image():
+    msg = ros_loader.get_message_instance("sensor_msgs/Image")
+    msg.header.frame_id = "camera"
+    msg.height = 480
+    msg.width = 640
+    msg.encoding = "rgb8"
+    msg.step = msg.width * 3
+    msg.data = bytes(bytearray(i % 256 for i in range(msg.height * msg.step)))
+    return msg
+
+
+def make_point_cloud():
+    msg = ros_loader.get_message_instance("sensor_msgs/PointCloud2")
+    msg.header.frame_id = "lidar"
+    msg.height = 1
+    msg.width = 10000
+    for offset, name in enumerate(["x", "y", "z", "intensity"]):
+        field = ros_loader.get_message_instance("sensor_msgs/PointField")
+        field.name = name
+        field.offset = offset * 4
+        field.datatype = 7
+        field.count = 1
+        msg.fields.append(field)
+    msg.point_step = 16
+    msg.row_step = msg.width * msg.point_step
+    msg.data = bytes(bytearray(i % 256 for i in range(msg.row_step)))
+    msg.is_dense = True
+    return msg
+
+
+def make_laser_scan():
+    msg = ros_loader.get_message_instance("sensor_msgs/LaserScan")
+    msg.header.frame_id = "laser"
+    msg.angle_min = -math.pi
+    msg.angle_max = math.pi
+    msg.angle_increment = 2 * math.pi / 720
+    msg.range_min = 0.1
+    msg.range_max = 30.0
+    msg.ranges = [1.0 + (i % 100) * 0.1 for i in range(720)]
+    msg.intensities = [float(i % 50) for i in range(720)]
+    return msg
+
+
+def make_tf_message():
+    msg = ros_loader.get_message_instance("tf2_msgs/TFMessage")
+    for i in range(20):
+        transform = ros_loader.get_message_instance("geometry_msgs/TransformStamped")
+        transform.header.frame_id = "link_%d" % i
+        transform.child_frame_id = "link_%d" % (i + 1)
+        transform.transform.translation.x = 0.1 * i
+        transform.transform.rotation.w = 1.0
+        msg.transforms.append(transform)
+    return msg
+
+
+def make_joint_state():
+    msg = ros_loader.get_message_instance("sensor_msgs/JointState")
+    msg.name = ["joint_%d" % i for i in range(30)]
+    msg.position = [0.01 * i for i in range(30)]
+    msg.velocity = [0.1] * 30
+    msg.effort = [0.0] * 30
+    return msg
+
+
+def make_marker_array():
+    msg = ros_loader.get_message_instance("visualization_msgs/MarkerArray")
+    for i in range(100):
+        marker = ros_loader.get_message_instance("visualization_msgs/Marker")
+        marker.header.frame_id = "map"
+        marker.ns = "benchmark"
+        marker.id = i
+        marker.type = 4
+        marker.pose.orientation.w = 1.0
+        marker.scale.x = 0.05
+        marker.color.a = 1.0
+        for j in range(10):
+            point = ros_loader.get_message_instance("geometry_msgs/Point")
+            point.x = i + 0.1 * j
+            marker.points.append(point)
+        msg.markers.append(marker)
+    return msg
+
+
+messages = [("Image", make_image), ("PointCloud2", make_point_cloud), ("LaserScan", make_laser_scan),
+            ("TFMessage", make_tf_message), ("JointState", make_joint_state), ("MarkerArray", make_marker_array)]
+
+
+def make_protocol(protocol_class, **attributes):
+    protocol = protocol_class("benchmark")
+    for name, value in attributes.items():
+        setattr(protocol, name, value)
+    return protocol
+
+
+def get_operations(inst, fragment_size):
+    """ Returns the benchmarked operations for the message inst as a list of
+    (name, function, size in bytes) tuples """
+    values = message_conversion.extract_values(inst)
+    outgoing = {"op": "publish", "topic": "/benchmark", "msg": values}
+
+    json_protocol = make_protocol(Protocol)
+    bson_protocol = make_protocol(Protocol, bson_only_mode=True)
+    serialized = json_protocol.serialize(outgoing)
+
+    def populate():
+        message_conversion.populate_instance(values, type(inst)())
+
+    fragmentation = Fragmentation(json_protocol)
+
+    def fragment():
+        for _ in fragmentation.fragment_serialized(serialized, fragment_size):
+            pass
+
+    operations = [
+        ("extract_values", lambda: message_conversion.extract_values(inst), len(serialized)),
+        ("populate_instance", populate, len(serialized)),
+        ("serialize_json", lambda: json_protocol.serialize(outgoing), len(serialized)),
+        ("serialize_bson", lambda: bson_protocol.serialize(outgoing), len(bson_protocol.serialize(outgoing))),
+        ("fragment", fragment, len(serialized)),
+    ]
+    if RosbridgeRDFProtocol is not None:
+        rdf_protocol = make_protocol(RosbridgeRDFProtocol)
+        # serialize adds the JSON-LD context to the message it is given
+        operations.append(("serialize_rdf", lambda: rdf_protocol.serialize(dict(outgoing)), len(serialized)))
+    return operations
+
+
+def measure_time(function, duration):
+    """ Returns the number of calls of function per second, running it for
+    at least duration seconds """
+    function()
+    calls = 0
+    batch = 1
+    start = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in range(batch):
+            function()
+        calls += batch
+        batch *= 2
+        elapsed = time.time() - start
+    return calls / elapsed
+
+
+def measure_allocations(function, calls=5):
+    """ Returns the average peak of memory allocated during a call of
+    function in bytes, or None if tracemalloc is not available """
+    if tracemalloc is None:
+        return None
+    function()
+    allocated = 0
+    for _ in range(calls):
+        # Restarting resets the peak
+        tracemalloc.start()
+        try:
+            function()
+            allocated += tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return allocated / float(calls)
+
+
+def run(message_names=None, operation_names=None, duration=1.0, fragment_size=65536, out=sys.stdout):
+    """ Runs the benchmarks and prints a row per message and operation.
+    Returns the results as a list of dicts. """
+    # The binary encoder is normally read from the parameter server
+    if message_conversion.binary_encoder is None:
+        message_conversion.binary_encoder = standard_b64encode
+
+    results = []
+    row = "%-12s %-18s %10s %12s %10s %14s"
+    print(row % ("message", "operation", "size [B]", "ops/s", "MB/s", "peak/op [KiB]"), file=out)
+    for message_name, make_message in messages:
+        if message_names and message_name not in message_names:
+            continue
+        inst = make_message()
+        for name, function, size in get_operations(inst, fragment_size):
+            if operation_names and name not in operation_names:
+                continue
+            rate = measure_time(function, duration)
+            allocated = measure_allocations(function)
+            results.append({"message": message_name, "operation": name, "size": size,
+                            "rate": rate, "allocated": allocated})
+            print(row % (message_name, name, size, "%.1f" % rate, "%.2f" % (rate * size / 1e6),
+                         "n/a" if allocated is None else "%.1f" % (allocated / 1024.0)), file=out)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", nargs="+", choices=[name for name, _ in messages],
+                        help="messages to benchmark, all by default")
+    parser.add_argument("--operations", nargs="+",
+                        choices=["extract_values", "populate_instance", "serialize_json", "serialize_bson",
+                                 "fragment", "serialize_rdf"],
+                        help="operations to benchmark, all by default")
+    parser.add_argument("--duration", type=float, default=1.0,
+                        help="minimum time in seconds to run each benchmark")
+    parser.add_argument("--fragment-size", type=int, default=65536,
+                        help="fragment size for the fragment benchmark")
+    args = parser.parse_args(argv)
+    run(args.messages, args.operations, args.duration, args.fragment_size)
+
+
+if __name__ == "__main__":
+    main()
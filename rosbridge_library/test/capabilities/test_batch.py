@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from rosbridge_library.protocol import Protocol
+from rosbridge_library.protocol import InvalidArgumentException, MissingArgumentException
+from rosbridge_library.capabilities.batch import Batch, join_serialized
+
+from json import dumps, loads
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_batch")
+
+    def test_missing_arguments(self):
+        proto = Protocol("hello")
+        batch = Batch(proto)
+        self.assertRaises(MissingArgumentException, batch.batch, {"op": "batch"})
+
+    def test_invalid_arguments(self):
+        proto = Protocol("hello")
+        batch = Batch(proto)
+        self.assertRaises(InvalidArgumentException, batch.batch, {"op": "batch", "ops": {}})
+
+    def test_batch(self):
+        proto = Protocol("test_batch")
+        Batch(proto)
+        received = []
+        errors = []
+
+        def fail(msg):
+            raise Exception("failed")
+
+        proto.register_operation("record", received.append)
+        proto.register_operation("fail", fail)
+        proto.log = lambda level, message, lid=None: errors.append(lid)
+
+        ops = [{"op": "record", "data": 1},
+               {"op": "fail", "id": "second"},
+               "not a message",
+               {"op": "batch", "id": "nested", "ops": []},
+               {"op": "unknown", "id": "fifth"},
+               {"op": "record", "data": 2}]
+        proto.incoming(dumps({"op": "batch", "id": "batch", "ops": ops}))
+
+        # All valid messages are processed in order, despite the errors
+        self.assertEqual([msg["data"] for msg in received], [1, 2])
+        self.assertEqual(errors, ["second", "batch", "nested", "fifth"])
+
+    def test_finish(self):
+        proto = Protocol("test_finish")
+        proto.add_capability(Batch)
+        self.assertIn("batch", proto.operations)
+        proto.finish()
+        self.assertNotIn("batch", proto.operations)
+
+    def test_join_serialized(self):
+        messages = [{"op": "publish", "topic": "/a", "msg": {"data": i}} for i in range(3)]
+        joined = loads(join_serialized([dumps(message) for message in messages]))
+        self.assertEqual(joined, {"op": "batch", "ops": messages})
+
+    def test_batch_window(self):
+        proto = Protocol("test_batch_window")
+        Batch(proto)
+        proto.incoming(dumps({"op": "batch", "ops": [], "batch_window": 5}))
+        self.assertEqual(proto.batch_window, 5)
+        proto.incoming(dumps({"op": "batch", "ops": [], "batch_window": 60000}))
+        self.assertEqual(proto.batch_window, proto.max_batch_window)
+        proto.incoming(dumps({"op": "batch", "ops": [], "batch_window": "5"}))
+        self.assertEqual(proto.batch_window, proto.max_batch_window)
+        proto.incoming(dumps({"op": "batch", "ops": [], "batch_window": 0}))
+        self.assertEqual(proto.batch_window, 0)
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_batch'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestBatch)
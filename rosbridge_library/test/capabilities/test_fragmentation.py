@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from rosbridge_library.protocol import Protocol
+from rosbridge_library.capabilities.fragmentation import Fragmentation
+from rosbridge_library.capabilities.defragmentation import Defragment
+from rosbridge_library.capabilities.subscribe import Subscribe
+from rosbridge_library.internal.json_streaming import StreamedMessage
+from rosbridge_library.internal.send_queue import SendQueue, MessageStream
+from rosbridge_library.util import bson, json
+
+from json import dumps, loads
+from std_msgs.msg import String
+
+
+class TestFragmentation(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_fragmentation")
+
+    def fragments(self, serialized, fragment_size, mid=None):
+        fragments = Fragmentation(Protocol("test_fragmentation")).fragment_serialized(
+            serialized, fragment_size, mid)
+        self.assertTrue(isinstance(fragments, MessageStream))
+        size = len(fragments)
+        count = fragments.count
+        result = list(fragments)
+        self.assertEqual(len(result), count)
+        self.assertEqual(sum(len(fragment) for fragment in result), size)
+        self.assertEqual(len(fragments), 0)
+        return result
+
+    def check_fragments(self, message, fragment_size, mid="message", ensure_ascii=True):
+        serialized = dumps(message, ensure_ascii=ensure_ascii)
+        fragments = self.fragments(serialized, fragment_size, mid)
+        self.assertTrue(len(fragments) > 1)
+        data = []
+        for num, fragment in enumerate(fragments):
+            self.assertTrue(len(fragment) <= fragment_size)
+            fragment = loads(fragment)
+            self.assertEqual(fragment["op"], "fragment")
+            self.assertEqual(fragment["id"], mid)
+            self.assertEqual(fragment["num"], num)
+            self.assertEqual(fragment["total"], len(fragments))
+            data.append(fragment["data"])
+        self.assertEqual(loads("".join(data)), message)
+
+    def test_fragment_size_includes_envelope(self):
+        message = {"op": "publish", "topic": "/test", "msg": {"data": list(range(500))}}
+        for fragment_size in [90, 100, 101, 1000]:
+            self.check_fragments(message, fragment_size)
+        self.check_fragments(message, 100, mid=12)
+
+    def test_escape_sequences(self):
+        # Every possible cut hits quotes, backslashes, control characters and
+        # surrogate pairs
+        text = u'"\\\n\t\x01\xe9\U0001f600' * 50
+        message = {"op": "publish", "topic": "/test", "msg": {"data": text}}
+        encoder, decoder = json.encoder, json.decoder
+        # The standard library escapes non-ASCII characters, and characters
+        # outside of the BMP as surrogate pairs
+        json.use("json")
+        try:
+            for fragment_size in range(85, 105):
+                self.check_fragments(message, fragment_size)
+                self.check_fragments(message, fragment_size, ensure_ascii=False)
+        finally:
+            json.use_backends(encoder, decoder)
+
+    def test_fragment_count(self):
+        serialized = dumps({"data": "x" * 10000})
+        fragments = self.fragments(serialized, 1000, "id")
+        self.assertEqual(len(fragments), 11)
+
+    def test_bson(self):
+        proto = Protocol("test_fragmentation")
+        proto.bson_only_mode = True
+        serialized = bson.BSON.encode({"op": "publish", "msg": {"data": list(range(200))}})
+        fragments = list(Fragmentation(proto).fragment_serialized(serialized, 200, "id"))
+        self.assertTrue(len(fragments) > 1)
+        data = []
+        for fragment in fragments:
+            self.assertTrue(len(fragment) <= 200)
+            data.append(bson.BSON(fragment).decode()["data"])
+        self.assertEqual(b"".join(data), serialized)
+
+    def test_send_fragments(self):
+        proto = Protocol("test_fragmentation")
+        proto.fragment_size = 100
+        sent = []
+        proto.outgoing = sent.append
+        message = {"op": "publish", "topic": "/test", "msg": {"data": list(range(100))}}
+        proto.send(message)
+        self.assertTrue(len(sent) > 1)
+        self.assertEqual(loads("".join(loads(fragment)["data"] for fragment in sent)), message)
+
+        # Transports that take streams produce the fragments as they send
+        del sent[:]
+        proto.outgoing_takes_streams = True
+        proto.send(message)
+        self.assertEqual(len(sent), 1)
+        self.assertTrue(isinstance(sent[0], MessageStream))
+
+    def test_send_streamed_fragments(self):
+        proto = Protocol("test_send_streamed_fragments")
+        proto.fragment_size = 100
+        self.assertTrue(proto.streams_messages())
+        sent = []
+        proto.outgoing = sent.append
+        subscribe = Subscribe(proto)
+
+        msg = String()
+        msg.data = u'"\\\n\xe9 streamed ' * 50
+        subscribe.publish("/test", StreamedMessage(msg))
+        self.assertTrue(len(sent) > 1)
+        for fragment in sent:
+            self.assertTrue(len(fragment) <= proto.fragment_size)
+        self.assertEqual(loads("".join(loads(fragment)["data"] for fragment in sent)),
+                         {"op": "publish", "topic": "/test", "msg": {"data": msg.data}})
+
+        # Produced as the transport sends them, like other fragments
+        del sent[:]
+        proto.outgoing_takes_streams = True
+        subscribe.publish("/test", StreamedMessage(msg))
+        self.assertEqual(len(sent), 1)
+        self.assertTrue(isinstance(sent[0], MessageStream))
+
+    def test_send_queue(self):
+        serialized = dumps({"data": "x" * 1000})
+        fragments = Fragmentation(Protocol("test_fragmentation")).fragment_serialized(
+            serialized, 200, "id")
+        count = fragments.count
+        size = len(fragments)
+
+        queue = SendQueue()
+        queue.push("first")
+        queue.push(fragments)
+        queue.push("last")
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.queued_bytes, len("first") + size + len("last"))
+
+        self.assertEqual(queue.pop(), ("first", None))
+        # Streams are not taken in batches
+        self.assertEqual(queue.pop_while(lambda message: True), [])
+        popped = [queue.pop()[0] for _ in range(count)]
+        self.assertEqual(sum(len(fragment) for fragment in popped), size)
+        self.assertEqual(queue.pop_while(lambda message: True), ["last"])
+        self.assertEqual(queue.queued_bytes, 0)
+        self.assertEqual(queue.stats()["sent"], count + 2)
+
+    def test_drop_stream(self):
+        fragments = Fragmentation(Protocol("test_fragmentation")).fragment_serialized(
+            dumps({"data": "x" * 1000}), 200, "id")
+        queue = SendQueue(max_messages=1)
+        queue.push(fragments)
+        size = len(fragments)
+        queue.push("newer")
+        self.assertEqual(queue.pop(), ("newer", None))
+        self.assertEqual(queue.stats()["dropped"], 1)
+        self.assertEqual(queue.stats()["dropped_bytes"], size)
+
+        # Once its first fragment is sent, the rest of a stream is kept
+        fragments = Fragmentation(Protocol("test_fragmentation")).fragment_serialized(
+            dumps({"data": "x" * 1000}), 200, "id")
+        queue.push(fragments)
+        queue.pop()
+        queue.push("newer")
+        popped = [entry[0] for entry in iter(queue.pop, None)]
+        self.assertEqual(len(popped), fragments.count)
+        self.assertEqual(popped[-1], "newer")
+
+    def test_defragment(self):
+        message = {"op": "record", "data": u"\xe9" * 1000}
+        fragments = self.fragments(dumps(message), 200, "id")
+
+        received = []
+        proto = Protocol("test_fragmentation")
+        proto.register_operation("record", received.append)
+        Defragment(proto)
+        for fragment in reversed(fragments):
+            proto.incoming(fragment)
+        self.assertEqual(received, [message])
+
+    def test_defragment_per_client(self):
+        received = []
+        protos = [Protocol("first"), Protocol("second")]
+        for proto in protos:
+            proto.register_operation("record", received.append)
+            Defragment(proto)
+        for n, proto in enumerate(protos):
+            serialized = dumps({"op": "record", "data": n})
+            proto.incoming(dumps({"op": "fragment", "id": 1, "num": 0, "total": 2,
+                                  "data": serialized[:10]}))
+        for n, proto in enumerate(protos):
+            serialized = dumps({"op": "record", "data": n})
+            proto.incoming(dumps({"op": "fragment", "id": 1, "num": 1, "total": 2,
+                                  "data": serialized[10:]}))
+        self.assertEqual([message["data"] for message in received], [0, 1])
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_fragmentation'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestFragmentation)
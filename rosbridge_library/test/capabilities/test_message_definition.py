@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from rosbridge_library.protocol import Protocol
+from rosbridge_library.protocol import InvalidArgumentException, MissingArgumentException
+from rosbridge_library.capabilities.message_definition import MessageDefinition
+from rosbridge_library.internal import ros_loader
+
+from json import dumps
+from std_msgs.msg import Header
+
+
+class TestMessageDefinition(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_message_definition")
+
+    def test_missing_arguments(self):
+        proto = Protocol("test_missing_arguments")
+        definition = MessageDefinition(proto)
+        msg = {"op": "get_message_definition"}
+        self.assertRaises(MissingArgumentException, definition.get_message_definition, msg)
+
+    def test_invalid_arguments(self):
+        proto = Protocol("test_invalid_arguments")
+        definition = MessageDefinition(proto)
+        msg = {"op": "get_message_definition", "type": 42}
+        self.assertRaises(InvalidArgumentException, definition.get_message_definition, msg)
+
+    def test_invalid_msg_type(self):
+        proto = Protocol("test_invalid_msg_type")
+        definition = MessageDefinition(proto)
+        msg = {"op": "get_message_definition", "type": "std_msgs/Nonexistent"}
+        self.assertRaises(ros_loader.InvalidClassException, definition.get_message_definition, msg)
+
+    def test_message_definition(self):
+        proto = Protocol("test_message_definition")
+        MessageDefinition(proto)
+
+        received = {"msg": None}
+
+        def cb(msg, cid=None):
+            received["msg"] = msg
+
+        proto.send = cb
+        proto.incoming(dumps({"op": "get_message_definition", "id": "definition",
+                              "type": "std_msgs/Header"}))
+
+        self.assertEqual(received["msg"], {"op": "message_definition", "id": "definition",
+                                           "type": "std_msgs/Header", "md5sum": Header._md5sum,
+                                           "definition": Header._full_text})
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_message_definition'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestMessageDefinition)
@@ -9,6 +9,9 @@ from json import loads, dumps
 from std_msgs.msg import String
 
 from rosbridge_library.capabilities import subscribe
+from rosbridge_library.internal import delta_encoding
+from rosbridge_library.internal.send_queue import SendQueue
+from rosbridge_library.internal.subscribers import SerializedMessage
 from rosbridge_library.protocol import Protocol
 from rosbridge_library.protocol import InvalidArgumentException, MissingArgumentException
 
@@ -63,6 +66,102 @@ class TestSubscribe(unittest.TestCase):
 
         subscription.unregister()
 
+    def test_delta(self):
+        sent = []
+
+        def publish(message, fragment_size=None, compression="none", delta=None, chained=None):
+            sent.append((message, delta))
+
+        subscription = subscribe.Subscription("client_test_delta", "/test_delta", publish)
+        subscription.subscribe("a", "std_msgs/String", delta=True, keyframe_interval=2)
+        self.assertTrue(subscription.delta)
+        self.assertEqual(subscription.keyframe_interval, 2)
+        try:
+            for i in range(4):
+                subscription._publish({"data": "message %d" % (i // 2), "index": i})
+            self.assertEqual(sent, [({"data": "message 0", "index": 0}, None),
+                                    ({"data": "message 0", "index": 1}, {"index": 1}),
+                                    ({"data": "message 1", "index": 2}, {"data": "message 1", "index": 2}),
+                                    ({"data": "message 1", "index": 3}, None)])
+
+            # New subscriptions start with a full message
+            del sent[:]
+            subscription.subscribe("b", "std_msgs/String", delta=True)
+            subscription._publish({"data": "message 2", "index": 4})
+            self.assertEqual(sent, [({"data": "message 2", "index": 4}, None)])
+
+            # Clients that did not ask for patches get full messages
+            del sent[:]
+            subscription.subscribe("c", "std_msgs/String")
+            self.assertFalse(subscription.delta)
+            subscription._publish({"data": "message 2", "index": 5})
+            self.assertEqual(sent, [({"data": "message 2", "index": 5}, None)])
+        finally:
+            subscription.unregister()
+
+    def test_delta_overflow(self):
+        proto = Protocol("test_delta_overflow")
+        queue = SendQueue(max_messages=3)
+        proto.outgoing = queue.push
+        proto.outgoing_takes_topic = True
+        sub = subscribe.Subscribe(proto)
+        topic = "/test_delta_overflow"
+        subscription = subscribe.Subscription(proto.client_id, topic, lambda *args, **kwargs:
+                                              sub.publish(topic, *args, **kwargs))
+        subscription.subscribe("a", "std_msgs/String", delta=True)
+
+        def receive(state):
+            # Applies the queued messages like a client would
+            for message in iter(queue.pop, None):
+                message = loads(message[0])
+                if "delta" in message:
+                    state = delta_encoding.apply(state, message["delta"])
+                else:
+                    state = message["msg"]
+                self.assertIn(state, published)
+            return state
+
+        published = []
+        try:
+            # The client does not read while the queue overflows
+            for i in range(10):
+                published.append({"data": "message %d" % i, "index": i})
+                subscription._publish(published[-1])
+            self.assertGreater(queue.stats()["dropped"], 0)
+            state = receive(None)
+            self.assertEqual(state, published[-1])
+
+            for i in range(10, 12):
+                published.append({"data": "message %d" % i, "index": i})
+                subscription._publish(published[-1])
+            self.assertEqual(receive(state), published[-1])
+        finally:
+            subscription.unregister()
+
+    def test_serialization_changed(self):
+        proto = Protocol("test_serialization_changed")
+        proto.allow_binary_attachments = True
+        proto.register_operation("noop", lambda msg: None)
+        sent = []
+        proto.outgoing = sent.append
+        sub = subscribe.Subscribe(proto)
+        proto.capabilities.append(sub)
+        topic = "/test_serialization_changed"
+        sub.subscribe({"op": "subscribe", "topic": topic, "type": "std_msgs/String"})
+        try:
+            self.assertFalse(sub._subscriptions[topic].options["binary_attachments"])
+            # The subscription follows the settings of the client
+            proto.incoming(dumps({"op": "noop", "binary_attachments": True}))
+            self.assertTrue(sub._subscriptions[topic].options["binary_attachments"])
+
+            # Messages serialized for other settings are not sent
+            sub.publish(topic, SerializedMessage('{"op": "publish"}', (Protocol, "stale")))
+            self.assertEqual(sent, [])
+            sub.publish(topic, SerializedMessage('{"op": "publish"}', sub.pool_serialization()))
+            self.assertEqual(sent, ['{"op": "publish"}'])
+        finally:
+            proto.finish()
+
     def test_missing_arguments(self):
         proto = Protocol("test_missing_arguments")
         sub = subscribe.Subscribe(proto)
@@ -91,6 +190,19 @@ class TestSubscribe(unittest.TestCase):
         msg = {"op": "subscribe", "topic": "/jon", "compression": 9000}
         self.assertRaises(InvalidArgumentException, sub.subscribe, msg)
 
+        msg = {"op": "subscribe", "topic": "/jon", "fields": [1]}
+        self.assertRaises(InvalidArgumentException, sub.subscribe, msg)
+
+        msg = {"op": "subscribe", "topic": "/jon", "fields": ["data", None]}
+        self.assertRaises(InvalidArgumentException, sub.subscribe, msg)
+
+        msg = {"op": "subscribe", "topic": "/jon", "encoding": "base64"}
+        self.assertRaises(InvalidArgumentException, sub.subscribe, msg)
+
+        # Raw messages can't be sent as JSON
+        msg = {"op": "subscribe", "topic": "/jon", "encoding": "raw"}
+        self.assertRaises(InvalidArgumentException, sub.subscribe, msg)
+
     def test_subscribe_works(self):
         proto = Protocol("test_subscribe_works")
         sub = subscribe.Subscribe(proto)
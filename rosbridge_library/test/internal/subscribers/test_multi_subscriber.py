@@ -5,6 +5,7 @@ import rostest
 import unittest
 from rosgraph import Master
 
+from io import BytesIO
 from time import sleep, time
 
 from rosbridge_library.internal.subscribers import *
@@ -180,6 +181,77 @@ class TestMultiSubscriber(unittest.TestCase):
         self.assertEqual(msg.data, received["msg1"]["data"])
         self.assertEqual(msg.data, received["msg2"]["data"])
 
+    def test_conversion_variants(self):
+        topic = "/test_conversion_variants"
+        msg_type = "std_msgs/String"
+        client1 = "client_test_conversion_variants_1"
+        client2 = "client_test_conversion_variants_2"
+
+        msg = String()
+        msg.data = "dsajfadsufasdjf"
+
+        pub = rospy.Publisher(topic, String)
+        multi = MultiSubscriber(topic, msg_type)
+
+        received = {"msg1": None, "msg2": None}
+
+        def cb1(msg):
+            received["msg1"] = msg
+
+        def cb2(msg):
+            received["msg2"] = msg
+
+        # One ROS subscriber converts messages once per set of options
+        multi.subscribe(client1, cb1)
+        multi.subscribe(client2, cb2, options={"add_ros_type_to_message": True})
+        self.assertEqual(len(multi.conversions), 2)
+        sleep(0.5)
+        pub.publish(msg)
+        sleep(0.5)
+        self.assertEqual(msg.data, received["msg1"]["data"])
+        self.assertFalse("@rostype" in received["msg1"])
+        self.assertEqual(msg.data, received["msg2"]["data"])
+        self.assertEqual("std_msgs/String", received["msg2"]["@rostype"])
+
+        self.assertFalse(multi.unsubscribe(client2, options={"fields": ("data",)}))
+        multi.unsubscribe(client2, options={"add_ros_type_to_message": True})
+        self.assertEqual(len(multi.conversions), 1)
+        self.assertFalse(multi.has_client_id(client2))
+
+    def test_raw_subscription(self):
+        topic = "/test_raw_subscription"
+        msg_type = "std_msgs/String"
+        client1 = "client_test_raw_subscription_1"
+        client2 = "client_test_raw_subscription_2"
+
+        msg = String()
+        msg.data = "dsajfadsufasdjf"
+        buff = BytesIO()
+        msg.serialize(buff)
+
+        pub = rospy.Publisher(topic, String)
+        multi = MultiSubscriber(topic, msg_type)
+
+        received = {"msg1": None, "msg2": None}
+
+        def cb1(msg):
+            received["msg1"] = msg
+
+        def cb2(msg):
+            received["msg2"] = msg
+
+        # The subscriber switches to AnyMsg, and still converts messages
+        multi.subscribe(client1, cb1)
+        multi.subscribe(client2, cb2, options={"encoding": "raw"})
+        self.assertTrue(multi.raw)
+        sleep(0.5)
+        pub.publish(msg)
+        sleep(0.5)
+        self.assertEqual(msg.data, received["msg1"]["data"])
+        self.assertEqual(buff.getvalue(), received["msg2"].data)
+        self.assertEqual(String._type, received["msg2"].type)
+        self.assertEqual(String._md5sum, received["msg2"].md5sum)
+
 
 PKG = 'rosbridge_library'
 NAME = 'test_multi_subscriber'
@@ -5,11 +5,12 @@ import rostest
 import unittest
 from rosgraph import Master
 
+from threading import Thread
 from time import sleep
 
 from rosbridge_library.internal.subscribers import *
 from rosbridge_library.internal.topics import *
-from rosbridge_library.internal.message_conversion import FieldTypeMismatchException
+from rosbridge_library.internal.message_conversion import FieldTypeMismatchException, NonexistentFieldException
 from std_msgs.msg import String, Int32
 
 
@@ -183,6 +184,53 @@ class TestSubscriberManager(unittest.TestCase):
         sleep(0.5)
         self.assertEqual(msg.data, received["msg"]["data"])
 
+    def test_single_subscriber_for_options(self):
+        topic = "/test_single_subscriber_for_options"
+        msg_type = "std_msgs/String"
+        client1 = "client_test_single_subscriber_for_options_1"
+        client2 = "client_test_single_subscriber_for_options_2"
+        options = {"add_ros_type_to_message": True}
+
+        manager.subscribe(client1, topic, None, msg_type)
+        subscriber = manager._subscribers[topic]
+        manager.subscribe(client2, topic, None, msg_type, options=options)
+        self.assertTrue(manager._subscribers[topic] is subscriber)
+
+        manager.unsubscribe(client1, topic)
+        self.assertTrue(topic in manager._subscribers)
+        manager.unsubscribe(client2, topic, options=options)
+        self.assertFalse(topic in manager._subscribers)
+        self.assertFalse(self.is_topic_subscribed(topic))
+
+    def test_concurrent_subscribe(self):
+        topic = "/test_concurrent_subscribe"
+        msg_type = "std_msgs/String"
+        clients = ["client_test_concurrent_subscribe_%d" % i for i in range(5)]
+
+        threads = [Thread(target=manager.subscribe, args=(client, topic, None, msg_type))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        subscriber = manager._subscribers[topic]
+        for client in clients:
+            self.assertTrue(subscriber.has_client_id(client))
+
+        for client in clients:
+            manager.unsubscribe(client, topic)
+        self.assertFalse(topic in manager._subscribers)
+        self.assertFalse(self.is_topic_subscribed(topic))
+
+    def test_subscribe_nonexistent_field(self):
+        topic = "/test_subscribe_nonexistent_field"
+        msg_type = "std_msgs/String"
+        client = "client_test_subscribe_nonexistent_field"
+
+        self.assertRaises(NonexistentFieldException, manager.subscribe, client, topic, None,
+                          msg_type, options={"fields": ("nonexistent",)})
+        self.assertFalse(topic in manager._subscribers)
+
 
 PKG = 'rosbridge_library'
 NAME = 'test_subscriber_manager'
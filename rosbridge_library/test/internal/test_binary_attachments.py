@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from json import loads, dumps
+
+from rosbridge_library.internal import binary_attachments
+from rosbridge_library.internal import message_conversion as c
+from rosbridge_library.internal import ros_loader
+from rosbridge_library.protocol import Protocol
+
+
+class TestBinaryAttachments(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_binary_attachments")
+
+    def test_encode_decode(self):
+        data = bytes(bytearray(range(256))) * 4
+        msg = {"op": "publish", "topic": "/image",
+               "msg": {"height": 2, "data": binary_attachments.Attachment(data),
+                       "layers": [{"data": binary_attachments.Attachment(data[:300])}]}}
+        frame = binary_attachments.encode(msg, dumps)
+        self.assertIsInstance(frame, binary_attachments.BinaryFrame)
+        self.assertTrue(frame.startswith(binary_attachments.frame_magic))
+        # The shared message must not be modified
+        self.assertIsInstance(msg["msg"]["data"], binary_attachments.Attachment)
+
+        decoded = binary_attachments.decode(frame, loads)
+        self.assertEqual(decoded["topic"], "/image")
+        self.assertEqual(decoded["msg"]["height"], 2)
+        self.assertEqual(decoded["msg"]["data"], data)
+        self.assertEqual(decoded["msg"]["layers"][0]["data"], data[:300])
+
+    def test_no_attachments(self):
+        msg = {"op": "publish", "topic": "/floats", "msg": {"data": [1.0, 2.0]}}
+        self.assertIsNone(binary_attachments.encode(msg, dumps))
+
+    def test_extract_values(self):
+        inst = ros_loader.get_message_instance("sensor_msgs/Image")
+        inst.data = bytes(bytearray(range(256))) * 2
+        extracted = c.extract_values(inst, options={"binary_attachments": True})
+        self.assertIsInstance(extracted["data"], binary_attachments.Attachment)
+        self.assertEqual(extracted["data"].data, inst.data)
+
+        inst.data = inst.data[:binary_attachments.min_attachment_size - 1]
+        extracted = c.extract_values(inst, options={"binary_attachments": True})
+        self.assertEqual(extracted, c.extract_values(inst))
+
+    def test_negotiation(self):
+        data = bytes(bytearray(range(256))) * 2
+        msg = {"op": "publish", "topic": "/image", "msg": {"data": binary_attachments.Attachment(data)}}
+
+        proto = Protocol("test_negotiation")
+        proto.register_operation("noop", lambda msg: None)
+        proto.incoming(dumps({"op": "noop", "binary_attachments": True}))
+        self.assertFalse(proto.binary_attachments)
+
+        proto.allow_binary_attachments = True
+        proto.incoming(dumps({"op": "noop", "binary_attachments": True}))
+        self.assertTrue(proto.binary_attachments)
+        self.assertIsInstance(proto.serialize(msg), binary_attachments.BinaryFrame)
+
+        proto.incoming(dumps({"op": "noop", "binary_attachments": False}))
+        self.assertTrue(proto.binary_attachments)
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_binary_attachments'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestBinaryAttachments)
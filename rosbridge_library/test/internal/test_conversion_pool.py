@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+import os
+from io import BytesIO
+from json import loads
+from threading import Event
+from time import sleep
+
+from rosbridge_library.internal.conversion_pool import ConversionPool
+from rosbridge_library.internal.subscribers import convert_serialized, get_options_key
+from rosbridge_library.protocol import Protocol
+from std_msgs.msg import String
+
+
+def delayed(value, delay):
+    sleep(delay)
+    return value
+
+
+def failing(value):
+    raise ValueError(value)
+
+
+def dying():
+    os._exit(1)
+
+
+class TestConversionPool(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_conversion_pool")
+
+    def wait_for(self, pool):
+        for _ in range(100):
+            if pool.pending() == 0:
+                return
+            sleep(0.05)
+        self.fail("Jobs were not delivered")
+
+    def test_ordered_per_key(self):
+        pool = ConversionPool(4)
+        try:
+            received = {"a": [], "b": []}
+            # Earlier jobs take longer, but are delivered first
+            for i in range(4):
+                pool.submit("a", delayed, (i, 0.4 - 0.1 * i), received["a"].append)
+            pool.submit("b", delayed, ("b", 0), received["b"].append)
+            self.wait_for(pool)
+            self.assertEqual(received["a"], [0, 1, 2, 3])
+            self.assertEqual(received["b"], ["b"])
+        finally:
+            pool.terminate()
+
+    def test_failed_job(self):
+        pool = ConversionPool(2)
+        try:
+            received = []
+            pool.submit("a", failing, ("first",), received.append)
+            pool.submit("a", delayed, ("second", 0), received.append)
+            self.wait_for(pool)
+            # Later jobs are not held up by a failed one
+            self.assertEqual(received, ["second"])
+        finally:
+            pool.terminate()
+
+    def test_job_timeout(self):
+        pool = ConversionPool(2, job_timeout=0.5)
+        try:
+            received = []
+            pool.submit("a", dying, (), received.append)
+            pool.submit("a", delayed, (1, 0), received.append)
+            sleep(0.3)
+            # The result of the dead worker never arrives
+            self.assertEqual(received, [])
+            # The later job is delivered once the dead one timed out, without
+            # waiting for more jobs of its key
+            self.wait_for(pool)
+            self.assertEqual(received, [1])
+            self.assertEqual(pool.timed_out, 1)
+        finally:
+            pool.terminate()
+
+    def test_max_pending(self):
+        pool = ConversionPool(1, max_pending=2)
+        try:
+            received = []
+            self.assertTrue(pool.submit("a", delayed, (1, 0.3), received.append))
+            self.assertTrue(pool.submit("a", delayed, (2, 0), received.append))
+            self.assertFalse(pool.submit("a", delayed, (3, 0), received.append))
+            self.assertTrue(pool.submit("b", delayed, (4, 0), received.append))
+            self.assertEqual(pool.dropped, 1)
+            self.wait_for(pool)
+            self.assertEqual(sorted(received), [1, 2, 4])
+        finally:
+            pool.terminate()
+
+    def test_convert_serialized(self):
+        msg = String()
+        msg.data = "dsajfadsufasdjf"
+        buff = BytesIO()
+        msg.serialize(buff)
+
+        serialization = (Protocol, Protocol("test_convert_serialized").serialization_key())
+        keys = [get_options_key({"serialization": serialization}),
+                get_options_key({"serialization": serialization, "add_ros_type_to_message": True})]
+        results = convert_serialized("/test_convert_serialized", "std_msgs/String", buff.getvalue(), keys)
+
+        self.assertEqual(loads(results[0]), {"op": "publish", "topic": "/test_convert_serialized",
+                                             "msg": {"data": msg.data}})
+        self.assertEqual(loads(results[1])["msg"]["@rostype"], "std_msgs/String")
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_conversion_pool'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestConversionPool)
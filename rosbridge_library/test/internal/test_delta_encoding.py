@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from json import loads, dumps
+
+from rosbridge_library.internal import delta_encoding
+
+
+class TestDeltaEncoding(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_delta_encoding")
+
+    def check_roundtrip(self, old, new):
+        # Patches have to survive serialization
+        patch = loads(dumps(delta_encoding.diff(old, new)))
+        self.assertEqual(delta_encoding.apply(old, patch), new)
+        return patch
+
+    def test_nested_fields(self):
+        old = {"header": {"seq": 1, "stamp": {"secs": 5, "nsecs": 0}, "frame_id": "map"},
+               "info": {"width": 10, "height": 10}}
+        new = {"header": {"seq": 2, "stamp": {"secs": 5, "nsecs": 0}, "frame_id": "map"},
+               "info": {"width": 10, "height": 10}}
+        patch = self.check_roundtrip(old, new)
+        self.assertEqual(patch, {"header": {"seq": 2}})
+        self.assertEqual(old["header"]["seq"], 1)
+        self.assertEqual(delta_encoding.diff(new, new), {})
+
+    def test_array_ranges(self):
+        old = {"data": list(range(1000))}
+        new = {"data": list(range(1000))}
+        new["data"][3] = -1
+        new["data"][500:510] = [-1] * 10
+        patch = self.check_roundtrip(old, new)
+        self.assertEqual(patch["data"]["length"], 1000)
+        self.assertEqual(patch["data"]["ranges"], [{"start": 3, "values": [-1]},
+                                                   {"start": 500, "values": [-1] * 10}])
+
+        new["data"] = new["data"][:900] + [7] * 10
+        self.check_roundtrip(old, new)
+
+        new["data"] = [-1] * 1000
+        patch = self.check_roundtrip(old, new)
+        self.assertEqual(patch["data"], new["data"])
+
+    def test_message_arrays(self):
+        old = {"status": [{"name": "a", "level": 0}, {"name": "b", "level": 0}] * 100}
+        new = {"status": [dict(x) for x in old["status"]]}
+        new["status"][101]["level"] = 2
+        patch = self.check_roundtrip(old, new)
+        self.assertEqual(patch["status"]["ranges"], [{"start": 101, "values": [{"name": "b", "level": 2}]}])
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_delta_encoding'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestDeltaEncoding)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from rosbridge_library.util import json_backends
+from rosbridge_library.util.json_backends import JsonBackend, Json
+
+
+class TestJsonBackends(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_json_backends")
+
+    def test_standard_library(self):
+        backend = json_backends.backends()["json"]
+        self.assertEqual(json_backends.check_encoder(backend), [])
+        self.assertEqual(json_backends.check_decoder(backend), [])
+
+    def test_checks(self):
+        import json
+
+        def lossy_dumps(obj):
+            # Like old versions of ujson, which only kept 10 digits
+            if isinstance(obj, list):
+                obj = [round(x, 10) if isinstance(x, float) else x for x in obj]
+            return json.dumps(obj)
+        self.assertEqual(json_backends.check_encoder(JsonBackend("lossy", lossy_dumps, json.loads)),
+                         ["float precision"])
+
+        def strict_dumps(obj):
+            return json.dumps(obj, allow_nan=False)
+        self.assertEqual(json_backends.check_encoder(JsonBackend("strict", strict_dumps, json.loads)), ["nan"])
+
+        if sys.version_info >= (3, 0):
+            def bytes_dumps(obj):
+                return json.dumps(obj).encode("utf-8")
+            self.assertIn("text output", json_backends.check_encoder(JsonBackend("bytes", bytes_dumps, json.loads)))
+
+        def float_loads(s):
+            return json.loads(s, parse_int=float)
+        self.assertEqual(json_backends.check_decoder(JsonBackend("float", json.dumps, float_loads)),
+                         ["large ints"])
+
+    def test_select(self):
+        encoder, decoder = json_backends.select()
+        self.assertEqual(json_backends.check_encoder(encoder), [])
+        self.assertEqual(json_backends.check_decoder(decoder), [])
+        self.assertEqual(decoder.loads(encoder.dumps({"a": [1, 0.1, u"\u00fc"]})), {"a": [1, 0.1, u"\u00fc"]})
+        # The choice does not depend on timing
+        self.assertEqual(json_backends.select(), (encoder, decoder))
+
+    def test_benchmark(self):
+        dumps_rate, loads_rate = json_backends.benchmark(json_backends.backends()["json"], 0.001)
+        self.assertGreater(dumps_rate, 0)
+        self.assertGreater(loads_rate, 0)
+
+    def test_use(self):
+        backends = json_backends.backends()
+        json = Json(backends["json"], backends["json"])
+        self.assertRaises(ValueError, json.use, "xml")
+        self.assertEqual(json.encoder.name, "json")
+
+        name = sorted(backends.keys())[0]
+        json.use(name, "json")
+        self.assertIs(json.encoder, backends[name])
+        self.assertIs(json.dumps, backends[name].dumps)
+        self.assertIs(json.loads, backends["json"].loads)
+
+    def test_use_fastest(self):
+        backends = json_backends.backends()
+        json = Json(backends["json"], backends["json"])
+        json.use("fastest")
+        self.assertEqual(json_backends.check_encoder(json.encoder), [])
+        self.assertEqual(json_backends.check_decoder(json.decoder), [])
+        self.assertIs(json.dumps, json.encoder.dumps)
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_json_backends'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestJsonBackends)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+import time
+
+from json import loads, dumps
+
+from rosbridge_library.internal.json_framer import JsonFramer
+from rosbridge_library.protocol import Protocol
+
+
+class TestJsonFramer(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_json_framer")
+
+    def test_split_objects(self):
+        msgs = [{"op": "publish", "msg": {"data": "{\"not\": }} a brace \\ {"}},
+                {"op": "subscribe", "topic": "/a", "nested": [{"b": {}}, "}"]},
+                {"op": "advertise", "topic": "\\\\\"}"}]
+        stream = "".join(dumps(msg) for msg in msgs)
+        # Feeding any split of the stream, down to single characters, yields the same objects
+        for size in [1, 2, 3, 7, len(stream)]:
+            framer = JsonFramer()
+            objects = []
+            for i in range(0, len(stream), size):
+                objects.extend(framer.feed(stream[i:i + size]))
+            self.assertEqual([loads(x) for x in objects], msgs)
+            self.assertEqual(framer.pending(), 0)
+
+    def test_garbage(self):
+        framer = JsonFramer()
+        objects = framer.feed('garbage } ] {"op": "a"}\n more garbage {"op": "b"} {"op"')
+        self.assertEqual([loads(x) for x in objects], [{"op": "a"}, {"op": "b"}])
+        self.assertEqual(framer.discarded, len("garbage } ]") + len("more garbage"))
+        self.assertEqual(framer.feed(': "c"}'), ['{"op": "c"}'])
+
+    def test_large_partial_message(self):
+        framer = JsonFramer()
+        stream = dumps({"op": "publish", "msg": {"data": ["{}" * 10] * 50000}})
+        start = time.time()
+        objects = []
+        for i in range(0, len(stream), 4096):
+            objects.extend(framer.feed(stream[i:i + 4096]))
+        self.assertEqual(objects, [stream])
+        self.assertLess(time.time() - start, 5.0)
+
+    def test_protocol_incoming(self):
+        received = []
+        proto = Protocol("test_protocol_incoming")
+        proto.register_operation("test", received.append)
+        stream = dumps({"op": "test", "data": 1}) + " " + dumps({"op": "test", "data": "{"})
+        for i in range(0, len(stream), 5):
+            proto.incoming(stream[i:i + 5])
+        proto.incoming(dumps({"op": "test", "data": 3}))
+        self.assertEqual([msg["data"] for msg in received], [1, "{", 3])
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_json_framer'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestJsonFramer)
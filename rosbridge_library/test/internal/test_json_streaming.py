@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from json import loads, dumps
+
+from rosbridge_library.internal import json_streaming
+from rosbridge_library.internal import message_conversion as c
+from rosbridge_library.internal import ros_loader
+from rosbridge_library.protocol import Protocol
+
+
+class TestJsonStreaming(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_json_streaming")
+
+    def get_instances(self):
+        joint_state = ros_loader.get_message_instance("sensor_msgs/JointState")
+        joint_state.header.frame_id = u"b\u00e4se \"link\""
+        joint_state.name = ["a", "b", "c"]
+        joint_state.position = [0.5, float("nan"), 1e300]
+        joint_state.velocity = [0.25] * 300
+        joint_state.effort = [float("inf")] * 300
+
+        pose_array = ros_loader.get_message_instance("geometry_msgs/PoseArray")
+        pose_array.poses = [ros_loader.get_message_instance("geometry_msgs/Pose") for _ in range(3)]
+        pose_array.poses[1].position.x = 3.0
+
+        image = ros_loader.get_message_instance("sensor_msgs/Image")
+        image.encoding = "mono8"
+        image.data = bytes(bytearray(range(256)))
+
+        return [joint_state, pose_array, image, ros_loader.get_message_instance("std_msgs/Empty"),
+                ros_loader.get_message_instance("std_msgs/Time")]
+
+    def test_same_values(self):
+        for inst in self.get_instances():
+            for options in [None, {"add_ros_type_to_inst": True}]:
+                msg = {"op": "publish", "topic": "/test", "msg": json_streaming.StreamedMessage(inst, options)}
+                self.assertTrue(json_streaming.is_streamed(msg))
+                expected = {"op": "publish", "topic": "/test", "msg": c.extract_values(inst, options)}
+                self.assertEqual(loads(json_streaming.dumps(msg)), loads(dumps(expected)))
+                self.assertEqual(json_streaming.extract_values(msg), expected)
+
+    def test_chunks(self):
+        for inst in self.get_instances():
+            msg = {"op": "publish", "topic": "/test", "msg": json_streaming.StreamedMessage(inst)}
+            chunks = json_streaming.dump_chunks(msg, 64)
+            self.assertEqual("".join(chunks), json_streaming.dumps(msg))
+            for chunk in chunks[:-1]:
+                self.assertEqual(len(chunk), 64)
+            self.assertTrue(0 < len(chunks[-1]) <= 64)
+
+    def test_protocol_fragments(self):
+        inst = self.get_instances()[0]
+        sent = []
+        proto = Protocol("test_protocol_fragments")
+        proto.outgoing = sent.append
+        proto.fragment_size = 500
+        proto.send({"op": "publish", "topic": "/test", "msg": json_streaming.StreamedMessage(inst)})
+
+        fragments = [loads(x) for x in sent]
+        self.assertTrue(len(fragments) > 1)
+        for num, fragment in enumerate(fragments):
+            self.assertEqual(fragment["op"], "fragment")
+            self.assertEqual(fragment["num"], num)
+            self.assertEqual(fragment["total"], len(fragments))
+        reassembled = loads("".join(fragment["data"] for fragment in fragments))
+        self.assertEqual(reassembled["msg"], loads(dumps(c.extract_values(inst))))
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_json_streaming'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestJsonStreaming)
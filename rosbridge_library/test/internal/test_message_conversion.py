@@ -107,6 +107,30 @@ class TestMessageConversion(unittest.TestCase):
                 self.assertEqual(c._from_inst(msg, rostype), None)
                 self.assertEqual(dumps({"data":c._from_inst(msg, rostype)}), "{\"data\": null}")
 
+    def test_float_array_special_cases(self):
+        for length in [3, c.numpy_min_array_length * 2]:
+            values = [0.5, float('nan'), 1e9999999, -1e9999999] * length
+            expected = [0.5, None, None, None] * length
+            for rostype in ["float32[]", "float64[]"]:
+                self.assertEqual(c._from_inst(values, rostype), expected)
+                self.assertEqual(c._from_inst(tuple(values), rostype), expected)
+                finite = [0.25 * i for i in range(length)]
+                self.assertEqual(c._from_inst(finite, rostype), finite)
+
+    def test_primitive_arrays(self):
+        for rostype in ["float32[]", "float64[]"]:
+            values = [0.5 * i for i in range(1000)] + [1, 2, 3]
+            self.assertEqual(c._to_inst(values, rostype, rostype), values)
+            self.assertEqual(c._to_inst(tuple(values), rostype, rostype), values)
+            self.assertRaises(c.FieldTypeMismatchException, c._to_inst, values + ["4"], rostype, rostype)
+            self.assertRaises(c.FieldTypeMismatchException, c._to_inst, values + [True], rostype, rostype)
+        for rostype in ["int32[]", "uint64[]"]:
+            self.assertEqual(c._to_inst(list(range(100)), rostype, rostype), list(range(100)))
+            self.assertRaises(c.FieldTypeMismatchException, c._to_inst, [1, 2.5], rostype, rostype)
+        self.assertEqual(c._to_inst([True, False], "bool[]", "bool[]"), [True, False])
+        self.assertRaises(c.FieldTypeMismatchException, c._to_inst, [True, 0], "bool[]", "bool[]")
+        self.assertEqual(c._to_inst(["a", "b"], "string[]", "string[]"), ["a", "b"])
+
     def test_signed_int_base_msgs(self):
         int8s = range(-127, 128)
         for int8 in int8s:
@@ -242,6 +266,61 @@ class TestMessageConversion(unittest.TestCase):
             c.populate_instance(msg, inst2)
             self.assertEqual(inst, inst2)
 
+    def test_converter_cache(self):
+        rostype = "sensor_msgs/JointState"
+        msg = {"name": ["a", "b"], "position": [1.0, 2.0], "velocity": [], "effort": []}
+        inst = ros_loader.get_message_instance(rostype)
+        c.populate_instance(msg, inst)
+        converter = c._get_from_converter(rostype)
+        self.assertIs(converter, c._get_from_converter(rostype))
+        first = c.extract_values(inst)
+        self.assertIn(type(inst), c._from_object_plans)
+        self.assertEqual(first, c.extract_values(inst))
+
+        extracted = c.extract_values(inst, options={"add_ros_type_to_inst": True})
+        self.assertEqual(extracted[c.ros_type_field_name], rostype)
+        self.assertEqual(extracted["header"][c.ros_type_field_name], "std_msgs/Header")
+
+    def test_decoder_cache(self):
+        rostype = "geometry_msgs/PoseArray"
+        msg = {"poses": [{"position": {"x": 1.0, "y": 2.0, "z": 3.0}},
+                         {"orientation": {"x": 0.0, "y": 0.0, "z": 0.0, "w": 1.0}}]}
+        self.assertIs(c._get_to_decoder(rostype), c._get_to_decoder(rostype))
+        for _ in range(2):
+            inst = ros_loader.get_message_instance(rostype)
+            c.populate_instance(msg, inst)
+            self.validate_instance(inst)
+            self.assertEqual(inst.poses[0].position.z, 3.0)
+            self.assertEqual(inst.poses[1].orientation.w, 1.0)
+        self.assertIn(type(inst), c._to_object_plans)
+
+        inst = ros_loader.get_message_instance(rostype)
+        bad_msg = {"poses": [{"position": {"x": "one"}}]}
+        self.assertRaises(c.FieldTypeMismatchException, c.populate_instance, bad_msg, inst)
+        bad_msg = {"poses": [{"position": {"w": 1.0}}]}
+        self.assertRaises(c.NonexistentFieldException, c.populate_instance, bad_msg, inst)
+
+    def test_field_projection(self):
+        rostype = "geometry_msgs/PoseArray"
+        msg = {"header": {"seq": 3, "stamp": {"secs": 1, "nsecs": 2}, "frame_id": "map"},
+               "poses": [{"position": {"x": 1.0, "y": 2.0, "z": 3.0}},
+                         {"orientation": {"x": 0.0, "y": 0.0, "z": 0.0, "w": 1.0}}]}
+        inst = ros_loader.get_message_instance(rostype)
+        c.populate_instance(msg, inst)
+
+        fields = ["poses.position", "header.stamp", "poses.position.x"]
+        extracted = c.extract_values(inst, options={"fields": fields})
+        self.assertEqual(extracted, {"header": {"stamp": {"secs": 1, "nsecs": 2}},
+                                     "poses": [{"position": {"x": 1.0, "y": 2.0, "z": 3.0}},
+                                               {"position": {"x": 0.0, "y": 0.0, "z": 0.0}}]})
+        self.assertIs(c.get_projection(type(inst), fields), c.get_projection(type(inst), reversed(fields)))
+
+        extracted = c.extract_values(inst, options={"fields": ["header"]})
+        self.assertEqual(extracted, {"header": c.extract_values(inst.header)})
+
+        for fields in [["nope"], ["header.stamp.secs"], ["poses.position.w"]]:
+            self.assertRaises(c.NonexistentFieldException, c.get_projection, type(inst), fields)
+
     def test_int8array(self):
         def test_int8_msg(rostype, data):
             msg = {"data": data}
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+import time
+
+from json import loads, dumps
+
+from rosbridge_library.internal.outgoing_queue import OutgoingQueue
+from rosbridge_library.protocol import Protocol
+
+
+class TestOutgoingQueue(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_outgoing_queue")
+
+    def test_pacing(self):
+        sent = []
+        queue = OutgoingQueue(lambda message: sent.append((time.time(), message)), 0.05)
+        start = time.time()
+        for i in range(5):
+            queue.push(i)
+        # Producers never wait for the interval
+        self.assertLess(time.time() - start, 0.05)
+        time.sleep(0.5)
+        queue.finish()
+
+        self.assertEqual([message for _, message in sent], list(range(5)))
+        for (previous, _), (current, _) in zip(sent, sent[1:]):
+            self.assertGreaterEqual(current - previous, 0.045)
+
+    def test_finish(self):
+        sent = []
+        queue = OutgoingQueue(sent.append, 10)
+        queue.push(1)
+        queue.push(2)
+        time.sleep(0.1)
+        queue.finish()
+        queue.join(1)
+        self.assertFalse(queue.is_alive())
+        self.assertEqual(sent, [1])
+
+    def test_send_errors(self):
+        sent = []
+        logged = []
+
+        def send(message):
+            if message == "fail":
+                raise ValueError(message)
+            if message == "closed":
+                raise IOError(message)
+            sent.append(message)
+
+        queue = OutgoingQueue(send, log=lambda level, message: logged.append(level),
+                              is_closed=lambda exc: isinstance(exc, IOError))
+        for message in ["fail", 1, "closed", 2]:
+            queue.push(message)
+        queue.join(1)
+        # Failed messages are logged and skipped, a closed client stops the queue
+        self.assertFalse(queue.is_alive())
+        self.assertEqual(sent, [1])
+        self.assertEqual(logged, ["error"])
+
+    def test_protocol_delay(self):
+        sent = []
+        proto = Protocol("test_protocol_delay")
+        proto.outgoing = sent.append
+        proto.send({"op": "test", "data": 0})
+        self.assertEqual(len(sent), 1)
+        self.assertIsNone(proto.outgoing_queue)
+
+        proto.delay_between_messages = 0.05
+        start = time.time()
+        for i in range(1, 4):
+            proto.send({"op": "test", "data": i})
+        self.assertLess(time.time() - start, 0.05)
+        time.sleep(0.5)
+
+        proto.delay_between_messages = 0
+        proto.send({"op": "test", "data": 4})
+        time.sleep(0.1)
+        self.assertEqual([loads(message)["data"] for message in sent], list(range(5)))
+        proto.finish()
+
+    def test_protocol_delay_order(self):
+        sent = []
+
+        def outgoing(message):
+            if loads(message)["data"] == 1:
+                # The transport is still writing this message when the next
+                # one is sent
+                time.sleep(0.1)
+            sent.append(message)
+
+        proto = Protocol("test_protocol_delay_order")
+        proto.outgoing = outgoing
+        proto.delay_between_messages = 0.01
+        proto.send({"op": "test", "data": 0})
+        time.sleep(0.05)
+        proto.send({"op": "test", "data": 1})
+        time.sleep(0.02)
+        proto.delay_between_messages = 0
+        proto.send({"op": "test", "data": 2})
+        time.sleep(0.2)
+        self.assertEqual([loads(message)["data"] for message in sent], [0, 1, 2])
+        proto.finish()
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_outgoing_queue'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestOutgoingQueue)
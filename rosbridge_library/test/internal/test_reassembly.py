@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from rosbridge_library.internal.reassembly import Reassembler, slot_bytes
+from rosbridge_library.internal.exceptions import InvalidArgumentException
+
+
+class TestReassembly(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_reassembly")
+
+    def test_out_of_order(self):
+        reassembler = Reassembler(10)
+        self.assertEqual(reassembler.add("a", 2, 3, "c", 0), None)
+        self.assertEqual(reassembler.add("a", 0, 3, "a", 0), None)
+        self.assertEqual(reassembler.add("a", 1, 3, "b", 0), "abc")
+        self.assertEqual(len(reassembler), 0)
+        self.assertEqual(reassembler.size, 0)
+
+    def test_interleaved_messages(self):
+        reassembler = Reassembler(10)
+        reassembler.add(1, 0, 2, b"x", 0)
+        reassembler.add(2, 0, 2, b"1", 0)
+        self.assertEqual(reassembler.add(2, 1, 2, b"2", 0), b"12")
+        self.assertEqual(reassembler.add(1, 1, 2, b"y", 0), b"xy")
+
+    def test_invalid_fragments(self):
+        reassembler = Reassembler(10)
+        self.assertRaises(InvalidArgumentException, reassembler.add, "a", 3, 3, "x", 0)
+        self.assertRaises(InvalidArgumentException, reassembler.add, "a", -1, 3, "x", 0)
+        self.assertRaises(InvalidArgumentException, reassembler.add, "a", 0, 0, "x", 0)
+        reassembler.add("a", 0, 3, "x", 0)
+        self.assertRaises(InvalidArgumentException, reassembler.add, "a", 0, 3, "x", 0)
+        self.assertRaises(InvalidArgumentException, reassembler.add, "a", 1, 4, "x", 0)
+        # The message is still completed by valid fragments
+        reassembler.add("a", 1, 3, "y", 0)
+        self.assertEqual(reassembler.add("a", 2, 3, "z", 0), "xyz")
+
+    def test_timeout(self):
+        logged = []
+        reassembler = Reassembler(10, log=lambda level, text, mid: logged.append(mid))
+        reassembler.add("old", 0, 2, "x", 0)
+        reassembler.add("kept", 0, 2, "x", 0)
+        reassembler.add("new", 0, 2, "x", 5)
+        # A fragment of a timed out message keeps it
+        self.assertEqual(reassembler.add("kept", 1, 2, "y", 11), "xy")
+        self.assertEqual(logged, ["old"])
+        self.assertEqual(list(reassembler.messages.keys()), ["new"])
+        reassembler.expire(16)
+        self.assertEqual(len(reassembler), 0)
+        self.assertEqual(reassembler.size, 0)
+
+    def test_memory_limit(self):
+        logged = []
+        limit = 3 * slot_bytes + 10
+        reassembler = Reassembler(10, limit, lambda level, text, mid: logged.append(mid))
+        reassembler.add("a", 0, 2, "12345", 0)
+        self.assertEqual(reassembler.size, 2 * slot_bytes + 5)
+        # Makes room by dropping the oldest message
+        reassembler.add("b", 0, 3, "xyz", 1)
+        self.assertEqual(logged, ["a"])
+        self.assertEqual(list(reassembler.messages.keys()), ["b"])
+        # A message that exceeds the limit on its own is dropped
+        self.assertRaises(InvalidArgumentException, reassembler.add, "b", 1, 3, "x" * 10, 2)
+        self.assertEqual(len(reassembler), 0)
+        self.assertEqual(reassembler.size, 0)
+        # Huge announced totals are refused before allocating
+        self.assertRaises(InvalidArgumentException, reassembler.add, "c", 0, 10 ** 9, "x", 3)
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_reassembly'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestReassembly)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from json import loads
+
+from rosbridge_library.internal.send_queue import SendQueue, MessageStream, Chained
+from rosbridge_library.protocol import Protocol
+
+
+def drain(queue):
+    messages = []
+    entry = queue.pop()
+    while entry is not None:
+        messages.append(entry[0])
+        entry = queue.pop()
+    return messages
+
+
+class ListStream(MessageStream):
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.count = len(self.messages)
+
+    def next(self):
+        if not self.messages:
+            raise StopIteration
+        return self.messages.pop(0)
+
+    def done(self):
+        return not self.messages
+
+    def __len__(self):
+        return sum(len(message) for message in self.messages)
+
+
+class TestSendQueue(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_send_queue")
+
+    def test_unbounded(self):
+        queue = SendQueue()
+        self.assertTrue(queue.push("a"))
+        self.assertFalse(queue.push("b"))
+        self.assertEqual(drain(queue), ["a", "b"])
+        # Draining the queue makes it idle again
+        self.assertTrue(queue.push("c"))
+
+    def test_drop_oldest(self):
+        queue = SendQueue(max_messages=3)
+        for message in "abcde":
+            queue.push(message)
+        self.assertEqual(drain(queue), ["c", "d", "e"])
+        stats = queue.stats()
+        self.assertEqual(stats["sent"], 3)
+        self.assertEqual(stats["dropped"], 2)
+        self.assertEqual(stats["dropped_bytes"], 2)
+        self.assertEqual(stats["max_queued"], 3)
+
+        queue = SendQueue(max_bytes=10)
+        for message in ["aaaa", "bbbb", "cccc"]:
+            queue.push(message)
+        self.assertEqual(drain(queue), ["bbbb", "cccc"])
+
+    def test_drop_newest(self):
+        queue = SendQueue(max_messages=2, policy="drop_newest")
+        for message in "abcd":
+            queue.push(message)
+        self.assertEqual(drain(queue), ["a", "b"])
+        self.assertEqual(queue.stats()["dropped"], 2)
+
+    def test_oversized(self):
+        # A message larger than the budget still gets through an empty queue
+        for policy in ["drop_oldest", "drop_newest", "latest_per_topic"]:
+            queue = SendQueue(max_bytes=4, policy=policy)
+            queue.push("abcdefgh")
+            self.assertEqual(drain(queue), ["abcdefgh"])
+
+    def test_started_stream(self):
+        queue = SendQueue(max_messages=2)
+        queue.push(ListStream(["f1", "f2", "f3"]))
+        self.assertEqual(queue.pop()[0], "f1")
+        # The rest of a partly sent stream is kept, the next entry is dropped
+        for message in "abc":
+            queue.push(message)
+        self.assertEqual(drain(queue), ["f2", "f3", "c"])
+        self.assertEqual(queue.stats()["dropped"], 2)
+
+        # A stream that has not started is dropped as a whole
+        queue.push(ListStream(["f1", "f2"]))
+        queue.push("a")
+        queue.push("b")
+        self.assertEqual(drain(queue), ["a", "b"])
+
+    def test_chained(self):
+        class Chain(object):
+            keyframes = 0
+
+            def request_keyframe(self):
+                self.keyframes += 1
+
+        # Patches following a dropped message are dropped until the next
+        # keyframe, which is asked for
+        for policy, expected, keyframes in [("drop_oldest", ["k2", "p3"], 1),
+                                            ("latest_per_topic", ["k2", "p3"], 1),
+                                            ("drop_newest", ["k1", "p1"], 2)]:
+            chain = Chain()
+            queue = SendQueue(max_messages=2, policy=policy)
+            queue.push("k1", Chained(chain, start=True))
+            queue.push("p1", Chained(chain))
+            queue.push("other", "/other")
+            queue.push("p2", Chained(chain))
+            queue.push("k2", Chained(chain, start=True))
+            queue.push("p3", Chained(chain))
+            self.assertEqual(drain(queue), expected, policy)
+            self.assertEqual(chain.keyframes, keyframes, policy)
+
+    def test_latest_per_topic(self):
+        queue = SendQueue(max_messages=3, policy="latest_per_topic")
+        queue.push("a1", "/a")
+        queue.push("b1", "/b")
+        queue.push("a2", "/a")
+        queue.push("status")
+        queue.push("b2", "/b")
+        # Messages keep the position of the message they replace
+        self.assertEqual(drain(queue), ["a2", "b2", "status"])
+        self.assertEqual(queue.stats()["dropped"], 2)
+
+        # Messages without a topic fall back to dropping the oldest
+        for i in range(5):
+            queue.push(str(i))
+        self.assertEqual(drain(queue), ["2", "3", "4"])
+
+        # A sent message is not replaced anymore
+        queue.push("a3", "/a")
+        self.assertEqual(drain(queue), ["a3"])
+        queue.push("a4", "/a")
+        self.assertEqual(drain(queue), ["a4"])
+
+    def test_pop_while(self):
+        queue = SendQueue()
+        for message in ["a", "b", "C", "d"]:
+            queue.push(message)
+        self.assertEqual(queue.pop_while(str.islower), ["a", "b"])
+        self.assertEqual(queue.pop_while(str.islower), [])
+        self.assertEqual(drain(queue), ["C", "d"])
+        self.assertEqual(queue.stats()["sent"], 4)
+
+        for message in ["e", "f", "g"]:
+            queue.push(message)
+        self.assertEqual(queue.pop_while(str.islower, 2), ["e", "f"])
+        self.assertEqual(drain(queue), ["g"])
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, SendQueue, policy="drop_all")
+
+    def test_clear(self):
+        queue = SendQueue()
+        queue.push("a", "/a")
+        queue.push("b")
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.stats()["dropped"], 2)
+        self.assertEqual(queue.stats()["queued_bytes"], 0)
+
+    def test_protocol_topics(self):
+        sent = []
+        proto = Protocol("test_protocol_topics")
+        proto.outgoing = lambda message, topic=None: sent.append((loads(message)["op"], topic))
+        proto.send({"op": "publish", "topic": "/a", "msg": {}})
+        proto.send({"op": "publish", "topic": "/a", "delta": {}})
+        proto.send({"op": "status", "level": "info", "msg": ""})
+        # Topics are only passed to transports asking for them
+        self.assertEqual(sent, [("publish", None), ("publish", None), ("status", None)])
+
+        del sent[:]
+        proto.outgoing_takes_topic = True
+        proto.send({"op": "publish", "topic": "/a", "msg": {}})
+        proto.send({"op": "publish", "topic": "/a", "delta": {}})
+        proto.send({"op": "status", "level": "info", "msg": ""})
+        # Deltas must never replace each other
+        self.assertEqual(sent, [("publish", "/a"), ("publish", None), ("status", None)])
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_send_queue'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestSendQueue)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from rosbridge_library.internal.serialization_cache import SerializationCache
+from rosbridge_library.internal.serialization_cache import cache as serialization_cache
+from rosbridge_library.protocol import Protocol
+
+
+class TestSerializationCache(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_serialization_cache")
+
+    def test_get_put(self):
+        cache = SerializationCache()
+        source = {"data": 1}
+        self.assertIsNone(cache.get(source, "key"))
+        # Messages taken by a single client are not cached
+        cache.share(source, 1)
+        cache.put(source, "key", "value")
+        self.assertIsNone(cache.get(source, "key"))
+        cache.share(source, 2)
+        cache.put(source, "key", "value")
+        self.assertEqual(cache.get(source, "key"), "value")
+        self.assertIsNone(cache.get(source, "other_key"))
+        self.assertIsNone(cache.get({"data": 1}, "key"))
+        cache.clear()
+        self.assertIsNone(cache.get(source, "key"))
+
+    def test_eviction(self):
+        cache = SerializationCache(max_entries=2)
+        sources = [{"data": i} for i in range(3)]
+        for source in sources:
+            cache.share(source, 2)
+            cache.put(source, "key", str(source["data"]))
+        self.assertIsNone(cache.get(sources[0], "key"))
+        self.assertEqual(cache.get(sources[1], "key"), "1")
+        self.assertEqual(cache.get(sources[2], "key"), "2")
+
+    def test_max_bytes(self):
+        cache = SerializationCache(max_bytes=10)
+        sources = [{"data": i} for i in range(3)]
+        for source in sources:
+            cache.share(source, 2)
+        cache.put(sources[0], "key", "x" * 11)
+        self.assertIsNone(cache.get(sources[0], "key"))
+        cache.put(sources[1], "key", "x" * 6)
+        cache.put(sources[2], "key", ["x" * 3, "x" * 3])
+        self.assertIsNone(cache.get(sources[1], "key"))
+        self.assertEqual(cache.get(sources[2], "key"), ["x" * 3, "x" * 3])
+        self.assertEqual(cache.size, 6)
+
+    def test_taken(self):
+        cache = SerializationCache()
+        source = {"data": 1}
+        cache.share(source, 2)
+        cache.put(source, "key", "value")
+        cache.taken(source)
+        self.assertEqual(cache.get(source, "key"), "value")
+        # Dropped once all clients took it
+        cache.taken(source)
+        self.assertIsNone(cache.get(source, "key"))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_shared_send(self):
+        sent = []
+        protocols = [Protocol("test_shared_send_%d" % i) for i in range(3)]
+        for protocol in protocols:
+            protocol.outgoing = sent.append
+        protocols[2].binary_attachments = True
+
+        message = {"data": "hello"}
+        serialization_cache.share(message, len(protocols))
+        for protocol in protocols:
+            outgoing_msg = {"op": "publish", "topic": "/shared", "msg": message}
+            protocol.send(outgoing_msg, shared_source=message, shared_key=("/shared", "none"))
+
+        self.assertEqual(len(sent), 3)
+        self.assertIs(sent[0], sent[1])
+        self.assertIsNot(sent[0], sent[2])
+        self.assertEqual(sent[0], sent[2])
+        self.assertEqual(len(serialization_cache), 0)
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_serialization_cache'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestSerializationCache)
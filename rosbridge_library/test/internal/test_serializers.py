@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from json import loads, dumps
+
+from rosbridge_library.internal import serializers
+from rosbridge_library.internal import message_conversion as c
+from rosbridge_library.internal import ros_loader
+from rosbridge_library.internal.binary_attachments import Attachment, BinaryFrame
+from rosbridge_library.protocol import Protocol
+from rosbridge_library.util import bson, text_type
+
+
+class TestSerializers(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_serializers")
+
+    def test_registry(self):
+        self.assertIs(serializers.get("json"), serializers.json_serializer)
+        self.assertIn("bson", serializers.names())
+        self.assertIsNone(serializers.get("xml"))
+
+    def test_typed_array(self):
+        array = serializers.TypedArray("int16", [1, -2, 300])
+        self.assertEqual(array.tag(), 77)
+        self.assertEqual(array.pack(), b"\x01\x00\xfe\xff\x2c\x01")
+        self.assertEqual(serializers.unpack_typed_array(77, array.pack()), [1, -2, 300])
+        self.assertIsNone(serializers.unpack_typed_array(1, b""))
+
+        array = serializers.TypedArray("float64", (0.5, float("inf")))
+        self.assertEqual(serializers.unpack_typed_array(86, array.pack()), [0.5, float("inf")])
+
+    def test_extract_values(self):
+        inst = ros_loader.get_message_instance("sensor_msgs/Image")
+        inst.data = b"\x01\x02\x03"
+        extracted = c.extract_values(inst, options={"native_binary": True})
+        self.assertIsInstance(extracted["data"], Attachment)
+        self.assertEqual(extracted["data"].data, inst.data)
+
+        inst = ros_loader.get_message_instance("sensor_msgs/JointState")
+        inst.name = ["a", "b"]
+        inst.position = [1.0, float("nan")]
+        extracted = c.extract_values(inst, options={"typed_arrays": True})
+        self.assertEqual(extracted["name"], ["a", "b"])
+        self.assertIsInstance(extracted["position"], serializers.TypedArray)
+        self.assertEqual(extracted["position"].rostype, "float64")
+        self.assertEqual(c.extract_values(inst)["position"], [1.0, None])
+
+    def test_negotiation(self):
+        proto = Protocol("test_negotiation")
+        proto.register_operation("noop", lambda msg: None)
+        proto.incoming(dumps({"op": "noop", "serializer": "xml"}))
+        self.assertIs(proto.serializer, serializers.json_serializer)
+
+        proto.incoming(dumps({"op": "noop", "serializer": "bson"}))
+        self.assertEqual(proto.serializer.name, "bson")
+        msg = {"op": "publish", "topic": "/test", "msg": {"data": "hello"}}
+        frame = proto.serialize(msg)
+        self.assertIsInstance(frame, BinaryFrame)
+        self.assertEqual(proto.deserialize(bytes(frame)), msg)
+        # Text messages are still JSON
+        self.assertEqual(proto.deserialize(u'{"op": "noop"}'), {"op": "noop"})
+
+        # The serializer can only be chosen once
+        self.assertFalse(proto.set_serializer("json"))
+        self.assertEqual(proto.serializer.name, "bson")
+
+    def test_undelimited_transport(self):
+        proto = Protocol("test_undelimited_transport")
+        proto.delimits_messages = False
+        self.assertFalse(proto.set_serializer("bson"))
+        self.assertIs(proto.serializer, serializers.json_serializer)
+
+    def check_roundtrip(self, name):
+        serializer = serializers.get(name)
+        inst = ros_loader.get_message_instance("sensor_msgs/JointState")
+        inst.name = ["a", "b"]
+        inst.position = [1.0, float("inf")]
+        options = {"native_binary": True, "typed_arrays": True}
+        msg = {"op": "publish", "topic": "/joints",
+               "msg": c.extract_values(inst, options=options)}
+        msg["msg"]["data"] = Attachment(b"\x00\xff")
+        msg["msg"]["blob"] = bson.binary.Binary(b"\x01\xfe")
+
+        frame = serializer.dumps(msg)
+        self.assertIsInstance(frame, BinaryFrame)
+        decoded = serializer.loads(bytes(frame))
+        self.assertEqual(decoded["topic"], "/joints")
+        self.assertEqual(decoded["msg"]["name"], ["a", "b"])
+        self.assertEqual(decoded["msg"]["position"], [1.0, float("inf")])
+        self.assertEqual(decoded["msg"]["data"], b"\x00\xff")
+        # Strings stay text and binary data stays bytes, on python 2 as well
+        self.assertIsInstance(decoded["msg"]["name"][0], text_type)
+        self.assertEqual(decoded["msg"]["blob"], b"\x01\xfe")
+
+    @unittest.skipIf(serializers.cbor2 is None, "cbor2 is not installed")
+    def test_cbor(self):
+        self.check_roundtrip("cbor")
+
+    @unittest.skipIf(serializers.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        self.check_roundtrip("msgpack")
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_serializers'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestSerializers)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+import sys
+import rospy
+import rostest
+import unittest
+
+from json import dumps
+
+from rosbridge_library.internal import stats
+from rosbridge_library.internal.send_queue import SendQueue
+from rosbridge_library.protocol import Protocol
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        rospy.init_node("test_stats")
+
+    def test_histogram(self):
+        histogram = stats.Histogram()
+        histogram.observe(0.00005)
+        histogram.observe(0.001)
+        histogram.observe(10)
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[stats.latency_buckets.index(0.001)], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+
+        other = stats.Histogram()
+        other.merge(histogram)
+        self.assertEqual(other.to_dict(), histogram.to_dict())
+
+    def test_protocol(self):
+        proto = Protocol("test_protocol")
+        proto.register_operation("noop", lambda msg: None)
+
+        def fail(msg):
+            raise Exception("failed")
+        proto.register_operation("fail", fail)
+        sent = []
+        proto.outgoing = sent.append
+
+        message = dumps({"op": "noop"})
+        proto.incoming(message)
+        proto.incoming(message)
+        proto.incoming(dumps({"op": "fail"}))
+        proto.send({"op": "publish", "topic": "/test", "msg": {"data": 1}})
+
+        snapshot = proto.stats.snapshot()
+        self.assertEqual(snapshot["client_id"], "test_protocol")
+        self.assertEqual(snapshot["ops"]["noop"]["count"], 2)
+        self.assertEqual(snapshot["ops"]["noop"]["errors"], 0)
+        self.assertEqual(snapshot["ops"]["noop"]["latency"]["count"], 2)
+        self.assertEqual(snapshot["ops"]["fail"]["errors"], 1)
+        self.assertEqual(snapshot["messages_in"], 3)
+        self.assertEqual(snapshot["bytes_in"], 2 * len(message) + len(dumps({"op": "fail"})))
+        self.assertEqual(snapshot["messages_out"], 1)
+        self.assertEqual(snapshot["bytes_out"], len(sent[0]))
+        self.assertEqual(snapshot["stages"]["serialize"]["count"], 1)
+        self.assertEqual(snapshot["stages"]["outgoing"]["count"], 1)
+        self.assertIn(proto.stats, stats.clients())
+
+    def test_received(self):
+        proto = Protocol("test_received")
+        proto.register_operation("noop", lambda msg: None)
+        message = dumps({"op": "noop"})
+        # Transports that delimit messages hand them over directly
+        proto.handle_message(message)
+        proto.handle_message("not json")
+        # Several messages, split across reads
+        proto.incoming(message + message[:5])
+        proto.incoming(message[5:])
+
+        snapshot = proto.stats.snapshot()
+        self.assertEqual(snapshot["messages_in"], 4)
+        self.assertEqual(snapshot["bytes_in"], 3 * len(message) + len("not json"))
+        self.assertEqual(snapshot["ops"]["noop"]["count"], 3)
+
+    def test_totals(self):
+        before, _ = stats.totals()
+        before_noop = before.ops.get("noop", [0, 0, None])[0]
+
+        proto = Protocol("test_totals")
+        proto.register_operation("noop", lambda msg: None)
+        queue = SendQueue(max_messages=1)
+        proto.stats.add_queue("send", queue)
+        queue.push("a")
+        queue.push("b")
+        proto.incoming(dumps({"op": "noop"}))
+
+        totals, queued = stats.totals()
+        self.assertEqual(totals.ops["noop"][0], before_noop + 1)
+        self.assertEqual(queued["send"][0], 1)
+
+        proto.finish()
+        self.assertNotIn(proto.stats, stats.clients())
+        totals, queued = stats.totals()
+        self.assertEqual(totals.ops["noop"][0], before_noop + 1)
+        self.assertEqual(totals.queues["send"]["dropped"], before.queues.get("send", {}).get("dropped", 0) + 1)
+
+        text = stats.prometheus_text()
+        self.assertIn('rosbridge_operations_total{op="noop"} %d' % (before_noop + 1), text)
+        self.assertIn('rosbridge_operation_duration_seconds_bucket{op="noop",le="+Inf"} %d' % (before_noop + 1),
+                      text)
+        self.assertIn("# TYPE rosbridge_send_stage_duration_seconds histogram", text)
+
+
+PKG = 'rosbridge_library'
+NAME = 'test_stats'
+if __name__ == '__main__':
+    rostest.unitrun(PKG, NAME, TestStats)
@@ -10,6 +10,9 @@ from rosbridge_library.capabilities.subscribe import Subscribe
 from rosbridge_library.capabilities.advertise_service import AdvertiseService
 from rosbridge_library.capabilities.unadvertise_service import UnadvertiseService
 from rosbridge_library.capabilities.call_service import CallService
+from rosbridge_library.internal import conversion_pool
+from rosbridge_library.internal.stats import StatsPublisher
+from rosbridge_library.util import json
 
 from functools import partial
 from signal import signal, SIGINT, SIG_DFL
@@ -33,6 +36,7 @@ def shutdown_hook(server):
 if __name__ == "__main__":
     loaded = False
     retry_count = 0
+    stats_publisher = None
     while not loaded:
         retry_count += 1
         print("trying to start rosbridge TCP server..")
@@ -59,13 +63,33 @@ if __name__ == "__main__":
             socket_timeout = get_param('~socket_timeout', RosbridgeTcpSocket.socket_timeout)
             retry_startup_delay = get_param('~retry_startup_delay', 5.0)  # seconds
             fragment_timeout = get_param('~fragment_timeout', RosbridgeTcpSocket.fragment_timeout)
+            max_fragment_bytes = get_param('~max_fragment_bytes', RosbridgeTcpSocket.max_fragment_bytes)
             delay_between_messages = get_param('~delay_between_messages', RosbridgeTcpSocket.delay_between_messages)
             max_message_size = get_param('~max_message_size', RosbridgeTcpSocket.max_message_size)
             unregister_timeout = get_param('~unregister_timeout', RosbridgeTcpSocket.unregister_timeout)
             bson_only_mode = get_param('~bson_only_mode', False)
+            allow_binary_attachments = get_param('~allow_binary_attachments', RosbridgeTcpSocket.allow_binary_attachments)
+            allow_length_prefixed_json = get_param('~allow_length_prefixed_json', RosbridgeTcpSocket.allow_length_prefixed_json)
+            max_send_queue_messages = get_param('~max_send_queue_messages', RosbridgeTcpSocket.max_send_queue_messages)
+            max_send_queue_bytes = get_param('~max_send_queue_bytes', RosbridgeTcpSocket.max_send_queue_bytes)
+            send_queue_policy = get_param('~send_queue_policy', RosbridgeTcpSocket.send_queue_policy)
+            allow_compression = get_param('~allow_compression', RosbridgeTcpSocket.allow_compression)
+            compression_level = get_param('~compression_level', RosbridgeTcpSocket.compression_level)
+            compression_window_bits = get_param('~compression_window_bits', RosbridgeTcpSocket.compression_window_bits)
+            compression_mem_level = get_param('~compression_mem_level', RosbridgeTcpSocket.compression_mem_level)
+            json_backend = get_param('~json_backend', 'auto')
+            conversion_processes = get_param('~conversion_processes', 0)
+            stats_topic = get_param('~stats_topic', '/rosbridge/stats')
+            stats_period = get_param('~stats_period', 0)
 
             if max_message_size == "None":
                 max_message_size = None
+            if max_send_queue_messages == "None":
+                max_send_queue_messages = None
+            if max_send_queue_bytes == "None":
+                max_send_queue_bytes = None
+            if max_fragment_bytes == "None":
+                max_fragment_bytes = None
 
             # Get the glob strings and parse them as arrays.
             RosbridgeTcpSocket.topics_glob = [
@@ -163,10 +187,27 @@ if __name__ == "__main__":
             RosbridgeTcpSocket.incoming_buffer = incoming_buffer
             RosbridgeTcpSocket.socket_timeout = socket_timeout
             RosbridgeTcpSocket.fragment_timeout = fragment_timeout
+            RosbridgeTcpSocket.max_fragment_bytes = max_fragment_bytes
             RosbridgeTcpSocket.delay_between_messages = delay_between_messages
             RosbridgeTcpSocket.max_message_size = max_message_size
             RosbridgeTcpSocket.unregister_timeout = unregister_timeout
             RosbridgeTcpSocket.bson_only_mode = bson_only_mode
+            RosbridgeTcpSocket.allow_binary_attachments = allow_binary_attachments
+            RosbridgeTcpSocket.allow_length_prefixed_json = allow_length_prefixed_json
+            RosbridgeTcpSocket.max_send_queue_messages = max_send_queue_messages
+            RosbridgeTcpSocket.max_send_queue_bytes = max_send_queue_bytes
+            RosbridgeTcpSocket.send_queue_policy = send_queue_policy
+            RosbridgeTcpSocket.allow_compression = allow_compression
+            RosbridgeTcpSocket.compression_level = compression_level
+            RosbridgeTcpSocket.compression_window_bits = compression_window_bits
+            RosbridgeTcpSocket.compression_mem_level = compression_mem_level
+            if json_backend != 'auto':
+                json.use(json_backend)
+            loginfo("Using JSON encoder %s and decoder %s", json.encoder.name, json.decoder.name)
+            # Started after choosing the JSON backend, which the workers use as well
+            if conversion_pool.pool is None and conversion_pool.start(conversion_processes):
+                on_shutdown(conversion_pool.stop)
+                loginfo("Converting messages in %d worker processes", conversion_processes)
 
 
             if "--topics_glob" in sys.argv:
@@ -229,6 +270,8 @@ if __name__ == "__main__":
             SocketServer.ThreadingTCPServer.allow_reuse_address = True
             server = SocketServer.ThreadingTCPServer((host, port), RosbridgeTcpSocket)
             on_shutdown(partial(shutdown_hook, server))
+            if stats_period > 0 and stats_publisher is None:
+                stats_publisher = StatsPublisher(stats_topic, stats_period)
 
             loginfo("Rosbridge TCP server started on port %d", port)
 
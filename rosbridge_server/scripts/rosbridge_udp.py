@@ -45,6 +45,9 @@ from rosbridge_library.capabilities.subscribe import Subscribe
 from rosbridge_library.capabilities.advertise_service import AdvertiseService
 from rosbridge_library.capabilities.unadvertise_service import UnadvertiseService
 from rosbridge_library.capabilities.call_service import CallService
+from rosbridge_library.internal import conversion_pool
+from rosbridge_library.internal.stats import StatsPublisher
+from rosbridge_library.util import json
 
 def shutdown_hook():
     reactor.stop()
@@ -59,14 +62,39 @@ if __name__ == "__main__":
      # get RosbridgeProtocol parameters
     RosbridgeUdpSocket.fragment_timeout = rospy.get_param('~fragment_timeout',
                                                           RosbridgeUdpSocket.fragment_timeout)
+    RosbridgeUdpSocket.max_fragment_bytes = rospy.get_param('~max_fragment_bytes',
+                                                            RosbridgeUdpSocket.max_fragment_bytes)
     RosbridgeUdpSocket.delay_between_messages = rospy.get_param('~delay_between_messages',
                                                                 RosbridgeUdpSocket.delay_between_messages)
     RosbridgeUdpSocket.max_message_size = rospy.get_param('~max_message_size',
                                                           RosbridgeUdpSocket.max_message_size)
     RosbridgeUdpSocket.unregister_timeout = rospy.get_param('~unregister_timeout',
                                                           RosbridgeUdpSocket.unregister_timeout)
+    RosbridgeUdpSocket.max_send_queue_messages = rospy.get_param('~max_send_queue_messages',
+                                                                 RosbridgeUdpSocket.max_send_queue_messages)
+    RosbridgeUdpSocket.max_send_queue_bytes = rospy.get_param('~max_send_queue_bytes',
+                                                              RosbridgeUdpSocket.max_send_queue_bytes)
+    RosbridgeUdpSocket.send_queue_policy = rospy.get_param('~send_queue_policy',
+                                                           RosbridgeUdpSocket.send_queue_policy)
     if RosbridgeUdpSocket.max_message_size == "None":
         RosbridgeUdpSocket.max_message_size = None
+    if RosbridgeUdpSocket.max_send_queue_messages == "None":
+        RosbridgeUdpSocket.max_send_queue_messages = None
+    if RosbridgeUdpSocket.max_send_queue_bytes == "None":
+        RosbridgeUdpSocket.max_send_queue_bytes = None
+    if RosbridgeUdpSocket.max_fragment_bytes == "None":
+        RosbridgeUdpSocket.max_fragment_bytes = None
+    json_backend = rospy.get_param('~json_backend', 'auto')
+    if json_backend != 'auto':
+        json.use(json_backend)
+    rospy.loginfo("Using JSON encoder %s and decoder %s", json.encoder.name, json.decoder.name)
+    # Started after choosing the JSON backend, which the workers use as well
+    conversion_processes = rospy.get_param('~conversion_processes', 0)
+    if conversion_pool.start(conversion_processes):
+        rospy.on_shutdown(conversion_pool.stop)
+        rospy.loginfo("Converting messages in %d worker processes", conversion_processes)
+    stats_topic = rospy.get_param('~stats_topic', '/rosbridge/stats')
+    stats_period = rospy.get_param('~stats_period', 0)
 
     # Get the glob strings and parse them as arrays.
     RosbridgeUdpSocket.topics_glob = [
@@ -190,6 +218,9 @@ if __name__ == "__main__":
     # Done with parameter handling                   #
     ##################################################
 
+    if stats_period > 0:
+        stats_publisher = StatsPublisher(stats_topic, stats_period)
+
     rospy.loginfo("Rosbridge UDP server started on port %d", port)
     reactor.listenUDP(port, RosbridgeUdpFactory(), interface=interface)
     reactor.run()
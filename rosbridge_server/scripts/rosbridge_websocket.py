@@ -44,6 +44,7 @@ from tornado.web import Application
 from rosbridge_server import RosbridgeWebSocket
 from rosbridge_server import RosbridgeWebSocketRDF
 from rosbridge_server import LinkedRoboticThing, LRTWebSocket
+from rosbridge_server import MetricsHandler
 
 from rosbridge_library.capabilities.advertise import Advertise
 from rosbridge_library.capabilities.publish import Publish
@@ -51,7 +52,9 @@ from rosbridge_library.capabilities.subscribe import Subscribe
 from rosbridge_library.capabilities.advertise_service import AdvertiseService
 from rosbridge_library.capabilities.unadvertise_service import UnadvertiseService
 from rosbridge_library.capabilities.call_service import CallService
-from rosbridge_library.util import AtomicInteger
+from rosbridge_library.internal import conversion_pool
+from rosbridge_library.internal.stats import StatsPublisher
+from rosbridge_library.util import AtomicInteger, json
 import logging
 
 def shutdown_hook():
@@ -79,6 +82,9 @@ if __name__ == "__main__":
     RosbridgeWebSocket.fragment_timeout = rospy.get_param('~fragment_timeout',
                                                           RosbridgeWebSocket.fragment_timeout)
     RosbridgeWebSocketRDF.fragment_timeout = RosbridgeWebSocket.fragment_timeout
+    RosbridgeWebSocket.max_fragment_bytes = rospy.get_param('~max_fragment_bytes',
+                                                            RosbridgeWebSocket.max_fragment_bytes)
+    RosbridgeWebSocketRDF.max_fragment_bytes = RosbridgeWebSocket.max_fragment_bytes
     RosbridgeWebSocket.delay_between_messages = rospy.get_param('~delay_between_messages',
                                                                 RosbridgeWebSocket.delay_between_messages)
     RosbridgeWebSocketRDF.delay_between_messages = RosbridgeWebSocket.delay_between_messages
@@ -89,11 +95,59 @@ if __name__ == "__main__":
                                                           RosbridgeWebSocket.unregister_timeout)
     RosbridgeWebSocketRDF.unregister_timeout = RosbridgeWebSocket.unregister_timeout
     bson_only_mode = rospy.get_param('~bson_only_mode', False)
+    RosbridgeWebSocket.allow_binary_attachments = rospy.get_param('~allow_binary_attachments',
+                                                                  RosbridgeWebSocket.allow_binary_attachments)
+
+    RosbridgeWebSocket.max_send_queue_messages = rospy.get_param('~max_send_queue_messages',
+                                                                 RosbridgeWebSocket.max_send_queue_messages)
+    RosbridgeWebSocketRDF.max_send_queue_messages = RosbridgeWebSocket.max_send_queue_messages
+    RosbridgeWebSocket.max_send_queue_bytes = rospy.get_param('~max_send_queue_bytes',
+                                                              RosbridgeWebSocket.max_send_queue_bytes)
+    RosbridgeWebSocketRDF.max_send_queue_bytes = RosbridgeWebSocket.max_send_queue_bytes
+    RosbridgeWebSocket.send_queue_policy = rospy.get_param('~send_queue_policy',
+                                                           RosbridgeWebSocket.send_queue_policy)
+    RosbridgeWebSocketRDF.send_queue_policy = RosbridgeWebSocket.send_queue_policy
+    RosbridgeWebSocket.max_batch_messages = rospy.get_param('~max_batch_messages',
+                                                            RosbridgeWebSocket.max_batch_messages)
+    RosbridgeWebSocketRDF.max_batch_messages = RosbridgeWebSocket.max_batch_messages
+    RosbridgeWebSocket.allow_compression = rospy.get_param('~allow_compression',
+                                                           RosbridgeWebSocket.allow_compression)
+    RosbridgeWebSocketRDF.allow_compression = RosbridgeWebSocket.allow_compression
+    RosbridgeWebSocket.compression_level = rospy.get_param('~compression_level',
+                                                           RosbridgeWebSocket.compression_level)
+    RosbridgeWebSocketRDF.compression_level = RosbridgeWebSocket.compression_level
+    RosbridgeWebSocket.compression_window_bits = rospy.get_param('~compression_window_bits',
+                                                                 RosbridgeWebSocket.compression_window_bits)
+    RosbridgeWebSocketRDF.compression_window_bits = RosbridgeWebSocket.compression_window_bits
+    RosbridgeWebSocket.compression_mem_level = rospy.get_param('~compression_mem_level',
+                                                               RosbridgeWebSocket.compression_mem_level)
+    RosbridgeWebSocketRDF.compression_mem_level = RosbridgeWebSocket.compression_mem_level
+    json_backend = rospy.get_param('~json_backend', 'auto')
+    if json_backend != 'auto':
+        json.use(json_backend)
+    rospy.loginfo("Using JSON encoder %s and decoder %s", json.encoder.name, json.decoder.name)
+    # Started after choosing the JSON backend, which the workers use as well
+    conversion_processes = rospy.get_param('~conversion_processes', 0)
+    if conversion_pool.start(conversion_processes):
+        rospy.on_shutdown(conversion_pool.stop)
+        rospy.loginfo("Converting messages in %d worker processes", conversion_processes)
+    stats_topic = rospy.get_param('~stats_topic', '/rosbridge/stats')
+    stats_period = rospy.get_param('~stats_period', 0)
+    enable_metrics = rospy.get_param('~enable_metrics', False)
 
     if RosbridgeWebSocket.max_message_size == "None":
         RosbridgeWebSocket.max_message_size = None
     if RosbridgeWebSocketRDF.max_message_size == "None":
         RosbridgeWebSocketRDF.max_message_size = None
+    if RosbridgeWebSocket.max_send_queue_messages == "None":
+        RosbridgeWebSocket.max_send_queue_messages = None
+        RosbridgeWebSocketRDF.max_send_queue_messages = None
+    if RosbridgeWebSocket.max_send_queue_bytes == "None":
+        RosbridgeWebSocket.max_send_queue_bytes = None
+        RosbridgeWebSocketRDF.max_send_queue_bytes = None
+    if RosbridgeWebSocket.max_fragment_bytes == "None":
+        RosbridgeWebSocket.max_fragment_bytes = None
+        RosbridgeWebSocketRDF.max_fragment_bytes = None
 
     # SSL options
     certfile = rospy.get_param('~certfile', None)
@@ -256,6 +310,14 @@ if __name__ == "__main__":
                                (r"/lrt(?P<path>/.*)?", LinkedRoboticThing, dict(path_prefix="/lrt", websocket_prefix="/lrtws")),
                                (r"/lrtws/topics(?P<topic>/.*)?", LRTWebSocket, dict(path_prefix="/lrtws/topics", resource_prefix="/lrt"))
                                ])
+    if enable_metrics and RosbridgeWebSocket.authenticate:
+        # /metrics has no authentication of its own
+        rospy.logwarn("Not serving /metrics, as clients have to authenticate")
+    elif enable_metrics:
+        # Prometheus scrapes the statistics of all clients from here
+        application.add_handlers(r".*", [(r"/metrics", MetricsHandler)])
+    if stats_period > 0:
+        stats_publisher = StatsPublisher(stats_topic, stats_period)
 
     connected = False
     while not connected and not rospy.is_shutdown():
@@ -4,3 +4,4 @@ from .websocket_rdf_handler import RosbridgeWebSocketRDF
 from .tcp_handler import RosbridgeTcpSocket
 from .udp_handler import RosbridgeUdpSocket,RosbridgeUdpFactory
 from .linked_robotic_thing import LinkedRoboticThing,LRTWebSocket
+from .metrics_handler import MetricsHandler
@@ -1,6 +1,5 @@
 from __future__ import print_function
 
-import json
 import logging
 import tornado
 import tornado.web
@@ -29,7 +28,7 @@ from rosbridge_library.capabilities.advertise import Registration
 from rosbridge_library.capabilities.subscribe import Subscription
 from rosbridge_library.internal import ros_loader
 from rosbridge_library.internal.publishers import manager as publisher_manager
-from rosbridge_library.util import rdfutils
+from rosbridge_library.util import json, rdfutils
 
 UUID_URI = 'http://{}'.format(uuid.uuid4())
 
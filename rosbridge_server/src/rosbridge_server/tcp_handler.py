@@ -1,6 +1,10 @@
 import rospy
+import socket
 import struct
+import zlib
 from rosbridge_library.rosbridge_protocol import RosbridgeProtocol
+from rosbridge_library.internal.outgoing_queue import OutgoingQueue
+from rosbridge_library.internal.send_queue import SendQueue
 
 try:
     import SocketServer
@@ -23,25 +27,65 @@ class RosbridgeTcpSocket(SocketServer.BaseRequestHandler):
     # The following are passed on to RosbridgeProtocol
     # defragmentation.py:
     fragment_timeout = 600                  # seconds
+    max_fragment_bytes = 64 * 1024 * 1024   # bytes, of incomplete messages
     # protocol.py:
     delay_between_messages = 0              # seconds
     max_message_size = None                 # bytes
     unregister_timeout = 10.0               # seconds
+    # send queue, bounds the messages waiting for a slow client
+    max_send_queue_messages = 1000
+    max_send_queue_bytes = 64 * 1024 * 1024
+    send_queue_policy = "drop_oldest"
     bson_only_mode = False
+    allow_binary_attachments = True
+    # Clients may ask for length-prefixed JSON by sending length_prefix_magic
+    # first.  Every message in both directions is then preceded by its length.
+    allow_length_prefixed_json = True
+    length_prefix_magic = b"RBLP"
+    length_prefix = struct.Struct("!I")
+    # Clients may ask for zlib stream compression by sending compression_magic
+    # first.  Both directions are then a zlib stream, flushed after every
+    # message.
+    allow_compression = True
+    compression_magic = b"RBZL"
+    compression_level = 6
+    compression_window_bits = 15            # 9 to 15
+    compression_mem_level = 8               # 1 to 9
+
+    # per connection state
+    negotiating = True
+    length_prefixed = False
+    pending_data = b""
+    compressor = None
+    decompressor = None
 
     def setup(self):
         cls = self.__class__
         parameters = {
             "fragment_timeout": cls.fragment_timeout,
+            "max_fragment_bytes": cls.max_fragment_bytes,
             "delay_between_messages": cls.delay_between_messages,
             "max_message_size": cls.max_message_size,
             "unregister_timeout": cls.unregister_timeout,
-            "bson_only_mode": cls.bson_only_mode
+            "bson_only_mode": cls.bson_only_mode,
+            "allow_binary_attachments": cls.allow_binary_attachments
         }
+        self.negotiating = not cls.bson_only_mode
 
         try:
             self.protocol = RosbridgeProtocol(cls.client_id_seed, parameters=parameters)
+            # Messages are written from their own thread, so a client that
+            # reads slowly does not block the threads producing them
+            self.send_queue = SendQueue(cls.max_send_queue_messages, cls.max_send_queue_bytes,
+                                        cls.send_queue_policy)
+            self.protocol.stats.add_queue("send", self.send_queue)
+            self.sender = OutgoingQueue(self.write_message, queue=self.send_queue,
+                                        log=self.protocol.log, is_closed=self.is_closed)
             self.protocol.outgoing = self.send_message
+            self.protocol.outgoing_takes_topic = True
+            self.protocol.outgoing_takes_streams = True
+            # Binary serializers need length-prefixed framing
+            self.protocol.delimits_messages = cls.bson_only_mode
             cls.client_id_seed += 1
             cls.clients_connected += 1
             self.protocol.log("info", "connected. " + str(cls.clients_connected) + " client total.")
@@ -51,9 +95,10 @@ class RosbridgeTcpSocket(SocketServer.BaseRequestHandler):
     def recvall(self,n):
         # http://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data
         # Helper function to recv n bytes or return None if EOF is hit
-        data = ''
+        data = self.pending_data[:n]
+        self.pending_data = self.pending_data[n:]
         while len(data) < n:
-            packet = self.request.recv(n - len(data))
+            packet = self.receive(n - len(data))
             if not packet:
                 return None
             data += packet
@@ -81,6 +126,107 @@ class RosbridgeTcpSocket(SocketServer.BaseRequestHandler):
         self.protocol.incoming(data)
         return True
 
+    def recv_length_prefixed(self):
+        # Read the length of the JSON message
+        raw_msglen = self.recvall(self.length_prefix.size)
+        if not raw_msglen:
+            return None
+        msglen = self.length_prefix.unpack(raw_msglen)[0]
+
+        # Retrieve the message, which is known to be complete
+        data = self.recvall(msglen)
+        if data == None:
+            return None
+
+        self.protocol.handle_message(data)
+        return True
+
+    def receive(self, n):
+        """
+        Receives up to n bytes from the client, decompressed if the client
+        asked for compression.  Returns an empty string on EOF
+        """
+        if self.decompressor is None:
+            return self.request.recv(n)
+        while True:
+            # The output is limited to n bytes, the rest of the input is kept
+            # in unconsumed_tail
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.decompress(self.decompressor.unconsumed_tail, n)
+            else:
+                packet = self.request.recv(n)
+                if not packet:
+                    return packet
+                data = self.decompressor.decompress(packet, n)
+            if data:
+                return data
+
+    def negotiate(self, data):
+        """
+        Handles the magics a client may start the connection with, first the
+        one for compression, then the one for framing.  Returns the received
+        data that follows them
+        """
+        if self.compressor is None:
+            data = self.negotiate_compression(data)
+            if self.compressor is not None and not data:
+                # The framing magic may follow in the next packet
+                return data
+        return self.negotiate_framing(data)
+
+    def negotiate_compression(self, data):
+        """
+        Switches the connection to zlib stream compression if the client
+        started it with the magic.  Returns the decompressed data that follows
+        the magic, or all of the data otherwise
+        """
+        cls = self.__class__
+        if not cls.allow_compression:
+            return data
+        magic = cls.compression_magic
+        while len(data) < len(magic) and magic.startswith(data):
+            packet = self.request.recv(len(magic) - len(data))
+            if not packet:
+                return data
+            data += packet
+        if not data.startswith(magic):
+            return data
+
+        # Acknowledge uncompressed, everything after it is compressed
+        self.request.sendall(magic)
+        self.compressor = zlib.compressobj(cls.compression_level, zlib.DEFLATED,
+                                           cls.compression_window_bits, cls.compression_mem_level)
+        # The client may use any window size
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        self.protocol.log("info", "using zlib stream compression")
+        return self.decompressor.decompress(data[len(magic):], cls.incoming_buffer)
+
+    def negotiate_framing(self, data):
+        """
+        Switches the connection to length-prefixed JSON if the client started
+        it with the magic.  Returns the received data that follows the magic,
+        or all of it otherwise
+        """
+        cls = self.__class__
+        self.negotiating = False
+        if not cls.allow_length_prefixed_json:
+            return data
+        magic = cls.length_prefix_magic
+        while len(data) < len(magic) and magic.startswith(data):
+            packet = self.receive(len(magic) - len(data))
+            if not packet:
+                return data
+            data += packet
+        if not data.startswith(magic):
+            return data
+
+        self.length_prefixed = True
+        self.protocol.delimits_messages = True
+        # Acknowledge, so the client knows that messages will be prefixed
+        self.write(magic)
+        self.protocol.log("info", "using length-prefixed JSON")
+        return data[len(magic):]
+
     def handle(self):
         """
         Listen for TCP messages
@@ -94,8 +240,20 @@ class RosbridgeTcpSocket(SocketServer.BaseRequestHandler):
                       break
                   continue
 
+              if self.length_prefixed:
+                  if self.recv_length_prefixed() == None:
+                      break
+                  continue
+
               # non-BSON handling
-              data = self.request.recv(cls.incoming_buffer)
+              data = self.receive(cls.incoming_buffer)
+              if self.negotiating and data:
+                  data = self.negotiate(data)
+                  if self.length_prefixed:
+                      self.pending_data = data
+                      continue
+                  if self.negotiating:
+                      continue
               # Exit on empty string
               if data.strip() == '':
                   break
@@ -113,11 +271,43 @@ class RosbridgeTcpSocket(SocketServer.BaseRequestHandler):
         """
         cls = self.__class__
         cls.clients_connected -= 1
+        self.sender.finish()
         self.protocol.finish()
+        stats = self.send_queue.stats()
+        if stats["dropped"] > 0:
+            self.protocol.log("info", "dropped %d of %d messages, the client did not read fast enough."
+                              % (stats["dropped"], stats["dropped"] + stats["sent"]))
         self.protocol.log("info", "disconnected. " + str(cls.clients_connected) + " client total." )
 
-    def send_message(self, message=None):
+    def send_message(self, message=None, topic=None):
         """
         Callback from rosbridge
         """
-        self.request.sendall(message)
+        self.sender.push(message, topic)
+
+    def write_message(self, message, topic=None):
+        """
+        Writes a message to the socket, called from the sender thread
+        """
+        if not isinstance(message, bytes):
+            message = message.encode("utf-8")
+        if self.length_prefixed:
+            message = self.length_prefix.pack(len(message)) + message
+        self.write(message)
+
+    def is_closed(self, exc):
+        """
+        Tells whether an exception raised while writing means that the
+        connection is closed.  A write that timed out may still succeed later
+        """
+        return isinstance(exc, socket.error) and not isinstance(exc, socket.timeout)
+
+    def write(self, data):
+        """
+        Sends data to the client, compressed if the client asked for
+        compression
+        """
+        if self.compressor is not None:
+            # Flush, so the client can decompress the message right away
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.request.sendall(data)
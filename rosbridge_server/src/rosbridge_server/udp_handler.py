@@ -1,7 +1,9 @@
 import rospy
 from rosbridge_library.rosbridge_protocol import RosbridgeProtocol
 from rosbridge_library.util import json, bson
+from rosbridge_library.internal.send_queue import SendQueue
 
+from twisted.internet import reactor
 from twisted.internet.protocol import DatagramProtocol,Factory
 
 class RosbridgeUdpFactory(DatagramProtocol):
@@ -26,10 +28,15 @@ class RosbridgeUdpSocket:
     # The following parameters are passed on to RosbridgeProtocol
     # defragmentation.py:
     fragment_timeout = 600                  # seconds
+    max_fragment_bytes = 64 * 1024 * 1024   # bytes, of incomplete messages
     # protocol.py:
     delay_between_messages = 0              # seconds
     max_message_size = None                 # bytes
     unregister_timeout = 10.0               # seconds
+    # send queue, bounds the messages waiting for the reactor to send them
+    max_send_queue_messages = 1000
+    max_send_queue_bytes = 64 * 1024 * 1024
+    send_queue_policy = "drop_oldest"
 
     def __init__(self,write):
         self.write = write
@@ -39,13 +46,19 @@ class RosbridgeUdpSocket:
         cls = self.__class__
         parameters = {
             "fragment_timeout": cls.fragment_timeout,
+            "max_fragment_bytes": cls.max_fragment_bytes,
             "delay_between_messages": cls.delay_between_messages,
             "max_message_size": cls.max_message_size,
             "unregister_timeout": cls.unregister_timeout
         }
         try:
             self.protocol = RosbridgeProtocol(cls.client_id_seed, parameters=parameters)
+            self.send_queue = SendQueue(cls.max_send_queue_messages, cls.max_send_queue_bytes,
+                                        cls.send_queue_policy)
+            self.protocol.stats.add_queue("send", self.send_queue)
             self.protocol.outgoing = self.send_message
+            self.protocol.outgoing_takes_topic = True
+            self.protocol.outgoing_takes_streams = True
             self.authenticated = False
             cls.client_id_seed += 1
             cls.clients_connected += 1
@@ -85,10 +98,22 @@ class RosbridgeUdpSocket:
     def stopProtocol(self):
         cls = self.__class__
         cls.clients_connected -= 1
+        self.send_queue.clear()
         self.protocol.finish()
+        stats = self.send_queue.stats()
+        if stats["dropped"] > 0:
+            rospy.loginfo("Dropped %d of %d messages to client %d.",
+                          stats["dropped"], stats["dropped"] + stats["sent"], self.protocol.client_id)
         rospy.loginfo("Client disconnected. %d clients total.", cls.clients_connected)
-    def send_message(self, message):
-        binary = type(message)==bson.BSON
-        self.write(message)
+    def send_message(self, message, topic=None):
+        # Messages are produced by ROS threads, but the transport may only be
+        # used from the reactor thread
+        if self.send_queue.push(message, topic):
+            reactor.callFromThread(self.write_queued)
+    def write_queued(self):
+        entry = self.send_queue.pop()
+        while entry is not None:
+            self.write(entry[0])
+            entry = self.send_queue.pop()
     def check_origin(self, origin):
         return False
@@ -34,15 +34,89 @@ import rospy
 
 from rosauth.srv import Authentication
 
-from functools import partial
-
 from tornado.ioloop import IOLoop
-from tornado.websocket import WebSocketHandler
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
 
 from rosbridge_library.rosbridge_protocol import RosbridgeProtocol
-from rosbridge_library.util import json, bson
+from rosbridge_library.util import bson
+from rosbridge_library.internal.send_queue import SendQueue
+from rosbridge_library.internal.binary_attachments import BinaryFrame
+from rosbridge_library.capabilities.batch import join_serialized
+
+class WebSocketSendMixin(object):
+    """ Sends the messages of a rosbridge WebSocket handler: they wait in
+    self.send_queue and are written one at a time, batched for clients that
+    set a batch_window, and compressed with permessage-deflate if allowed.
+    Expects the send queue and compression attributes of RosbridgeWebSocket,
+    and has to come before WebSocketHandler in the bases. """
+
+    def send_message(self, message, topic=None):
+        # Only one message is written at a time, the others wait in the send
+        # queue, which drops messages if the client does not keep up
+        if self.send_queue.push(message, topic):
+            IOLoop.instance().add_callback(self.write_later)
+
+    def write_later(self, previous=None):
+        """ Writes the next queued messages once the batch window of the
+        client has passed, so the messages queued meanwhile are sent as one
+        batch, or right away if the client did not set a window, a full
+        batch is queued already or a stream is partly sent.  Runs on the
+        IOLoop. """
+        window = self.protocol.batch_window
+        if (window > 0 and len(self.send_queue) < self.max_batch_messages and
+                self.send_queue.streaming is None):
+            IOLoop.instance().call_later(window / 1000.0, self.write_next)
+        else:
+            self.write_next()
+
+    def write_next(self):
+        """ Writes the next queued message, or batch of messages, and
+        continues once it has been written to the socket.  Runs on the
+        IOLoop. """
+        entry = self.send_queue.pop()
+        if entry is None:
+            return
+        message = entry[0]
+        binary = self.is_binary(message)
+        if self.protocol.batch_window > 0 and not binary:
+            messages = [message] + self.send_queue.pop_while(lambda queued: not self.is_binary(queued),
+                                                             self.max_batch_messages - 1)
+            if len(messages) > 1:
+                message = join_serialized(messages)
+        try:
+            future = self.write_message(message, binary)
+        except WebSocketClosedError:
+            # The send queue is not drained anymore and never idle again
+            self.send_queue.clear()
+            return
+        if future is None:
+            # tornado < 4.3 does not allow waiting for the write
+            IOLoop.instance().add_callback(self.write_later)
+        else:
+            IOLoop.instance().add_future(future, self.write_later)
 
-class RosbridgeWebSocket(WebSocketHandler):
+    def is_binary(self, message):
+        return type(message) in (bson.BSON, BinaryFrame)
+
+    def prepare(self):
+        # tornado sizes the compression window of the server as the client
+        # asks for in its offer, so a smaller window is asked for on its behalf
+        cls = self.__class__
+        extensions = self.request.headers.get("Sec-WebSocket-Extensions")
+        if (cls.allow_compression and cls.compression_window_bits < 15 and extensions and
+                "permessage-deflate" in extensions and "server_max_window_bits" not in extensions):
+            self.request.headers["Sec-WebSocket-Extensions"] = extensions.replace(
+                "permessage-deflate", "permessage-deflate; server_max_window_bits=%d" % cls.compression_window_bits)
+
+    def get_compression_options(self):
+        # tornado < 4.5 ignores the options, but still compresses
+        cls = self.__class__
+        if not cls.allow_compression:
+            return None
+        return {"compression_level": cls.compression_level, "mem_level": cls.compression_mem_level}
+
+
+class RosbridgeWebSocket(WebSocketSendMixin, WebSocketHandler):
     client_id_seed = 0
     clients_connected = 0
     authenticate = False
@@ -50,24 +124,48 @@ class RosbridgeWebSocket(WebSocketHandler):
     # The following are passed on to RosbridgeProtocol
     # defragmentation.py:
     fragment_timeout = 600                  # seconds
+    max_fragment_bytes = 64 * 1024 * 1024   # bytes, of incomplete messages
     # protocol.py:
     delay_between_messages = 0              # seconds
     max_message_size = None                 # bytes
     unregister_timeout = 10.0               # seconds
+    # send queue, bounds the messages waiting for a slow client
+    max_send_queue_messages = 1000
+    max_send_queue_bytes = 64 * 1024 * 1024
+    send_queue_policy = "drop_oldest"
+    # batches, sent to clients setting a batch_window
+    max_batch_messages = 100
+    # permessage-deflate, used if the client offers it
+    allow_compression = False
+    compression_level = 6
+    compression_window_bits = 15            # 9 to 15
+    compression_mem_level = 8               # 1 to 9
     bson_only_mode = False
+    allow_binary_attachments = True
 
     def open(self):
         cls = self.__class__
         parameters = {
             "fragment_timeout": cls.fragment_timeout,
+            "max_fragment_bytes": cls.max_fragment_bytes,
             "delay_between_messages": cls.delay_between_messages,
             "max_message_size": cls.max_message_size,
             "unregister_timeout": cls.unregister_timeout,
-            "bson_only_mode": cls.bson_only_mode
+            "bson_only_mode": cls.bson_only_mode,
+            "allow_binary_attachments": cls.allow_binary_attachments
         }
         try:
             self.protocol = RosbridgeProtocol(int(cls.client_id_seed), parameters=parameters)
+            self.send_queue = SendQueue(cls.max_send_queue_messages, cls.max_send_queue_bytes,
+                                        cls.send_queue_policy)
+            self.protocol.stats.add_queue("send", self.send_queue)
             self.protocol.outgoing = self.send_message
+            self.protocol.outgoing_takes_topic = True
+            self.protocol.outgoing_takes_streams = True
+            # Clients may choose their wire format in the URL, e.g. ?serializer=cbor
+            serializer = self.get_argument("serializer", None)
+            if serializer:
+                self.protocol.set_serializer(serializer)
             self.set_nodelay(True)
             self.authenticated = False
             cls.client_id_seed += 1
@@ -83,10 +181,7 @@ class RosbridgeWebSocket(WebSocketHandler):
         # check if we need to authenticate
         if cls.authenticate and not self.authenticated:
             try:
-                if cls.bson_only_mode:
-                    msg = bson.BSON(message).decode()
-                else:
-                    msg = json.loads(message)
+                msg = self.protocol.deserialize(message)
 
                 if msg['op'] == 'auth':
                     # check the authorization information
@@ -112,12 +207,13 @@ class RosbridgeWebSocket(WebSocketHandler):
     def on_close(self):
         cls = self.__class__
         cls.clients_connected -= 1
+        self.send_queue.clear()
         self.protocol.finish()
+        stats = self.send_queue.stats()
+        if stats["dropped"] > 0:
+            rospy.loginfo("Dropped %d of %d messages to client %d, it did not read fast enough.",
+                          stats["dropped"], stats["dropped"] + stats["sent"], self.protocol.client_id)
         rospy.loginfo("Client disconnected. %d clients total.", cls.clients_connected)
 
-    def send_message(self, message):
-        binary = type(message)==bson.BSON
-        IOLoop.instance().add_callback(partial(self.write_message, message, binary))
-
     def check_origin(self, origin):
         return True
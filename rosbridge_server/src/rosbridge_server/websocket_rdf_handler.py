@@ -34,15 +34,14 @@ import rospy
 
 from rosauth.srv import Authentication
 
-from functools import partial
-
-from tornado.ioloop import IOLoop
 from tornado.websocket import WebSocketHandler
 
 from rosbridge_library.rosbridge_rdf_protocol import RosbridgeRDFProtocol
 from rosbridge_library.util import json, bson
+from rosbridge_library.internal.send_queue import SendQueue
+from rosbridge_server.websocket_handler import WebSocketSendMixin
 
-class RosbridgeWebSocketRDF(WebSocketHandler):
+class RosbridgeWebSocketRDF(WebSocketSendMixin, WebSocketHandler):
     client_id_seed = 0
     clients_connected = 0
     authenticate = False
@@ -50,16 +49,29 @@ class RosbridgeWebSocketRDF(WebSocketHandler):
     # The following are passed on to RosbridgeProtocol
     # defragmentation.py:
     fragment_timeout = 600                  # seconds
+    max_fragment_bytes = 64 * 1024 * 1024   # bytes, of incomplete messages
     # protocol.py:
     delay_between_messages = 0              # seconds
     max_message_size = None                 # bytes
     unregister_timeout = 10.0               # seconds
+    # send queue, bounds the messages waiting for a slow client
+    max_send_queue_messages = 1000
+    max_send_queue_bytes = 64 * 1024 * 1024
+    send_queue_policy = "drop_oldest"
+    # batches, sent to clients setting a batch_window
+    max_batch_messages = 100
+    # permessage-deflate, used if the client offers it
+    allow_compression = False
+    compression_level = 6
+    compression_window_bits = 15            # 9 to 15
+    compression_mem_level = 8               # 1 to 9
     bson_only_mode = False
 
     def open(self):
         cls = self.__class__
         parameters = {
             "fragment_timeout": cls.fragment_timeout,
+            "max_fragment_bytes": cls.max_fragment_bytes,
             "delay_between_messages": cls.delay_between_messages,
             "max_message_size": cls.max_message_size,
             "unregister_timeout": cls.unregister_timeout,
@@ -68,7 +80,12 @@ class RosbridgeWebSocketRDF(WebSocketHandler):
         }
         try:
             self.protocol = RosbridgeRDFProtocol(int(cls.client_id_seed), parameters=parameters)
+            self.send_queue = SendQueue(cls.max_send_queue_messages, cls.max_send_queue_bytes,
+                                        cls.send_queue_policy)
+            self.protocol.stats.add_queue("send", self.send_queue)
             self.protocol.outgoing = self.send_message
+            self.protocol.outgoing_takes_topic = True
+            self.protocol.outgoing_takes_streams = True
             self.set_nodelay(True)
             self.authenticated = False
             cls.client_id_seed += 1
@@ -113,12 +130,13 @@ class RosbridgeWebSocketRDF(WebSocketHandler):
     def on_close(self):
         cls = self.__class__
         cls.clients_connected -= 1
+        self.send_queue.clear()
         self.protocol.finish()
+        stats = self.send_queue.stats()
+        if stats["dropped"] > 0:
+            rospy.loginfo("Dropped %d of %d messages to client %d, it did not read fast enough.",
+                          stats["dropped"], stats["dropped"] + stats["sent"], self.protocol.client_id)
         rospy.loginfo("RDF Client disconnected. %d clients total.", cls.clients_connected)
 
-    def send_message(self, message):
-        binary = type(message)==bson.BSON
-        IOLoop.instance().add_callback(partial(self.write_message, message, binary))
-
     def check_origin(self, origin):
         return True